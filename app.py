@@ -1,7 +1,22 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, session, flash, g, has_app_context, send_file
+import csv
+import functools
+import hashlib
+import io
+import math
+import mimetypes
+import os
+import queue
+import re
 import sqlite3
-from datetime import datetime, timedelta
-from werkzeug.security import check_password_hash
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturoExpirado
+from datetime import datetime, timedelta, timezone
+from werkzeug.security import check_password_hash, generate_password_hash
 
 app = Flask(__name__)
 
@@ -14,204 +29,3474 @@ app.secret_key = 'chave-muito-secreta-uuuuuuuuuuuuuuuuhh'
 # Define o tempo máximo de sessão ativa (2 horas)
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=2)
 
+# Ajustes do SQLite (pool de conexões e PRAGMAs de desempenho)
+app.config['SQLITE_POOL_TAMANHO'] = 8              # conexões ociosas mantidas por processo
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 5000        # espera pelo lock de escrita antes de falhar
+app.config['SQLITE_CACHE_KB'] = 16384              # cache de páginas por conexão (16 MB)
+app.config['SQLITE_MMAP_BYTES'] = 256 * 1024 * 1024
+app.config['SQLITE_CACHE_STATEMENTS'] = 128        # cache de statements preparados por conexão
+
+# Fuso horário da casa: o banco guarda instantes em epoch UTC e
+# a conversão para o horário local acontece na borda da API
+app.config['FUSO_HORARIO_HORAS'] = -3
+
+
+# -----------------------------------------------------------
+# Abre uma conexão nova já com os PRAGMAs de desempenho:
+# - WAL permite leitores em paralelo com o escritor
+# - synchronous=NORMAL evita fsync a cada commit (seguro com WAL)
+# - mmap/cache reduzem leituras de disco
+# - busy_timeout espera o lock em vez de dar "database is locked"
+# -----------------------------------------------------------
+def _abrir_conexao(caminho):
+    conn = sqlite3.connect(
+        caminho,
+        timeout=app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000,
+        check_same_thread=False,  # a conexão circula entre threads via pool
+        cached_statements=app.config['SQLITE_CACHE_STATEMENTS'],
+        factory=ConexaoInstrumentada if _instrumentar_sql() else sqlite3.Connection,
+    )
+    conn.row_factory = sqlite3.Row  # permite acessar resultado por nome da coluna
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    conn.execute(f"PRAGMA cache_size = -{int(app.config['SQLITE_CACHE_KB'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_BYTES'])}")
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+# Métricas de requisições e SQL, expostas em /metrics (Prometheus)
+app.config['METRICAS_ATIVAS'] = True
+
+# Faixas (segundos) do histograma de latência das requisições
+FAIXAS_LATENCIA_S = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Log de consultas lentas (diagnóstico, desligado por padrão):
+# consultas acima do limite vão para o log com o plano de execução
+app.config['CONSULTAS_LENTAS_MS'] = None    # ex.: 50 → loga consultas acima de 50 ms
+app.config['CONSULTAS_LENTAS_TOP'] = 20     # consultas listadas em /api/diagnostico/consultas
+
+
+def _instrumentar_sql():
+    return app.config['METRICAS_ATIVAS'] or app.config['CONSULTAS_LENTAS_MS'] is not None
+
+
+# -----------------------------------------------------------
+# Acumuladores das métricas do processo. Cada atualização é uma
+# soma em dicionário sob um lock: barato o bastante para deixar
+# ligado em produção. Com vários workers (serve.py), cada processo
+# expõe os próprios números (rótulo "pid").
+# -----------------------------------------------------------
+class Metricas:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requisicoes = {}   # (endpoint, método, status) → [contagem por faixa..., soma, total]
+        self.sql = {}           # sql normalizado → [execuções, segundos, linhas, erros]
+        self.em_andamento = 0
+
+    def entrar(self):
+        with self._lock:
+            self.em_andamento += 1
+
+    def sair(self, chave, segundos):
+        faixa = next((i for i, limite in enumerate(FAIXAS_LATENCIA_S) if segundos <= limite),
+                     len(FAIXAS_LATENCIA_S))
+        with self._lock:
+            self.em_andamento -= 1
+            serie = self.requisicoes.get(chave)
+            if serie is None:
+                serie = self.requisicoes[chave] = [0] * (len(FAIXAS_LATENCIA_S) + 3)
+            serie[faixa] += 1
+            serie[-2] += segundos
+            serie[-1] += 1
+
+    def observar_sql(self, sql, segundos, linhas=0, execucoes=1, erros=0):
+        with self._lock:
+            serie = self.sql.get(sql)
+            if serie is None:
+                serie = self.sql[sql] = [0, 0.0, 0, 0]
+            serie[0] += execucoes
+            serie[1] += segundos
+            serie[2] += linhas
+            serie[3] += erros
+
+    def limpar(self):
+        with self._lock:
+            self.requisicoes.clear()
+            self.sql.clear()
+            self.em_andamento = 0
+
+
+metricas = Metricas()
+
+
+# -----------------------------------------------------------
+# Métricas por rota: latência (histograma) por endpoint, método
+# e status, e o número de requisições em andamento. Registrados
+# antes dos outros hooks, para contar também as respostas que um
+# before_request encerra (ex.: o 403 de /api/jobs). O tempo é
+# fechado quando o servidor fecha a resposta (call_on_close), então
+# respostas em streaming contam até o fim do envio. Arquivos de
+# send_file (direct_passthrough) vão direto ao servidor, sem esse
+# fechamento: fecham no after_request. Se o after_request não rodar
+# (exceção propagada), fecha no teardown como status 500.
+# -----------------------------------------------------------
+@app.before_request
+def _iniciar_medicao():
+    if app.config['METRICAS_ATIVAS']:
+        g.metricas_inicio = time.perf_counter()
+        metricas.entrar()
+
+
+@app.after_request
+def _registrar_status(resposta):
+    inicio = g.pop('metricas_inicio', None)
+    if inicio is not None:
+        chave = (_endpoint_medido(), request.method, resposta.status_code)
+        if resposta.direct_passthrough:
+            metricas.sair(chave, time.perf_counter() - inicio)
+        else:
+            resposta.call_on_close(lambda: metricas.sair(chave, time.perf_counter() - inicio))
+    return resposta
+
+
+@app.teardown_request
+def _encerrar_medicao(erro=None):
+    inicio = g.pop('metricas_inicio', None)
+    if inicio is not None:
+        metricas.sair((_endpoint_medido(), request.method, 500), time.perf_counter() - inicio)
+
+
+def _endpoint_medido():
+    return request.url_rule.rule if request.url_rule else 'sem_rota'
+
+
+# -----------------------------------------------------------
+# Normaliza o SQL para agrupar execuções da mesma consulta:
+# espaços colapsados, literais viram "?" e listas "IN (?, ?, ?)"
+# viram "IN (?, ...)" (o tamanho do lote não cria outra consulta)
+# -----------------------------------------------------------
+_RE_ESPACOS = re.compile(r'\s+')
+_RE_TEXTO = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMERO = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_RE_LISTA = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+@functools.lru_cache(maxsize=2048)
+def normalizar_sql(sql):
+    sql = _RE_ESPACOS.sub(' ', sql).strip()
+    sql = _RE_NUMERO.sub('?', _RE_TEXTO.sub('?', sql))
+    return _RE_LISTA.sub('(?, ...)', sql)
+
+
+# -----------------------------------------------------------
+# Formato dos parâmetros de uma consulta, sem os valores (que
+# podem ter nome e RG de clientes): "(int, str)", "{nome: str}"
+# -----------------------------------------------------------
+def formato_parametros(parametros):
+    if isinstance(parametros, dict):
+        return '{' + ', '.join(f'{k}: {type(v).__name__}' for k, v in parametros.items()) + '}'
+    tipos = [type(v).__name__ for v in parametros]
+    if len(tipos) > 8 and len(set(tipos)) == 1:
+        return f'({tipos[0]} x {len(tipos)})'
+    return '(' + ', '.join(tipos) + ')'
+
+
+# -----------------------------------------------------------
+# Consultas lentas: cada consulta (normalizada) acima do limite
+# vai para o log com o formato dos parâmetros, a duração e as
+# linhas. O EXPLAIN QUERY PLAN roda só na primeira vez que a
+# consulta aparece aqui e fica guardado junto do registro.
+# -----------------------------------------------------------
+class ConsultasLentas:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.registros = {}   # sql normalizado → dict com contagens e plano
+
+    def registrar(self, conn, sql, sql_original, parametros, segundos, linhas):
+        with self._lock:
+            registro = self.registros.get(sql)
+            novo = registro is None
+            if novo:
+                registro = self.registros[sql] = {
+                    'lentas': 0, 'segundos': 0.0, 'maior_segundos': 0.0, 'plano': None,
+                }
+            registro['lentas'] += 1
+            registro['segundos'] += segundos
+            registro['maior_segundos'] = max(registro['maior_segundos'], segundos)
+            registro['linhas'] = linhas
+            registro['parametros'] = formato_parametros(parametros)
+
+        if novo:
+            registro['plano'] = _plano_execucao(conn, sql_original, parametros)
+
+        app.logger.warning(
+            'Consulta lenta (%.1f ms, %d linhas, parâmetros %s): %s%s',
+            segundos * 1000, linhas, registro['parametros'], sql,
+            ''.join(f'\n    {linha}' for linha in registro['plano'] or ()) if novo else '',
+        )
+
+    def limpar(self):
+        with self._lock:
+            self.registros.clear()
+
+
+consultas_lentas = ConsultasLentas()
+
+
+def _plano_execucao(conn, sql, parametros):
+    try:
+        plano = conn.cursor(sqlite3.Cursor).execute('EXPLAIN QUERY PLAN ' + sql, parametros).fetchall()
+    except sqlite3.Error as erro:
+        return [f'(sem plano: {erro})']
+    return [linha[3] for linha in plano]
+
+
+# Varredura da tabela inteira (sem índice) em algum passo do plano
+_RE_VARREDURA = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+def varreduras_completas(plano):
+    return [m.group(1) for m in map(_RE_VARREDURA.match, plano or ()) if m]
+
+
+# -----------------------------------------------------------
+# Cursor e conexão instrumentados (usados por _abrir_conexao).
+# O cursor soma o tempo do execute e das leituras (fetch* e
+# iteração) e as linhas devolvidas; quando a consulta termina
+# (resultado esgotado, novo execute, close ou o cursor sai de
+# uso) os números vão de uma vez para as métricas e, se passar
+# do limite, para o log de consultas lentas.
+# -----------------------------------------------------------
+class CursorInstrumentado(sqlite3.Cursor):
+
+    _sql = None
+
+    def _rodar(self, metodo, sql, parametros, exemplo):
+        self._concluir()
+        inicio = time.perf_counter()
+        try:
+            metodo(sql, parametros)
+        except sqlite3.Error:
+            metricas.observar_sql(normalizar_sql(sql), time.perf_counter() - inicio, erros=1)
+            raise
+        self._segundos = time.perf_counter() - inicio
+        self._linhas = 0
+        self._sql_original = sql
+        self._exemplo = exemplo
+        self._sql = normalizar_sql(sql)
+        return self
+
+    def execute(self, sql, parametros=()):
+        return self._rodar(super().execute, sql, parametros, parametros)
+
+    def executemany(self, sql, parametros):
+        parametros = list(parametros)
+        return self._rodar(super().executemany, sql, parametros, parametros[0] if parametros else ())
+
+    def _concluir(self):
+        sql = self._sql
+        if sql is None:
+            return
+        self._sql = None
+        linhas = self._linhas or max(self.rowcount, 0)  # sem leitura: linhas alteradas
+        metricas.observar_sql(sql, self._segundos, linhas)
+
+        limite = app.config['CONSULTAS_LENTAS_MS']
+        if limite is not None and self._segundos * 1000 >= limite:
+            consultas_lentas.registrar(
+                self.connection, sql, self._sql_original, self._exemplo, self._segundos, linhas
+            )
+
+    def _lidas(self, inicio, linhas, fim):
+        if self._sql is not None:
+            self._segundos += time.perf_counter() - inicio
+            self._linhas += linhas
+            if fim:
+                self._concluir()
+
+    def fetchone(self):
+        inicio = time.perf_counter()
+        linha = super().fetchone()
+        self._lidas(inicio, linha is not None, linha is None)
+        return linha
+
+    def fetchmany(self, size=None):
+        tamanho = self.arraysize if size is None else size
+        inicio = time.perf_counter()
+        linhas = super().fetchmany(tamanho)
+        self._lidas(inicio, len(linhas), len(linhas) < tamanho)
+        return linhas
+
+    def fetchall(self):
+        inicio = time.perf_counter()
+        linhas = super().fetchall()
+        self._lidas(inicio, len(linhas), True)
+        return linhas
+
+    def __next__(self):
+        inicio = time.perf_counter()
+        try:
+            linha = super().__next__()
+        except StopIteration:
+            self._lidas(inicio, 0, True)
+            raise
+        self._lidas(inicio, 1, False)
+        return linha
+
+    def close(self):
+        self._concluir()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._concluir()
+        except Exception:
+            pass  # conexão já fechada ou interpretador encerrando
+
+
+class ConexaoInstrumentada(sqlite3.Connection):
+
+    def cursor(self, factory=CursorInstrumentado):
+        return super().cursor(factory)
+
+    # Os atalhos da conexão não passam por cursor() sozinhos
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self.cursor().executemany(sql, parametros)
+
+
+# -----------------------------------------------------------
+# Conversão epoch UTC → texto no horário local (formato das
+# colunas TEXT antigas: "AAAA-MM-DD HH:MM:SS")
+# -----------------------------------------------------------
+def _epoch_para_local(epoch):
+    fuso = timezone(timedelta(hours=app.config['FUSO_HORARIO_HORAS']))
+    return datetime.fromtimestamp(epoch, fuso).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _colunas(conn, tabela):
+    return {c[1] for c in conn.execute(f'PRAGMA table_info({tabela})')}
+
+
+def _tabela_existe(conn, tabela):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tabela,)
+    ).fetchone() is not None
+
+
+# -----------------------------------------------------------
+# Migração 1: colunas epoch (UTC, INTEGER) de criação/atualização
+# e índices para os filtros usados pela aplicação.
+# As colunas TEXT antigas continuam sendo gravadas (compatibilidade);
+# o backfill converte o texto local para UTC.
+# -----------------------------------------------------------
+def _migracao_epoch(conn):
+    colunas = _colunas(conn, 'pedido')
+    deslocamento = -app.config['FUSO_HORARIO_HORAS'] * 3600
+
+    for coluna, origem in (('criacao_epoch', 'criacao'), ('atualizacao_epoch', 'atualizacao')):
+        if coluna not in colunas:
+            conn.execute(f'ALTER TABLE pedido ADD COLUMN {coluna} INTEGER')
+        conn.execute(
+            f"UPDATE pedido SET {coluna} = CAST(strftime('%s', {origem}) AS INTEGER) + ? "
+            f'WHERE {coluna} IS NULL AND {origem} IS NOT NULL',
+            (deslocamento,)
+        )
+
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pedido_criacao_epoch ON pedido(criacao_epoch)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pedido_atualizacao_epoch ON pedido(atualizacao_epoch)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pedido_ativo_criacao ON pedido(ativo, criacao_epoch)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pedido_produto_criacao ON pedido(nome_produto, criacao_epoch)')
+
+
+# Preços iniciais dos produtos (antes ficavam fixos no Historico.js)
+PRECOS_INICIAIS = {
+    'Aluguel Médio': 50,
+    'Aluguel Pequeno': 40,
+    'Reposição': 25,
+    'Funcionário': 20,
+    'Da casa': 0,
+}
+
+
+# -----------------------------------------------------------
+# Dia local (AAAA-MM-DD) de uma coluna epoch, em SQL.
+# Usado nos triggers do resumo diário; o fuso fica fixo no
+# trigger no momento da migração.
+# -----------------------------------------------------------
+def _sql_dia_local(coluna):
+    return f"date({coluna}, 'unixepoch', '{app.config['FUSO_HORARIO_HORAS']:+d} hours')"
+
+
+# -----------------------------------------------------------
+# Migração 2: preço em "produto" e tabela resumo_diario
+# (quantidade de pedidos por dia e produto), mantida por triggers
+# em "pedido". Um resumo custa O(dias), não O(pedidos).
+# -----------------------------------------------------------
+def _migracao_resumo(conn):
+    if 'preco' not in _colunas(conn, 'produto'):
+        conn.execute('ALTER TABLE produto ADD COLUMN preco REAL DEFAULT 0')
+        conn.executemany(
+            'UPDATE produto SET preco = ? WHERE nome = ?',
+            [(preco, nome) for nome, preco in PRECOS_INICIAIS.items()]
+        )
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS resumo_diario (
+            dia TEXT NOT NULL,
+            produto TEXT NOT NULL,
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, produto)
+        ) WITHOUT ROWID
+    """)
+
+    dia_new = _sql_dia_local('NEW.criacao_epoch')
+    dia_old = _sql_dia_local('OLD.criacao_epoch')
+    soma_new = f"""
+        INSERT INTO resumo_diario (dia, produto, quantidade)
+        SELECT {dia_new}, COALESCE(NEW.nome_produto, ''), 1
+        WHERE NEW.criacao_epoch IS NOT NULL
+        ON CONFLICT (dia, produto) DO UPDATE SET quantidade = quantidade + 1;
+    """
+    subtrai_old = f"""
+        UPDATE resumo_diario SET quantidade = quantidade - 1
+        WHERE OLD.criacao_epoch IS NOT NULL
+          AND dia = {dia_old} AND produto = COALESCE(OLD.nome_produto, '');
+    """
+
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS resumo_pedido_insert AFTER INSERT ON pedido BEGIN {soma_new} END')
+    conn.execute(f'CREATE TRIGGER IF NOT EXISTS resumo_pedido_delete AFTER DELETE ON pedido BEGIN {subtrai_old} END')
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS resumo_pedido_update
+        AFTER UPDATE OF nome_produto, criacao_epoch ON pedido
+        WHEN OLD.nome_produto IS NOT NEW.nome_produto OR OLD.criacao_epoch IS NOT NEW.criacao_epoch
+        BEGIN {subtrai_old} {soma_new} END
+    """)
+
+    # Backfill com o histórico existente
+    conn.execute('DELETE FROM resumo_diario')
+    conn.execute(f"""
+        INSERT INTO resumo_diario (dia, produto, quantidade)
+        SELECT {_sql_dia_local('criacao_epoch')}, COALESCE(nome_produto, ''), COUNT(*)
+        FROM pedido
+        WHERE criacao_epoch IS NOT NULL
+        GROUP BY 1, 2
+    """)
+
+
+# -----------------------------------------------------------
+# Migração 3: contador de versão por assunto (versao_tabela),
+# incrementado por triggers. "catalogo" muda sempre que
+# produto/rosh mudam e invalida o cache do catálogo.
+# -----------------------------------------------------------
+def _migracao_versao_catalogo(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS versao_tabela (
+            nome TEXT PRIMARY KEY,
+            versao INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO versao_tabela (nome, versao) VALUES ('catalogo', 0)")
+
+    for tabela in ('produto', 'rosh'):
+        for evento in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS versao_{tabela}_{evento.lower()}
+                AFTER {evento} ON {tabela}
+                BEGIN
+                    UPDATE versao_tabela SET versao = versao + 1 WHERE nome = 'catalogo';
+                END
+            """)
+
+
+# -----------------------------------------------------------
+# Migração 4: versão "pedido" em versao_tabela, incrementada a
+# cada insert/update/delete em pedido. Serve de marcador barato
+# de mudança para as ETags das listagens.
+# -----------------------------------------------------------
+def _migracao_versao_pedido(conn):
+    conn.execute("INSERT OR IGNORE INTO versao_tabela (nome, versao) VALUES ('pedido', 0)")
+    for evento in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS versao_pedido_{evento.lower()}
+            AFTER {evento} ON pedido
+            BEGIN
+                UPDATE versao_tabela SET versao = versao + 1 WHERE nome = 'pedido';
+            END
+        """)
+
+
+# -----------------------------------------------------------
+# Migração 5: feed de alterações.
+# Cada insert/update/delete em pedido recebe um número de versão
+# crescente (o contador "pedido" de versao_tabela): as linhas
+# guardam a versão da última alteração em pedido.versao e as
+# exclusões viram tombstones em pedido_excluido.
+# -----------------------------------------------------------
+def _migracao_feed_alteracoes(conn):
+    if 'versao' not in _colunas(conn, 'pedido'):
+        conn.execute('ALTER TABLE pedido ADD COLUMN versao INTEGER')
+    conn.execute("""
+        UPDATE pedido SET versao = (SELECT versao FROM versao_tabela WHERE nome = 'pedido')
+        WHERE versao IS NULL
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pedido_versao ON pedido(versao)')
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pedido_excluido (
+            pedidoid INTEGER PRIMARY KEY,
+            versao INTEGER NOT NULL
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pedido_excluido_versao ON pedido_excluido(versao)')
+
+    # Substitui os triggers da migração 4 pelos que também carimbam a versão
+    for evento in ('insert', 'update', 'delete'):
+        conn.execute(f'DROP TRIGGER IF EXISTS versao_pedido_{evento}')
+
+    incrementa = "UPDATE versao_tabela SET versao = versao + 1 WHERE nome = 'pedido';"
+    atual = "(SELECT versao FROM versao_tabela WHERE nome = 'pedido')"
+    conn.execute(f"""
+        CREATE TRIGGER versao_pedido_insert AFTER INSERT ON pedido
+        BEGIN
+            {incrementa}
+            UPDATE pedido SET versao = {atual} WHERE pedidoid = NEW.pedidoid;
+        END
+    """)
+    # O WHEN evita que o próprio carimbo (que muda "versao") dispare de novo
+    conn.execute(f"""
+        CREATE TRIGGER versao_pedido_update AFTER UPDATE ON pedido
+        WHEN NEW.versao IS OLD.versao
+        BEGIN
+            {incrementa}
+            UPDATE pedido SET versao = {atual} WHERE pedidoid = NEW.pedidoid;
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER versao_pedido_delete AFTER DELETE ON pedido
+        BEGIN
+            {incrementa}
+            INSERT OR REPLACE INTO pedido_excluido (pedidoid, versao) VALUES (OLD.pedidoid, {atual});
+        END
+    """)
+
+
+# -----------------------------------------------------------
+# Migração 6: índice de busca textual (FTS5) sobre os pedidos.
+# Tabela própria (rowid = pedidoid), sincronizada por triggers
+# e preenchida com o histórico existente.
+# -----------------------------------------------------------
+COLUNAS_BUSCA = ('name', 'rg', 'essencia', 'observacao', 'nome_produto', 'nome_rosh')
+
+
+def _migracao_busca(conn):
+    colunas = ', '.join(COLUNAS_BUSCA)
+    novos = ', '.join(f'NEW.{c}' for c in COLUNAS_BUSCA)
+
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS pedido_fts
+        USING fts5({colunas}, tokenize = 'unicode61 remove_diacritics 2')
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS busca_pedido_insert AFTER INSERT ON pedido
+        BEGIN
+            INSERT INTO pedido_fts (rowid, {colunas}) VALUES (NEW.pedidoid, {novos});
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS busca_pedido_delete AFTER DELETE ON pedido
+        BEGIN
+            DELETE FROM pedido_fts WHERE rowid = OLD.pedidoid;
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS busca_pedido_update AFTER UPDATE OF {colunas} ON pedido
+        BEGIN
+            DELETE FROM pedido_fts WHERE rowid = OLD.pedidoid;
+            INSERT INTO pedido_fts (rowid, {colunas}) VALUES (NEW.pedidoid, {novos});
+        END
+    """)
+
+    conn.execute('DELETE FROM pedido_fts')
+    conn.execute(f'INSERT INTO pedido_fts (rowid, {colunas}) SELECT pedidoid, {colunas} FROM pedido')
+
+
+# -----------------------------------------------------------
+# Migração 7: tabela controle_interno (flags e marcas de tempo
+# internas) e a flag "arquivando". Enquanto ela vale 1, apagar um
+# pedido significa movê-lo para o arquivo: os triggers de delete
+# não mexem no resumo, não geram tombstone e mantêm o pedido na
+# busca textual.
+# -----------------------------------------------------------
+def _migracao_arquivo(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS controle_interno (
+            chave TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.executemany(
+        'INSERT OR IGNORE INTO controle_interno (chave, valor) VALUES (?, 0)',
+        [('arquivando',), ('ultimo_arquivamento',)]
+    )
+
+    for trigger in ('resumo_pedido_delete', 'versao_pedido_delete', 'busca_pedido_delete'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+
+    nao_arquivando = "(SELECT valor FROM controle_interno WHERE chave = 'arquivando') = 0"
+    atual = "(SELECT versao FROM versao_tabela WHERE nome = 'pedido')"
+    conn.execute(f"""
+        CREATE TRIGGER resumo_pedido_delete AFTER DELETE ON pedido
+        WHEN {nao_arquivando}
+        BEGIN
+            UPDATE resumo_diario SET quantidade = quantidade - 1
+            WHERE OLD.criacao_epoch IS NOT NULL
+              AND dia = {_sql_dia_local('OLD.criacao_epoch')} AND produto = COALESCE(OLD.nome_produto, '');
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER versao_pedido_delete AFTER DELETE ON pedido
+        WHEN {nao_arquivando}
+        BEGIN
+            UPDATE versao_tabela SET versao = versao + 1 WHERE nome = 'pedido';
+            INSERT OR REPLACE INTO pedido_excluido (pedidoid, versao) VALUES (OLD.pedidoid, {atual});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER busca_pedido_delete AFTER DELETE ON pedido
+        WHEN {nao_arquivando}
+        BEGIN
+            DELETE FROM pedido_fts WHERE rowid = OLD.pedidoid;
+        END
+    """)
+
+
+# -----------------------------------------------------------
+# Migração 8: produto e rosh do pedido como ids (FK), como já
+# declarado no sqlite_db_setup.py, em vez do nome repetido em
+# cada linha. Nomes dos pedidos que não estão no catálogo são
+# cadastrados antes da conversão (nenhum pedido perde o produto).
+# O resumo diário passa a agrupar por id, e a busca textual
+# continua indexando os nomes (buscados pelos triggers).
+# -----------------------------------------------------------
+COLUNAS_CATALOGO = (
+    ('nome_produto', 'produto', 'produtoid'),
+    ('nome_rosh', 'rosh', 'roshid'),
+)
+
+
+# Troca os nomes por ids nas linhas de <esquema>.pedido que ainda
+# guardam texto (também usada no banco de arquivo)
+def _converter_nomes_em_ids(conn, esquema='main'):
+    for coluna, tabela, chave in COLUNAS_CATALOGO:
+        conn.execute(f"UPDATE {esquema}.pedido SET {coluna} = NULL WHERE {coluna} = ''")
+        conn.execute(f"""
+            INSERT INTO main.{tabela} (nome)
+            SELECT DISTINCT {coluna} FROM {esquema}.pedido
+            WHERE typeof({coluna}) = 'text'
+              AND {coluna} NOT IN (SELECT nome FROM main.{tabela} WHERE nome IS NOT NULL)
+        """)
+        conn.execute(f"""
+            UPDATE {esquema}.pedido
+            SET {coluna} = (SELECT MIN(c.{chave}) FROM main.{tabela} c WHERE c.nome = {esquema}.pedido.{coluna})
+            WHERE typeof({coluna}) = 'text'
+        """)
+
+
+def _migracao_ids_catalogo(conn):
+    # Os triggers antigos recalculariam resumo e busca com os ids;
+    # o de versão marcaria todos os pedidos como alterados no feed
+    # (os dados vistos pelos clientes não mudam). Ficam fora durante
+    # a conversão; o de versão volta igual, os outros são refeitos.
+    versao_update = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'versao_pedido_update'"
+    ).fetchone()
+    for trigger in ('versao_pedido_update', 'resumo_pedido_insert', 'resumo_pedido_update',
+                    'resumo_pedido_delete', 'busca_pedido_insert', 'busca_pedido_update'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+
+    _converter_nomes_em_ids(conn)
+
+    if versao_update:
+        conn.execute(versao_update[0])
+
+    # Resumo diário por id de produto (0 = pedido sem produto)
+    conn.execute('DROP TABLE IF EXISTS resumo_diario')
+    conn.execute("""
+        CREATE TABLE resumo_diario (
+            dia TEXT NOT NULL,
+            produto INTEGER NOT NULL,
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, produto)
+        ) WITHOUT ROWID
+    """)
+
+    soma_new = f"""
+        INSERT INTO resumo_diario (dia, produto, quantidade)
+        SELECT {_sql_dia_local('NEW.criacao_epoch')}, COALESCE(NEW.nome_produto, 0), 1
+        WHERE NEW.criacao_epoch IS NOT NULL
+        ON CONFLICT (dia, produto) DO UPDATE SET quantidade = quantidade + 1;
+    """
+    subtrai_old = f"""
+        UPDATE resumo_diario SET quantidade = quantidade - 1
+        WHERE OLD.criacao_epoch IS NOT NULL
+          AND dia = {_sql_dia_local('OLD.criacao_epoch')} AND produto = COALESCE(OLD.nome_produto, 0);
+    """
+    nao_arquivando = "(SELECT valor FROM controle_interno WHERE chave = 'arquivando') = 0"
+    conn.execute(f'CREATE TRIGGER resumo_pedido_insert AFTER INSERT ON pedido BEGIN {soma_new} END')
+    conn.execute(f"""
+        CREATE TRIGGER resumo_pedido_delete AFTER DELETE ON pedido
+        WHEN {nao_arquivando}
+        BEGIN {subtrai_old} END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER resumo_pedido_update
+        AFTER UPDATE OF nome_produto, criacao_epoch ON pedido
+        WHEN OLD.nome_produto IS NOT NEW.nome_produto OR OLD.criacao_epoch IS NOT NEW.criacao_epoch
+        BEGIN {subtrai_old} {soma_new} END
+    """)
+    conn.execute(f"""
+        INSERT INTO resumo_diario (dia, produto, quantidade)
+        SELECT {_sql_dia_local('criacao_epoch')}, COALESCE(nome_produto, 0), COUNT(*)
+        FROM pedido
+        WHERE criacao_epoch IS NOT NULL
+        GROUP BY 1, 2
+    """)
+
+    # Busca textual: o índice guarda os nomes, lidos do catálogo.
+    # O conteúdo atual (já com nomes, incluindo os arquivados) fica.
+    colunas = ', '.join(COLUNAS_BUSCA)
+    nomes = {
+        coluna: f'(SELECT nome FROM {tabela} WHERE {chave} = NEW.{coluna})'
+        for coluna, tabela, chave in COLUNAS_CATALOGO
+    }
+    novos = ', '.join(nomes.get(c, f'NEW.{c}') for c in COLUNAS_BUSCA)
+    conn.execute(f"""
+        CREATE TRIGGER busca_pedido_insert AFTER INSERT ON pedido
+        BEGIN
+            INSERT INTO pedido_fts (rowid, {colunas}) VALUES (NEW.pedidoid, {novos});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER busca_pedido_update AFTER UPDATE OF {colunas} ON pedido
+        BEGIN
+            DELETE FROM pedido_fts WHERE rowid = OLD.pedidoid;
+            INSERT INTO pedido_fts (rowid, {colunas}) VALUES (NEW.pedidoid, {novos});
+        END
+    """)
+
+
+# -----------------------------------------------------------
+# Migração 9: tabela das tarefas em segundo plano (/api/jobs).
+# Guarda o estado para qualquer worker responder ao polling e
+# para recuperar as tarefas de um worker que morreu.
+# -----------------------------------------------------------
+def _migracao_tarefas(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tarefa (
+            tarefaid INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            parametros TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pendente',
+            progresso REAL NOT NULL DEFAULT 0,
+            mensagem TEXT,
+            resultado TEXT,
+            cancelar INTEGER NOT NULL DEFAULT 0,
+            tentativas INTEGER NOT NULL DEFAULT 0,
+            usuario TEXT,
+            criacao_epoch INTEGER NOT NULL,
+            inicio_epoch INTEGER,
+            fim_epoch INTEGER,
+            batimento_epoch INTEGER
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tarefa_status ON tarefa(status)')
+
+
+# Migrações em ordem; a posição (1, 2, ...) é gravada em PRAGMA user_version
+MIGRACOES = [
+    _migracao_epoch,
+    _migracao_resumo,
+    _migracao_versao_catalogo,
+    _migracao_versao_pedido,
+    _migracao_feed_alteracoes,
+    _migracao_busca,
+    _migracao_arquivo,
+    _migracao_ids_catalogo,
+    _migracao_tarefas,
+]
+
+
+# -----------------------------------------------------------
+# Aplica as migrações pendentes (idempotente).
+# Roda uma vez por processo, na criação do pool. BEGIN IMMEDIATE
+# garante que só um worker migre por vez; os outros esperam e
+# relêem a versão.
+# -----------------------------------------------------------
+def migrar_esquema(conn):
+    if not _tabela_existe(conn, 'pedido'):
+        return  # banco ainda não criado pelo sqlite_db_setup.py
+
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRACOES):
+        return
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        versao = conn.execute('PRAGMA user_version').fetchone()[0]
+        for numero, migracao in enumerate(MIGRACOES[versao:], start=versao + 1):
+            migracao(conn)
+            conn.execute(f'PRAGMA user_version = {numero}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# -----------------------------------------------------------
+# Pool de conexões de um arquivo de banco
+# Guarda conexões ociosas (LIFO) para reaproveitar entre requisições,
+# evitando o custo de abrir/parsear o schema a cada chamada
+# -----------------------------------------------------------
+class PoolConexoes:
+
+    def __init__(self, caminho, tamanho):
+        self.caminho = caminho
+        self.tamanho = tamanho
+        self._livres = []
+        self._lock = threading.Lock()
+
+    def obter(self):
+        with self._lock:
+            if self._livres:
+                return self._livres.pop()
+        return _abrir_conexao(self.caminho)
+
+    def devolver(self, conn):
+        # Nunca devolve ao pool uma conexão com transação pendurada
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._livres) < self.tamanho:
+                self._livres.append(conn)
+                return
+        conn.close()
+
+    def fechar(self):
+        with self._lock:
+            livres, self._livres = self._livres, []
+        for conn in livres:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _obter_pool():
+    with _pools_lock:
+        pool = _pools.get(DB_PATH)
+        if pool is None:
+            # Trocou o banco (ex.: testes) → fecha os pools antigos
+            for antigo in _pools.values():
+                antigo.fechar()
+            _pools.clear()
+            pool = PoolConexoes(DB_PATH, app.config['SQLITE_POOL_TAMANHO'])
+            conn = pool.obter()
+            try:
+                migrar_esquema(conn)
+            finally:
+                pool.devolver(conn)
+            _pools[DB_PATH] = pool
+        return pool
+
+
+# -----------------------------------------------------------
+# Descarta os pools herdados após um fork: conexões SQLite
+# não podem ser compartilhadas entre processos, então cada
+# worker abre as suas
+# -----------------------------------------------------------
+def reiniciar_conexoes_pos_fork():
+    global _escritor
+    with _pools_lock:
+        _pools.clear()
+        _escritor = None  # a thread do escritor não existe no processo filho
+    metricas.limpar()  # números do processo pai (migrações) não são deste worker
+    consultas_lentas.limpar()
+    _reiniciar_executor_tarefas()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reiniciar_conexoes_pos_fork)
+
+
+# -----------------------------------------------------------
+# Fecha todas as conexões ociosas (encerramento/testes)
+# -----------------------------------------------------------
+def fechar_conexoes():
+    global _escritor
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.fechar()
+        _pools.clear()
+        escritor, _escritor = _escritor, None
+    if escritor is not None:
+        escritor.parar()
+
+
+# -----------------------------------------------------------
+# Conexão com o banco SQLite
+# Dentro de uma requisição, pega uma conexão do pool e a reaproveita
+# até o fim do app context (devolvida em _devolver_conexao).
+# Fora do app context (scripts), abre uma conexão avulsa que o
+# chamador deve fechar.
+# -----------------------------------------------------------
+def db_connection():
+    if not has_app_context():
+        return _abrir_conexao(DB_PATH)
+
+    conn = g.get('_conexao_db')
+    if conn is None:
+        pool = _obter_pool()
+        conn = pool.obter()
+        g._conexao_db = conn
+        g._pool_db = pool
+    return conn
+
+
+@app.teardown_appcontext
+def _devolver_conexao(exc):
+    conn = g.pop('_conexao_db', None)
+    if conn is not None:
+        g.pop('_pool_db').devolver(conn)
+
+
+# -----------------------------------------------------------
+# Escritor único (opcional): serializa as escritas do processo
+# numa thread dedicada, com fila limitada e "group commit".
+# As escritas que chegam juntas (dentro de ESCRITOR_JANELA_MS)
+# vão numa só transação: um lock de escrita e um commit para
+# várias requisições. Cada escrita roda num SAVEPOINT próprio,
+# então o erro de uma não desfaz as outras.
+# -----------------------------------------------------------
+app.config['SQLITE_ESCRITOR_UNICO'] = False
+app.config['ESCRITOR_FILA_MAXIMA'] = 1000      # escritas aguardando
+app.config['ESCRITOR_ESPERA_FILA_S'] = 2       # espera por vaga na fila antes do 503
+app.config['ESCRITOR_JANELA_MS'] = 2           # tempo para juntar escritas num commit
+app.config['ESCRITOR_LOTE_MAXIMO'] = 200       # escritas por transação
+app.config['ESCRITOR_TIMEOUT_S'] = 30          # espera máxima pelo resultado
+
+
+class FilaEscritaCheia(Exception):
+    pass
+
+
+# A escrita não respondeu em ESCRITOR_TIMEOUT_S. Se ainda estava na
+# fila, foi cancelada (não será gravada); se a thread escritora já
+# tinha começado, ainda pode ser gravada depois da resposta.
+class EscritaSemResposta(Exception):
+
+    def __init__(self, talvez_gravada):
+        super().__init__()
+        self.talvez_gravada = talvez_gravada
+
+
+class EscritorUnico:
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.fila = queue.Queue(maxsize=app.config['ESCRITOR_FILA_MAXIMA'])
+        self.transacoes = 0
+        self.escritas = 0
+        self._thread = threading.Thread(target=self._rodar, name='escritor-sqlite', daemon=True)
+        self._thread.start()
+
+    # Enfileira "funcao(conn)" e espera o resultado (ou a exceção)
+    def executar(self, funcao):
+        futuro = Future()
+        try:
+            self.fila.put((funcao, futuro), timeout=app.config['ESCRITOR_ESPERA_FILA_S'])
+        except queue.Full:
+            raise FilaEscritaCheia()
+        try:
+            return futuro.result(timeout=app.config['ESCRITOR_TIMEOUT_S'])
+        except FuturoExpirado:
+            # cancel() só funciona enquanto o escritor não pegou a escrita
+            raise EscritaSemResposta(talvez_gravada=not futuro.cancel())
+
+    def parar(self):
+        self.fila.put(None)
+        self._thread.join(timeout=5)
+
+    def _rodar(self):
+        conn = _abrir_conexao(self.caminho)
+        try:
+            while True:
+                item = self.fila.get()
+                if item is None:
+                    return
+                lote = [item]
+
+                # Junta o que chegar durante a janela de group commit
+                limite = time.monotonic() + app.config['ESCRITOR_JANELA_MS'] / 1000
+                while len(lote) < app.config['ESCRITOR_LOTE_MAXIMO']:
+                    restante = limite - time.monotonic()
+                    try:
+                        item = self.fila.get(timeout=max(restante, 0)) if restante > 0 else self.fila.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self.fila.put(None)  # processa o lote e para em seguida
+                        break
+                    lote.append(item)
+
+                self._gravar(conn, lote)
+        finally:
+            conn.close()
+
+    def _gravar(self, conn, lote):
+        # Marca como iniciadas (não dá mais para cancelar) e descarta
+        # as que quem enviou já desistiu de esperar
+        lote = [(funcao, futuro) for funcao, futuro in lote if futuro.set_running_or_notify_cancel()]
+        if not lote:
+            return
+
+        resultados = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for funcao, futuro in lote:
+                conn.execute('SAVEPOINT escrita')
+                try:
+                    resultados.append((futuro, funcao(conn), None))
+                    conn.execute('RELEASE escrita')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO escrita')
+                    conn.execute('RELEASE escrita')
+                    resultados.append((futuro, None, e))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, futuro in lote:
+                futuro.set_exception(e)
+            return
+
+        self.transacoes += 1
+        self.escritas += len(lote)
+        # Só responde depois do commit: resultado entregue = gravado
+        for futuro, resultado, erro in resultados:
+            if erro is not None:
+                futuro.set_exception(erro)
+            else:
+                futuro.set_result(resultado)
+
+
+_escritor = None
+
+
+def _obter_escritor():
+    global _escritor
+    _obter_pool()  # garante o schema migrado antes de escrever
+    with _pools_lock:
+        escritor = _escritor
+        if escritor is not None and escritor.caminho == DB_PATH:
+            return escritor
+        _escritor = EscritorUnico(DB_PATH)
+    if escritor is not None:
+        escritor.parar()
+    return _escritor
+
+
+# -----------------------------------------------------------
+# Executa uma escrita "funcao(conn)" numa transação e retorna o
+# resultado. Com SQLITE_ESCRITOR_UNICO, passa pela fila do
+# escritor; senão usa a conexão da requisição com BEGIN IMMEDIATE
+# (pega o lock de escrita logo no início, sem upgrade no meio).
+# -----------------------------------------------------------
+def _escrever(funcao):
+    if app.config['SQLITE_ESCRITOR_UNICO']:
+        return _obter_escritor().executar(funcao)
+
+    conn = db_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        resultado = funcao(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return resultado
+
+
+@app.errorhandler(FilaEscritaCheia)
+def _fila_escrita_cheia(exc):
+    resposta = jsonify({'error': 'Servidor ocupado, tente novamente'})
+    resposta.status_code = 503
+    resposta.headers['Retry-After'] = '1'
+    return resposta
+
+
+# Sem resposta do escritor: 503 como a fila cheia, mas avisando se
+# a escrita ainda pode ter sido gravada (repetir um POST às cegas
+# criaria o pedido em dobro; o cliente deve conferir antes)
+@app.errorhandler(EscritaSemResposta)
+def _escrita_sem_resposta(exc):
+    if exc.talvez_gravada:
+        mensagem = 'Servidor ocupado: a alteração pode ter sido gravada, confira antes de repetir'
+    else:
+        mensagem = 'Servidor ocupado: a alteração não foi gravada, tente novamente'
+    resposta = jsonify({'error': mensagem, 'talvez_gravada': exc.talvez_gravada})
+    resposta.status_code = 503
+    resposta.headers['Retry-After'] = '1'
+    return resposta
+
+
+# Compressão gzip das respostas (negociada pelo Accept-Encoding)
+app.config['GZIP_NIVEL'] = 6               # 1 = mais rápido ... 9 = menor
+app.config['GZIP_MINIMO_BYTES'] = 1024     # abaixo disso não compensa comprimir
+app.config['GZIP_TIPOS'] = {
+    'application/json', 'application/x-ndjson', 'text/csv', 'text/html', 'text/plain',
+}
+
+
+# -----------------------------------------------------------
+# Comprime um corpo em streaming parte a parte. O Z_SYNC_FLUSH
+# após cada parte faz o cliente receber (e poder descomprimir)
+# cada lote assim que ele sai do cursor, sem esperar o fim.
+# -----------------------------------------------------------
+def _gzip_em_partes(partes, original, nivel):
+    compressor = zlib.compressobj(nivel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # formato gzip
+    try:
+        for parte in partes:
+            if parte:
+                yield compressor.compress(parte) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        # Fecha o gerador original (devolve a conexão do streaming)
+        if hasattr(original, 'close'):
+            original.close()
+
+
+# -----------------------------------------------------------
+# Comprime as respostas de texto/JSON quando o cliente aceita gzip.
+# Fica de fora: SSE (text/event-stream), arquivos enviados com
+# send_file (direct_passthrough) e respostas já codificadas.
+# A ETag vira fraca (W/"..."), pois o corpo comprimido não é
+# idêntico byte a byte; If-None-Match compara de forma fraca e o
+# 304 continua funcionando.
+# -----------------------------------------------------------
+@app.after_request
+def _comprimir(resposta):
+    if resposta.status_code == 304:
+        if request.accept_encodings['gzip']:
+            _etag_fraca(resposta)
+        return resposta
+
+    if (
+        resposta.status_code != 200
+        or resposta.direct_passthrough
+        or 'Content-Encoding' in resposta.headers
+        or resposta.mimetype not in app.config['GZIP_TIPOS']
+    ):
+        return resposta
+
+    resposta.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return resposta
+
+    nivel = app.config['GZIP_NIVEL']
+    if resposta.is_streamed:
+        original = resposta.response
+        resposta.response = _gzip_em_partes(resposta.iter_encoded(), original, nivel)
+        resposta.headers.pop('Content-Length', None)
+    else:
+        dados = resposta.get_data()
+        if len(dados) < app.config['GZIP_MINIMO_BYTES']:
+            return resposta
+        resposta.set_data(_comprimir_gzip(dados, nivel))
+
+    resposta.headers['Content-Encoding'] = 'gzip'
+    _etag_fraca(resposta)
+    return resposta
+
+
+def _comprimir_gzip(dados, nivel):
+    compressor = zlib.compressobj(nivel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(dados) + compressor.flush()
+
+
+def _etag_fraca(resposta):
+    etag, fraca = resposta.get_etag()
+    if etag and not fraca:
+        resposta.set_etag(etag, weak=True)
+
+
+# Arquivos estáticos com impressão digital (static/*.js → /assets/)
+app.config['ESTATICOS_DIR'] = None              # None → static/dist
+app.config['ESTATICOS_GZIP_NIVEL'] = 9          # comprimidos uma vez só, na preparação
+app.config['ESTATICOS_MAX_AGE_S'] = 365 * 86400
+
+_manifesto_estaticos = {}   # "index.js" → "index.<hash>.js"
+_manifesto_lock = threading.Lock()  # preparação sob demanda, em estatico()
+
+
+def _pasta_estaticos():
+    return app.config['ESTATICOS_DIR'] or os.path.join(app.static_folder, 'dist')
+
+
+# Temporário com nome único (threads e processos preparando ao
+# mesmo tempo não disputam o mesmo arquivo) e troca atômica
+def _gravar_se_faltar(caminho, dados):
+    if not os.path.exists(caminho):
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(caminho), suffix='.tmp', delete=False) as saida:
+            saida.write(dados)
+        os.replace(saida.name, caminho)
+
+
+# -----------------------------------------------------------
+# Copia cada arquivo de static/ para static/dist com o hash do
+# conteúdo no nome (index.3f2a1b9c0d4e.js), mais a versão .gz
+# já comprimida. Como o nome muda a cada alteração, o navegador
+# pode guardar o arquivo para sempre (Cache-Control: immutable)
+# e nem revalida ao recarregar a página. Versões antigas ficam
+# na pasta: páginas já abertas nas estações continuam achando.
+# Roda no serve.py antes do fork e, em desenvolvimento, na
+# primeira página renderizada.
+# -----------------------------------------------------------
+def preparar_estaticos():
+    global _manifesto_estaticos
+    pasta = _pasta_estaticos()
+    os.makedirs(pasta, exist_ok=True)
+    geradas = {pasta, os.path.join(app.static_folder, 'dist')}
+    manifesto = {}
+    for raiz, diretorios, arquivos in os.walk(app.static_folder):
+        diretorios[:] = [d for d in diretorios if os.path.join(raiz, d) not in geradas]
+        for arquivo in arquivos:
+            caminho = os.path.join(raiz, arquivo)
+            nome = os.path.relpath(caminho, app.static_folder).replace(os.sep, '/')
+            with open(caminho, 'rb') as entrada:
+                dados = entrada.read()
+
+            base, extensao = os.path.splitext(nome.replace('/', '_'))
+            impresso = f'{base}.{hashlib.sha256(dados).hexdigest()[:12]}{extensao}'
+            _gravar_se_faltar(os.path.join(pasta, impresso), dados)
+            _gravar_se_faltar(
+                os.path.join(pasta, impresso + '.gz'),
+                _comprimir_gzip(dados, app.config['ESTATICOS_GZIP_NIVEL'])
+            )
+            manifesto[nome] = impresso
+
+    _manifesto_estaticos = manifesto  # troca inteira: quem lê nunca vê o dicionário pela metade
+    return manifesto
+
+
+# -----------------------------------------------------------
+# Helper dos templates: {{ estatico('index.js') }} → URL com a
+# impressão digital. Em modo debug refaz o manifesto a cada uso,
+# para a edição do .js aparecer sem reiniciar o servidor.
+# -----------------------------------------------------------
+@app.template_global()
+def estatico(nome):
+    if app.debug or not _manifesto_estaticos:
+        with _manifesto_lock:  # primeiras páginas em paralelo: uma thread prepara
+            if app.debug or not _manifesto_estaticos:
+                preparar_estaticos()
+    impresso = _manifesto_estaticos.get(nome)
+    if impresso is None:
+        return url_for('static', filename=nome)
+    return url_for('servir_estatico', arquivo=impresso)
+
+
+# -----------------------------------------------------------
+# Serve os arquivos de static/dist: a versão .gz pronta quando o
+# cliente aceita gzip (nada é comprimido por requisição), com
+# cache longo e imutável. O _comprimir acima não mexe (resposta
+# já com Content-Encoding / direct_passthrough).
+# -----------------------------------------------------------
+@app.route('/assets/<arquivo>')
+def servir_estatico(arquivo):
+    caminho = os.path.join(_pasta_estaticos(), arquivo)
+    if (
+        arquivo.startswith('.') or os.path.basename(arquivo) != arquivo
+        or arquivo.endswith('.gz') or not os.path.isfile(caminho)
+    ):
+        return jsonify({'error': 'Arquivo não encontrado'}), 404
+
+    comprimido = request.accept_encodings['gzip'] and os.path.isfile(caminho + '.gz')
+    resposta = send_file(
+        caminho + '.gz' if comprimido else caminho,
+        mimetype=mimetypes.guess_type(arquivo)[0] or 'application/octet-stream',
+        max_age=app.config['ESTATICOS_MAX_AGE_S'],
+    )
+    if comprimido:
+        resposta.headers['Content-Encoding'] = 'gzip'
+    resposta.vary.add('Accept-Encoding')
+    resposta.cache_control.public = True
+    resposta.cache_control.immutable = True
+    return resposta
+
+
+# -----------------------------------------------------------
+# Rota inicial "/"
+# Exige login — se não estiver logado, redireciona ao /login
+# Se logado, renderiza a página principal
+# -----------------------------------------------------------
+@app.route('/')
+def index():
+    if 'usuario' not in session:
+        return redirect(url_for('login'))
+    return render_template('index.html', admin=session.get('admin', False))
+
+
+# -----------------------------------------------------------
+# Rota alternativa "/index" (mesmo comportamento da "/")
+# -----------------------------------------------------------
+@app.route('/index')
+def index_page():
+    if 'usuario' not in session:
+        return redirect(url_for('login'))
+    return render_template('index.html', admin=session.get('admin', False))
+
+
+# -----------------------------------------------------------
+# Página de histórico completo de pedidos
+# Apenas ADMIN pode acessar
+# -----------------------------------------------------------
+@app.route('/historico')
+def historico():
+
+    # Se não estiver logado → volta ao login
+    if 'usuario' not in session:
+        return redirect(url_for('login'))
+
+    # Se não for admin → redireciona para a tela principal
+    if not session.get('admin'):
+        return redirect(url_for('index'))
+
+    # Admin pode acessar o histórico
+    return render_template('historico.html', admin=True)
+
+
+# -----------------------------------------------------------
+# Rota de logout
+# Limpa totalmente a sessão e manda para o login
+# -----------------------------------------------------------
+@app.route('/logout')
+def logout():
+    session.clear()
+    return redirect(url_for('login'))
+
+
+# Tempo que o navegador pode reusar o catálogo sem perguntar ao servidor
+app.config['CATALOGO_MAX_AGE'] = 300
+
+_cache_catalogo = {}
+_cache_catalogo_lock = threading.Lock()
+
+
+def _versao(conn, nome):
+    linha = conn.execute('SELECT versao FROM versao_tabela WHERE nome = ?', (nome,)).fetchone()
+    return linha[0] if linha else 0
+
+
+# -----------------------------------------------------------
+# Catálogo (produtos + roshs) em cache no processo.
+# A cada chamada só lê o contador de versão (uma busca por PK);
+# as tabelas só são consultadas de novo quando a versão muda.
+# -----------------------------------------------------------
+def _catalogo():
+    conn = db_connection()
+    versao = _versao(conn, 'catalogo')
+
+    with _cache_catalogo_lock:
+        if _cache_catalogo.get('chave') == (DB_PATH, versao):
+            return _cache_catalogo['dados']
+
+    produtos = conn.execute('SELECT produtoid, nome, preco FROM produto ORDER BY produtoid').fetchall()
+    roshs = conn.execute('SELECT roshid, nome FROM rosh ORDER BY roshid').fetchall()
+    dados = {
+        'versao': versao,
+        'produtos': [{'nome': p['nome'], 'preco': p['preco'] or 0} for p in produtos],
+        'roshs': [r['nome'] for r in roshs],
+    }
+    # ETag forte derivada do conteúdo (continua válida se o banco for recriado)
+    dados['etag'] = hashlib.sha1(app.json.dumps(dados).encode()).hexdigest()[:16]
+
+    # Tradução nome ↔ id usada na gravação e na leitura dos pedidos
+    # (no nome repetido, vale o primeiro id, como na migração)
+    dados['ids'] = {
+        'nome_produto': {p['nome']: p['produtoid'] for p in reversed(produtos)},
+        'nome_rosh': {r['nome']: r['roshid'] for r in reversed(roshs)},
+    }
+    dados['nomes'] = {
+        'nome_produto': {p['produtoid']: p['nome'] for p in produtos},
+        'nome_rosh': {r['roshid']: r['nome'] for r in roshs},
+    }
+    dados['precos'] = {p['produtoid']: p['preco'] or 0 for p in produtos}
+
+    with _cache_catalogo_lock:
+        _cache_catalogo['chave'] = (DB_PATH, versao)
+        _cache_catalogo['dados'] = dados
+    return dados
+
+
+# -----------------------------------------------------------
+# Resposta de catálogo com ETag + Cache-Control: o navegador
+# reusa a cópia local por CATALOGO_MAX_AGE segundos e depois
+# revalida com If-None-Match (304 sem corpo)
+# -----------------------------------------------------------
+def _resposta_catalogo(corpo, etag):
+    resposta = jsonify(corpo)
+    resposta.set_etag(etag)
+    resposta.cache_control.private = True
+    resposta.cache_control.max_age = app.config['CATALOGO_MAX_AGE']
+    return resposta.make_conditional(request)
+
+
+# -----------------------------------------------------------
+# API: catálogo completo (produtos com preço + roshs) em uma
+# única requisição
+# -----------------------------------------------------------
+@app.route('/api/catalogo')
+def catalogo():
+    dados = _catalogo()
+    corpo = {k: dados[k] for k in ('versao', 'produtos', 'roshs')}
+    return _resposta_catalogo(corpo, f"catalogo-{dados['etag']}")
+
+
+# -----------------------------------------------------------
+# API: retorna lista de produtos cadastrados
+# -----------------------------------------------------------
+@app.route('/api/produtos')
+def listar_produtos():
+    dados = _catalogo()
+    return _resposta_catalogo([p['nome'] for p in dados['produtos']], f"produtos-{dados['etag']}")
+
+
+# -----------------------------------------------------------
+# API: retorna lista de roshs cadastrados
+# -----------------------------------------------------------
+@app.route('/api/roshs')
+def listar_roshs():
+    dados = _catalogo()
+    return _resposta_catalogo(dados['roshs'], f"roshs-{dados['etag']}")
+
+
+# Paginação das listagens de pedidos
+app.config['PAGINA_LIMITE_MAXIMO'] = 500
+
+# Quantas linhas o modo streaming (NDJSON) lê do cursor por vez
+app.config['STREAM_LOTE'] = 500
+
+# Consulta base das listagens (alias "p" usado nos filtros)
+SQL_PEDIDOS = 'SELECT p.* FROM pedido p'
+
+# Janela da listagem principal (usa o índice em criacao_epoch)
+app.config['JANELA_RECENTES_DIAS'] = 60
+FILTRO_RECENTES = 'p.criacao_epoch >= ?'
+
+
+# O início da janela anda de hora em hora (e não a cada segundo),
+# assim a mesma versão do banco gera a mesma resposta durante a
+# hora e a ETag continua válida
+def _inicio_janela_recentes():
+    hora = int(time.time()) // 3600 * 3600
+    return hora - app.config['JANELA_RECENTES_DIAS'] * 86400
+
+
+# -----------------------------------------------------------
+# GET condicional das listagens de pedidos.
+# A ETag combina as versões "pedido" e "catalogo" (mantidas por
+# trigger; renomear um produto muda as linhas servidas) com a
+# URL, o formato pedido e, nas listagens da janela de recentes
+# (janela=True), a hora da janela. Se o cliente já tem essa
+# versão, responde 304 sem rodar a consulta nem serializar.
+# Os parâmetros são validados antes: um inválido é 400, nunca 304.
+# -----------------------------------------------------------
+def _etag_pedidos(conn, janela=True):
+    chave = '|'.join((
+        str(_versao(conn, 'pedido')),
+        str(_versao(conn, 'catalogo')),  # os pedidos saem com os nomes do catálogo
+        request.full_path,
+        str(_quer_stream()),
+        str(_inicio_janela_recentes()) if janela else '',
+    ))
+    return 'pedidos-' + hashlib.sha1(chave.encode()).hexdigest()[:16]
+
+
+def _nao_modificado(etag):
+    if request.if_none_match.contains_weak(etag):  # fraca: cobre a versão gzip
+        return _com_etag(Response(status=304), etag)
+    return None
+
+
+def _com_etag(resposta, etag):
+    resposta.set_etag(etag)
+    resposta.cache_control.no_cache = True  # sempre revalidar (If-None-Match)
+    return resposta
+
+
+# -----------------------------------------------------------
+# Lê os parâmetros de paginação por cursor (keyset) da query string:
+# - limit  → tamanho da página
+# - after  → pedidos mais antigos que este pedidoid (próxima página)
+# - before → pedidos mais novos que este pedidoid (página anterior)
+# - total  → se "1", inclui a contagem total do filtro
+# Retorna None quando não há "limit" (lista completa, formato antigo)
+# Lança ValueError com a mensagem de erro se algo for inválido
+# -----------------------------------------------------------
+def _parametros_pagina():
+    if 'limit' not in request.args:
+        return None
+
+    try:
+        limite = int(request.args['limit'])
+        depois = int(request.args['after']) if request.args.get('after') else None
+        antes = int(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        raise ValueError('Parâmetros de paginação inválidos')
+
+    if not 1 <= limite <= app.config['PAGINA_LIMITE_MAXIMO']:
+        raise ValueError(f"limit deve estar entre 1 e {app.config['PAGINA_LIMITE_MAXIMO']}")
+    if depois is not None and antes is not None:
+        raise ValueError('Use apenas um dos cursores: after ou before')
+
+    return {
+        'limite': limite,
+        'depois': depois,
+        'antes': antes,
+        'total': request.args.get('total') == '1',
+    }
+
+
+# -----------------------------------------------------------
+# Busca uma página de pedidos (do mais novo para o mais antigo)
+# usando seek em pedidoid em vez de OFFSET: o custo de cada
+# página não depende de quantas páginas vêm antes dela
+# -----------------------------------------------------------
+def _pagina_pedidos(conn, filtros, params, pagina, arquivo=False, colunar=False):
+    limite = pagina['limite']
+    filtros_cursor = list(filtros)
+    params_cursor = list(params)
+
+    if pagina['antes'] is not None:
+        filtros_cursor.append('p.pedidoid > ?')
+        params_cursor.append(pagina['antes'])
+        ordem = 'ASC'
+    else:
+        if pagina['depois'] is not None:
+            filtros_cursor.append('p.pedidoid < ?')
+            params_cursor.append(pagina['depois'])
+        ordem = 'DESC'
+
+    # Versão lida ANTES da consulta: uma escrita que entre entre as
+    # duas leituras fica acima dela e o /changes ainda a entrega
+    # (no pior caso, repetida). Lida depois, seria perdida.
+    versao = _versao(conn, 'pedido')
+
+    # 1 a mais para saber se existe outra página
+    colunas, linhas = _consultar_tuplas(
+        conn, *_sql_pedidos(filtros_cursor, params_cursor, arquivo, ordem, limite + 1)
+    )
+
+    tem_mais = len(linhas) > limite
+    linhas = linhas[:limite]
+    if ordem == 'ASC':
+        linhas.reverse()
+
+    posicao_id = colunas.index('pedidoid')
+    primeiro = linhas[0][posicao_id] if linhas else None
+    ultimo = linhas[-1][posicao_id] if linhas else None
+    pedidos = _serializar_pedidos(colunas, linhas, colunar)
+
+    if pagina['antes'] is not None:
+        # Veio de uma página mais antiga, então sempre há próxima
+        proximo = ultimo
+        anterior = primeiro if tem_mais else None
+    else:
+        proximo = ultimo if tem_mais else None
+        anterior = primeiro if pagina['depois'] is not None else None
+
+    resultado = {
+        'pedidos': pedidos,
+        'proximo': proximo,
+        'anterior': anterior,
+        'versao': versao,  # ponto de partida para /api/pedidos/changes
+    }
+
+    if pagina['total']:
+        contagem = f'SELECT COUNT(*) FROM main.pedido p{_where(filtros)}'
+        if arquivo:
+            contagem = f'SELECT ({contagem}) + (SELECT COUNT(*) FROM arquivo.pedido p{_where(filtros)})'
+            params = list(params) * 2
+        resultado['total'] = conn.execute(contagem, params).fetchone()[0]
+
+    return resultado
+
+
+def _where(filtros):
+    return f" WHERE {' AND '.join(filtros)}" if filtros else ''
+
+
+# -----------------------------------------------------------
+# Formato colunar (?format=columnar) das listagens:
+#   {"colunas": [...], "valores": [[coluna 1], [coluna 2], ...],
+#    "dicionarios": {"nome_produto": [...], ...}, "linhas": N}
+# Cada nome de coluna vai uma vez só e as colunas de
+# COLUNAS_DICIONARIO trazem índices para o dicionário, em vez de
+# repetir o mesmo texto em toda linha. É montado direto das
+# tuplas do cursor (zip transpõe), sem um dict por linha; como o
+# banco guarda ids, só o dicionário é traduzido para nomes.
+# -----------------------------------------------------------
+COLUNAS_DICIONARIO = ('nome_produto', 'nome_rosh')
+
+
+def _formato_colunar():
+    formato = request.args.get('format', 'json')
+    if formato not in ('json', 'columnar'):
+        raise ValueError('format deve ser json ou columnar')
+    return formato == 'columnar'
+
+
+def _colunar(colunas, linhas, nomes):
+    valores = [list(coluna) for coluna in zip(*linhas)] or [[] for _ in colunas]
+    dicionarios = {}
+    for i, nome in enumerate(colunas):
+        if nome in COLUNAS_DICIONARIO:
+            indices = {}
+            valores[i] = [indices.setdefault(valor, len(indices)) for valor in valores[i]]
+            por_id = nomes.get(nome)
+            dicionarios[nome] = [por_id.get(v) for v in indices] if por_id else list(indices)
+    return {'colunas': colunas, 'valores': valores, 'dicionarios': dicionarios, 'linhas': len(linhas)}
+
+
+# -----------------------------------------------------------
+# Pedidos no formato da API: produto e rosh voltam a ser os
+# nomes (o banco guarda os ids), pelo cache do catálogo.
+# "nomes" vem de _catalogo()['nomes'].
+# -----------------------------------------------------------
+def _decodificar_pedido(pedido, nomes):
+    for coluna, por_id in nomes.items():
+        if coluna in pedido:
+            pedido[coluna] = por_id.get(pedido[coluna])
+    return pedido
+
+
+def _serializar_pedidos(colunas, linhas, colunar, nomes=None):
+    nomes = _catalogo()['nomes'] if nomes is None else nomes
+    if colunar:
+        return _colunar(colunas, linhas, nomes)
+    return [_decodificar_pedido(dict(zip(colunas, linha)), nomes) for linha in linhas]
+
+
+# Executa a consulta devolvendo tuplas simples (sem sqlite3.Row)
+# e a lista de nomes das colunas
+def _consultar_tuplas(conn, sql, params=()):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    return [d[0] for d in cursor.description], cursor.fetchall()
+
+
+# -----------------------------------------------------------
+# Monta a consulta de pedidos (filtros, ordem por pedidoid e limite).
+# Com arquivo=True junta o banco principal e o de arquivo num
+# UNION ALL com ORDER BY/LIMIT no composto: o SQLite percorre as
+# duas chaves primárias em paralelo (merge) e para no limite.
+# "campos" troca o p.* por colunas escolhidas e "ordenar_por" a
+# chave da ordem (colunas que estejam no resultado).
+# Retorna (sql, params).
+# -----------------------------------------------------------
+def _sql_pedidos(filtros, params, arquivo=False, ordem=None, limite=None,
+                 campos='p.*', ordenar_por=('pedidoid',)):
+    de = f'SELECT {campos} FROM {{}} p'
+    where = _where(filtros)
+    params = list(params)
+    if arquivo:
+        sql = f"{de.format('main.pedido')}{where} UNION ALL {de.format('arquivo.pedido')}{where}"
+        params = params * 2
+        prefixo = ''  # no composto, o ORDER BY usa o nome da coluna do resultado
+    else:
+        sql = f"{de.format('pedido')}{where}"
+        prefixo = 'p.'
+
+    if ordem:
+        sql += ' ORDER BY ' + ', '.join(f'{prefixo}{coluna} {ordem}' for coluna in ordenar_por)
+    if limite is not None:
+        sql += ' LIMIT ?'
+        params.append(limite)
+    return sql, params
+
+
+# -----------------------------------------------------------
+# API: listar pedidos dos últimos 60 dias (JANELA_RECENTES_DIAS)
+# Com ?limit=N devolve uma página + cursores (proximo/anterior)
+# Com ?format=columnar os pedidos vêm no formato colunar
+# -----------------------------------------------------------
+@app.route('/api/pedidos', methods=['GET'])
+def listar_pedidos():
+    try:
+        pagina = _parametros_pagina()
+        colunar = _formato_colunar()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    conn = db_connection()
+    etag = _etag_pedidos(conn)
+    nao_modificado = _nao_modificado(etag)
+    if nao_modificado:
+        return nao_modificado
+
+    if pagina is not None:
+        return _com_etag(jsonify(_pagina_pedidos(
+            conn, [FILTRO_RECENTES], [_inicio_janela_recentes()], pagina, colunar=colunar
+        )), etag)
+
+    colunas, linhas = _consultar_tuplas(
+        conn, f'{SQL_PEDIDOS} WHERE {FILTRO_RECENTES}', (_inicio_janela_recentes(),)
+    )
+    return _com_etag(jsonify(_serializar_pedidos(colunas, linhas, colunar)), etag)
+
+
+# -----------------------------------------------------------
+# O cliente pediu a resposta em streaming (NDJSON)?
+# Aceita ?stream=1 ou o header Accept: application/x-ndjson
+# -----------------------------------------------------------
+def _quer_stream():
+    return (
+        request.args.get('stream') == '1'
+        or request.accept_mimetypes.best == 'application/x-ndjson'
+    )
+
+
+# -----------------------------------------------------------
+# Lê uma consulta em lotes com fetchmany, gerando (colunas, lote):
+# a memória usada fica constante, não importa o tamanho do histórico.
+# Usa uma conexão própria do pool, pois o gerador continua rodando
+# depois que a view retorna (e anexa o arquivo se a consulta o usa).
+# -----------------------------------------------------------
+def _lotes_da_consulta(sql, params, arquivo=False):
+    pool = _obter_pool()
+    conn = pool.obter()
+    try:
+        if arquivo:
+            _anexar_arquivo(conn, criar=True)
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(sql, params)
+        colunas = [d[0] for d in cursor.description]
+        while True:
+            lote = cursor.fetchmany(app.config['STREAM_LOTE'])
+            if not lote:
+                break
+            yield colunas, lote
+        cursor.close()
+    finally:
+        pool.devolver(conn)
+
+
+# -----------------------------------------------------------
+# Gera as linhas de uma consulta como NDJSON (um pedido por linha).
+# No formato colunar, cada linha do NDJSON é um bloco colunar
+# com um lote inteiro (e seus próprios dicionários).
+# "nomes" (ids → nomes do catálogo) é lido ainda na requisição.
+# -----------------------------------------------------------
+def _gerar_ndjson(sql, params, nomes, arquivo=False, colunar=False):
+    lotes = _lotes_da_consulta(sql, params, arquivo)
+    try:
+        for colunas, lote in lotes:
+            if colunar:
+                yield app.json.dumps(_colunar(colunas, lote, nomes)) + '\n'
+            else:
+                yield ''.join(app.json.dumps(p) + '\n' for p in _serializar_pedidos(colunas, lote, False, nomes))
+    finally:
+        lotes.close()  # devolve a conexão mesmo se o cliente desistir no meio
+
+
+# -----------------------------------------------------------
+# API: listar TODOS os pedidos do banco
+# (sem filtro de data; aceita a mesma paginação de /api/pedidos)
+# Inclui os pedidos já movidos para o arquivo.
+# Com ?stream=1 (ou Accept: application/x-ndjson) transmite
+# o histórico inteiro em NDJSON, sem montar a lista em memória.
+# Aceita ?format=columnar (no streaming, um bloco por lote).
+# -----------------------------------------------------------
+@app.route('/api/pedidos/todos', methods=['GET'])
+def listar_todos_pedidos():
+    try:
+        colunar = _formato_colunar()
+        if request.args.get('stream') not in (None, '0', '1'):
+            raise ValueError('stream deve ser 0 ou 1')
+        stream = _quer_stream()
+        pagina = None if stream else _parametros_pagina()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # O histórico completo não depende da janela de recentes: a ETag
+    # não muda a cada hora
+    conn = db_connection()
+    etag = _etag_pedidos(conn, janela=False)
+    nao_modificado = _nao_modificado(etag)
+    if nao_modificado:
+        return nao_modificado
+
+    arquivo = _anexar_arquivo(conn)
+
+    if stream:
+        sql, params = _sql_pedidos([], [], arquivo, 'ASC')
+        return _com_etag(Response(
+            _gerar_ndjson(sql, params, _catalogo()['nomes'], arquivo, colunar),
+            mimetype='application/x-ndjson',
+        ), etag)
+
+    if pagina is not None:
+        return _com_etag(jsonify(_pagina_pedidos(conn, [], [], pagina, arquivo, colunar)), etag)
+
+    colunas, linhas = _consultar_tuplas(conn, *_sql_pedidos([], [], arquivo, 'ASC'))
+    return _com_etag(jsonify(_serializar_pedidos(colunas, linhas, colunar)), etag)
+
+
+# -----------------------------------------------------------
+# Exportação CSV do histórico (somente ADMIN), para a contabilidade
+# GET /api/pedidos/export.csv?from=AAAA-MM-DD&to=AAAA-MM-DD
+#     [&produto=nome][&rosh=nome][&ativo=0|1]
+# Datas são dias locais, inclusivos. Inclui os pedidos do arquivo.
+# As linhas saem do cursor em lotes direto para a resposta (memória
+# constante), em ordem de criação: o índice em criacao_epoch já
+# entrega essa ordem, sem ordenação temporária, mesmo no composto
+# com o arquivo. O preço vem do cadastro atual do produto.
+# -----------------------------------------------------------
+COLUNAS_EXPORTACAO = (
+    'pedidoid', 'criacao', 'nome', 'rg', 'produto', 'rosh', 'essencia', 'observacao', 'ativo', 'preco',
+)
+
+
+def _inicio_do_dia(texto):
+    fuso = timezone(timedelta(hours=app.config['FUSO_HORARIO_HORAS']))
+    return int(datetime.strptime(texto, '%Y-%m-%d').replace(tzinfo=fuso).timestamp())
+
+
+# Filtro em texto (query string ou parâmetros JSON de uma tarefa):
+# ausente ou vazio → None; outro tipo que não texto → ValueError
+def _filtro_texto(args, chave):
+    valor = args.get(chave)
+    if valor is None or valor == '':
+        return None
+    if not isinstance(valor, str):
+        raise ValueError(f'{chave} deve ser um texto')
+    return valor
+
+
+def _filtros_exportacao(args, catalogo):
+    filtros, params = [], []
+    inicio, fim = _filtro_texto(args, 'from'), _filtro_texto(args, 'to')
+    try:
+        if inicio:
+            filtros.append('p.criacao_epoch >= ?')
+            params.append(_inicio_do_dia(inicio))
+        if fim:
+            filtros.append('p.criacao_epoch < ?')
+            params.append(_inicio_do_dia(fim) + 86400)
+    except ValueError:
+        raise ValueError('Datas devem estar no formato AAAA-MM-DD')
+
+    for coluna, rotulo in (('nome_produto', 'Produto'), ('nome_rosh', 'Rosh')):
+        nome = _filtro_texto(args, rotulo.lower())
+        if nome:
+            filtros.append(f'p.{coluna} = ?')
+            params.append(_id_catalogo(catalogo['ids'][coluna], nome, rotulo))
+
+    # "0"/"1" na query string; 0/1 também no JSON das tarefas
+    ativo = args.get('ativo')
+    if ativo is not None and ativo != '':
+        if isinstance(ativo, bool) or ativo not in ('0', '1', 0, 1):
+            raise ValueError('ativo deve ser 0 ou 1')
+        filtros.append('p.ativo = ?')
+        params.append(int(ativo))
+    return filtros, params
+
+
+def _sql_exportacao(filtros, params, arquivo):
+    return _sql_pedidos(
+        filtros, params, arquivo, 'ASC',
+        campos='p.pedidoid, p.criacao, p.name, p.rg, p.nome_produto, p.nome_rosh, '
+               'p.essencia, p.observacao, p.ativo, p.criacao_epoch',
+        ordenar_por=('criacao_epoch', 'pedidoid'),
+    )
+
+
+# Texto digitado pelo cliente/atendente que começa com = + - @ (ou
+# tab/CR) vira fórmula no Excel: o apóstrofo na frente faz a célula
+# ser lida como texto (injeção de fórmula no CSV da contabilidade)
+INICIO_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _celula_texto(valor):
+    if isinstance(valor, str) and valor.startswith(INICIO_FORMULA):
+        return "'" + valor
+    return valor
+
+
+# Gera (texto, linhas): o cabeçalho e depois um pedaço de CSV por lote
+def _partes_csv(sql, params, catalogo, arquivo):
+    produtos = catalogo['nomes']['nome_produto']
+    roshs = catalogo['nomes']['nome_rosh']
+    precos = catalogo['precos']
+    saida = io.StringIO()
+    escritor = csv.writer(saida)
+
+    # BOM: o Excel abre o arquivo como UTF-8 (acentos corretos)
+    escritor.writerow(COLUNAS_EXPORTACAO)
+    yield '\ufeff' + saida.getvalue(), 0
+
+    lotes = _lotes_da_consulta(sql, params, arquivo)
+    try:
+        for _, lote in lotes:
+            saida.seek(0)
+            saida.truncate()
+            escritor.writerows(
+                (pid, criacao, _celula_texto(nome), _celula_texto(rg), _celula_texto(produtos.get(produto)),
+                 _celula_texto(roshs.get(rosh)), _celula_texto(essencia), _celula_texto(observacao),
+                 ativo, precos.get(produto, 0))
+                for pid, criacao, nome, rg, produto, rosh, essencia, observacao, ativo, _ in lote
+            )
+            yield saida.getvalue(), len(lote)
+    finally:
+        lotes.close()
+
+
+def _gerar_csv(sql, params, catalogo, arquivo):
+    partes = _partes_csv(sql, params, catalogo, arquivo)
+    try:
+        for texto, _ in partes:
+            yield texto
+    finally:
+        partes.close()
+
+
+@app.route('/api/pedidos/export.csv', methods=['GET'])
+def exportar_pedidos_csv():
+    if not session.get('admin'):
+        return jsonify({'error': 'Acesso restrito ao administrador'}), 403
+
+    catalogo = _catalogo()
+    try:
+        filtros, params = _filtros_exportacao(request.args, catalogo)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    arquivo = _anexar_arquivo(db_connection())
+    sql, params = _sql_exportacao(filtros, params, arquivo)
+
+    periodo = '_'.join(filter(None, (request.args.get('from'), request.args.get('to')))) or 'completo'
+    resposta = Response(_gerar_csv(sql, params, catalogo, arquivo), mimetype='text/csv')
+    resposta.headers.set('Content-Disposition', 'attachment', filename=f'pedidos_{periodo}.csv')
+    resposta.cache_control.no_store = True
+    return resposta
+
+
+# -----------------------------------------------------------
+# Converte o texto digitado numa consulta FTS5 por prefixo:
+# "ana uva" → "ana"* "uva"* (todas as palavras, cada uma como
+# início de palavra). Aspas e operadores do usuário são ignorados.
+# -----------------------------------------------------------
+def _consulta_fts(texto):
+    palavras = re.findall(r'\w+', texto or '', re.UNICODE)
+    return ' '.join(f'"{p}"*' for p in palavras)
+
+
+# -----------------------------------------------------------
+# API: busca textual nos pedidos (FTS5)
+# GET /api/pedidos/busca?q=texto[&limit=N][&pagina=P][&recentes=1]
+# Procura em nome, RG, essência, observação, produto e rosh,
+# ordenando pela relevância (bm25). "recentes=1" limita à janela
+# da listagem principal; sem ele a busca inclui o arquivo.
+# -----------------------------------------------------------
+@app.route('/api/pedidos/busca', methods=['GET'])
+def buscar_pedidos():
+    try:
+        limite = int(request.args.get('limit', 50))
+        pagina = int(request.args.get('pagina', 1))
+    except ValueError:
+        return jsonify({'error': 'Parâmetros de paginação inválidos'}), 400
+    if not 1 <= limite <= app.config['PAGINA_LIMITE_MAXIMO'] or pagina < 1:
+        return jsonify({'error': 'Parâmetros de paginação inválidos'}), 400
+
+    consulta = _consulta_fts(request.args.get('q'))
+    if not consulta:
+        return jsonify({'pedidos': [], 'pagina': pagina, 'mais': False})
+
+    recentes = request.args.get('recentes') == '1'
+    filtros, params = ['pedido_fts MATCH ?'], [consulta]
+    if recentes:
+        filtros.append(FILTRO_RECENTES)
+        params.append(_inicio_janela_recentes())
+
+    conn = db_connection()
+    if not recentes and _anexar_arquivo(conn):
+        linhas = _buscar_com_arquivo(conn, consulta, limite + 1, (pagina - 1) * limite)
+    else:
+        linhas = conn.execute(f"""
+            {SQL_PEDIDOS}
+            JOIN pedido_fts ON pedido_fts.rowid = p.pedidoid{_where(filtros)}
+            ORDER BY pedido_fts.rank, p.pedidoid DESC
+            LIMIT ? OFFSET ?
+        """, params + [limite + 1, (pagina - 1) * limite]).fetchall()
+
+    return jsonify({
+        'pedidos': [_decodificar_pedido(dict(p), _catalogo()['nomes']) for p in linhas[:limite]],
+        'pagina': pagina,
+        'mais': len(linhas) > limite,
+    })
+
+
+# -----------------------------------------------------------
+# Com o arquivo anexado, ordena os pedidoids só pelo índice FTS
+# (que cobre os dois bancos) e depois lê as linhas onde estiverem
+# -----------------------------------------------------------
+def _buscar_com_arquivo(conn, consulta, limite, deslocamento):
+    ids = [linha[0] for linha in conn.execute("""
+        SELECT rowid FROM pedido_fts WHERE pedido_fts MATCH ?
+        ORDER BY rank, rowid DESC
+        LIMIT ? OFFSET ?
+    """, (consulta, limite, deslocamento))]
+    if not ids:
+        return []
+
+    marcadores = ','.join('?' * len(ids))
+    por_id = {
+        linha['pedidoid']: linha
+        for linha in conn.execute(*_sql_pedidos([f'p.pedidoid IN ({marcadores})'], ids, arquivo=True))
+    }
+    return [por_id[i] for i in ids if i in por_id]
+
+
+# Arquivamento (hot/cold) dos pedidos antigos
+app.config['ARQUIVO_DB_PATH'] = None        # None → "<banco>_arquivo.db" ao lado do principal
+app.config['ARQUIVO_IDADE_DIAS'] = 180      # pedidos criados há mais tempo vão para o arquivo
+app.config['ARQUIVO_LOTE'] = 500            # pedidos movidos por transação
+app.config['ARQUIVO_PAUSA_S'] = 0.05        # folga entre lotes para as outras escritas
+app.config['ARQUIVO_INTERVALO_S'] = 3600    # intervalo do arquivamento automático
+
+
+# db/pedidos_db.db → db/pedidos_arquivo.db
+def _caminho_arquivo():
+    if app.config['ARQUIVO_DB_PATH']:
+        return app.config['ARQUIVO_DB_PATH']
+    raiz = os.path.splitext(DB_PATH)[0]
+    if raiz.endswith('_db'):
+        raiz = raiz[:-len('_db')]
+    return raiz + '_arquivo.db'
+
+
+# -----------------------------------------------------------
+# Anexa o banco de arquivo à conexão como "arquivo" (uma vez por
+# conexão do pool; o ATTACH continua valendo nas próximas
+# requisições). Sem criar=True não cria o arquivo: retorna False
+# se ele ainda não existe, ou seja, nada foi arquivado.
+# -----------------------------------------------------------
+def _anexar_arquivo(conn, criar=False):
+    if any(linha[1] == 'arquivo' for linha in conn.execute('PRAGMA database_list')):
+        return True
+
+    caminho = _caminho_arquivo()
+    if not criar and not os.path.exists(caminho):
+        return False
+
+    conn.execute('ATTACH DATABASE ? AS arquivo', (caminho,))
+    conn.execute('PRAGMA arquivo.journal_mode = WAL')
+    _sincronizar_esquema_arquivo(conn)
+    return True
+
+
+# -----------------------------------------------------------
+# Garante que arquivo.pedido tenha as mesmas colunas, na mesma
+# ordem, que main.pedido: as consultas juntam os dois com
+# UNION ALL de p.* e o arquivamento copia com SELECT *.
+# Colunas novas do principal (migrações) entram no fim das duas.
+# -----------------------------------------------------------
+def _sincronizar_esquema_arquivo(conn):
+    colunas = conn.execute('PRAGMA main.table_info(pedido)').fetchall()
+    existentes = {linha[1] for linha in conn.execute('PRAGMA arquivo.table_info(pedido)')}
+
+    if not existentes:
+        definicoes = ', '.join(
+            f'{c[1]} INTEGER PRIMARY KEY' if c[5] else f'{c[1]} {c[2]}'
+            for c in colunas
+        )
+        conn.execute(f'CREATE TABLE IF NOT EXISTS arquivo.pedido ({definicoes})')
+        conn.execute('CREATE INDEX IF NOT EXISTS arquivo.idx_pedido_criacao_epoch ON pedido(criacao_epoch)')
+    else:
+        for c in colunas:
+            if c[1] not in existentes:
+                conn.execute(f'ALTER TABLE arquivo.pedido ADD COLUMN {c[1]} {c[2]}')
+
+    if [c[1] for c in colunas] != [linha[1] for linha in conn.execute('PRAGMA arquivo.table_info(pedido)')]:
+        raise RuntimeError('Colunas de arquivo.pedido divergem de pedido')
+
+    # Arquivos de antes da migração 8 guardam os nomes de produto/rosh
+    if conn.execute('PRAGMA arquivo.user_version').fetchone()[0] < 1:
+        if existentes:
+            _converter_nomes_em_ids(conn, 'arquivo')
+        conn.execute('PRAGMA arquivo.user_version = 1')
+        conn.commit()
+
+
+# -----------------------------------------------------------
+# Move para o arquivo os pedidos criados há mais de
+# ARQUIVO_IDADE_DIAS, em lotes de ARQUIVO_LOTE, para nunca segurar
+# o lock de escrita por muito tempo. Cada lote são duas transações
+# curtas: copia (INSERT OR REPLACE, idempotente) e depois apaga do
+# principal com a flag "arquivando" ligada (os triggers de delete
+# ficam quietos). Em WAL o commit entre bancos anexados não é
+# atômico; nessa ordem, uma queda no meio deixa no máximo uma cópia
+# repetida, resolvida no próximo lote. Só apaga se a versão não
+# mudou desde a cópia; senão o pedido é copiado de novo.
+# "ao_lote(movidos)" é chamada depois de cada lote (progresso e
+# cancelamento da tarefa de arquivamento, em /api/jobs).
+# Retorna quantos pedidos foram movidos.
+# A mudança não gera tombstone nem muda a versão "pedido": por isso
+# só pedidos fora da janela de recentes podem ir para o arquivo
+# (senão sairiam da listagem com a ETag antiga ainda valendo).
+# -----------------------------------------------------------
+def verificar_idade_arquivo(idade_dias=None):
+    if idade_dias is None:
+        idade_dias = app.config['ARQUIVO_IDADE_DIAS']
+    if idade_dias < app.config['JANELA_RECENTES_DIAS']:
+        raise RuntimeError(
+            f"Idade de arquivamento ({idade_dias} dias) menor que a janela de recentes "
+            f"(JANELA_RECENTES_DIAS = {app.config['JANELA_RECENTES_DIAS']})"
+        )
+    return idade_dias
+
+
+def arquivar_pedidos_antigos(idade_dias=None, ao_lote=None):
+    idade_dias = verificar_idade_arquivo(idade_dias)
+    limite_epoch = int(time.time()) - int(idade_dias * 86400)
+
+    pool = _obter_pool()
+    conn = pool.obter()
+    movidos = 0
+    try:
+        _anexar_arquivo(conn, criar=True)
+        while True:
+            ids = [linha[0] for linha in conn.execute(
+                'SELECT pedidoid FROM main.pedido WHERE criacao_epoch < ? ORDER BY criacao_epoch LIMIT ?',
+                (limite_epoch, app.config['ARQUIVO_LOTE'])
+            )]
+            if not ids:
+                break
+            marcadores = ','.join('?' * len(ids))
+
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                f'INSERT OR REPLACE INTO arquivo.pedido SELECT * FROM main.pedido WHERE pedidoid IN ({marcadores})',
+                ids
+            )
+            conn.commit()
+
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("UPDATE controle_interno SET valor = 1 WHERE chave = 'arquivando'")
+            apagados = conn.execute(f"""
+                DELETE FROM main.pedido
+                WHERE pedidoid IN ({marcadores})
+                  AND versao IS (SELECT a.versao FROM arquivo.pedido a WHERE a.pedidoid = main.pedido.pedidoid)
+            """, ids).rowcount
+            conn.execute("UPDATE controle_interno SET valor = 0 WHERE chave = 'arquivando'")
+            conn.commit()
+
+            movidos += apagados
+            if ao_lote:
+                ao_lote(movidos)
+            time.sleep(app.config['ARQUIVO_PAUSA_S'])
+    finally:
+        pool.devolver(conn)
+    return movidos
+
+
+# -----------------------------------------------------------
+# Reserva a rodada de arquivamento: o UPDATE condicional na marca
+# "ultimo_arquivamento" só acerta em um worker por intervalo
+# -----------------------------------------------------------
+def _reservar_arquivamento(conn):
+    agora = int(time.time())
+    cursor = conn.execute(
+        "UPDATE controle_interno SET valor = ? WHERE chave = 'ultimo_arquivamento' AND valor <= ?",
+        (agora, agora - app.config['ARQUIVO_INTERVALO_S'])
+    )
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+# -----------------------------------------------------------
+# Arquivamento automático: uma thread por processo acorda a cada
+# ARQUIVO_INTERVALO_S e, se conseguir a reserva, arquiva
+# -----------------------------------------------------------
+def iniciar_arquivamento_automatico():
+    verificar_idade_arquivo()  # configuração inválida falha na subida, não a cada hora
+
+    def rodar():
+        while True:
+            try:
+                with app.app_context():
+                    if _reservar_arquivamento(db_connection()):
+                        arquivar_pedidos_antigos()
+            except Exception:
+                app.logger.exception('Falha no arquivamento automático')
+            time.sleep(app.config['ARQUIVO_INTERVALO_S'])
+
+    threading.Thread(target=rodar, name='arquivamento', daemon=True).start()
+
+
+# Eventos em tempo real (SSE) para as estações abertas
+app.config['EVENTOS_HEARTBEAT_S'] = 15        # comentário "ping" quando não há eventos
+app.config['EVENTOS_FILA_ASSINANTE'] = 100    # eventos pendentes por cliente antes de forçar recarga
+app.config['EVENTOS_HISTORICO'] = 500         # eventos guardados para retomar via Last-Event-ID
+app.config['EVENTOS_MAX_ASSINANTES'] = 200    # conexões SSE simultâneas por processo
+app.config['EVENTOS_POLL_S'] = 1.0            # intervalo para notar escritas de outros processos
+
+
+# -----------------------------------------------------------
+# Um cliente conectado ao /api/eventos.
+# A fila é limitada: se o cliente não acompanhar, os eventos
+# pendentes são descartados e ele recebe "recarregar" (e então
+# sincroniza pelo feed de alterações).
+# -----------------------------------------------------------
+class Assinante:
+
+    def __init__(self, limite):
+        self.fila = deque()
+        self.limite = limite
+        self.recarregar = False
+        self.cond = threading.Condition()
+
+    def entregar(self, evento):
+        with self.cond:
+            if len(self.fila) >= self.limite:
+                self.fila.clear()
+                self.recarregar = True
+            else:
+                self.fila.append(evento)
+            self.cond.notify()
+
+    # Espera até "timeout" segundos por eventos.
+    # Retorna (recarregar, lista de eventos); lista vazia = heartbeat
+    def aguardar(self, timeout):
+        with self.cond:
+            if not self.fila and not self.recarregar:
+                self.cond.wait(timeout)
+            eventos = list(self.fila)
+            self.fila.clear()
+            recarregar, self.recarregar = self.recarregar, False
+        return recarregar, eventos
+
+
+# -----------------------------------------------------------
+# Broker publish/subscribe em memória (um por processo).
+# Guarda os últimos eventos num buffer circular para que um
+# cliente reconectando com Last-Event-ID receba o que perdeu.
+# -----------------------------------------------------------
+class BrokerEventos:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._assinantes = set()
+        self._historico = deque()
+        self._ultimo_id = 0
+        self.ultima_versao = None  # última versão "pedido" anunciada
+        self._vigia = None
+
+    def publicar(self, dados):
+        with self._lock:
+            self._ultimo_id += 1
+            evento = (self._ultimo_id, dados)
+            self._historico.append(evento)
+            while len(self._historico) > app.config['EVENTOS_HISTORICO']:
+                self._historico.popleft()
+            if dados.get('versao') is not None:
+                self.ultima_versao = max(self.ultima_versao or 0, dados['versao'])
+            assinantes = list(self._assinantes)
+        for assinante in assinantes:
+            assinante.entregar(evento)
+
+    # Registra um cliente. Com ultimo_id (Last-Event-ID), reenvia os
+    # eventos perdidos; se eles já saíram do buffer, pede recarga.
+    # Retorna None se o limite de conexões foi atingido.
+    def assinar(self, ultimo_id=None):
+        assinante = Assinante(app.config['EVENTOS_FILA_ASSINANTE'])
+        with self._lock:
+            if len(self._assinantes) >= app.config['EVENTOS_MAX_ASSINANTES']:
+                return None
+            if ultimo_id is not None and ultimo_id < self._ultimo_id:
+                perdidos = [e for e in self._historico if e[0] > ultimo_id]
+                if not perdidos or perdidos[0][0] != ultimo_id + 1:
+                    assinante.recarregar = True
+                else:
+                    for evento in perdidos:
+                        assinante.entregar(evento)
+            elif ultimo_id is not None and ultimo_id > self._ultimo_id:
+                assinante.recarregar = True  # processo reiniciou: ids não batem
+            self._assinantes.add(assinante)
+            self._iniciar_vigia()
+        return assinante
+
+    def cancelar(self, assinante):
+        with self._lock:
+            self._assinantes.discard(assinante)
+
+    def tem_assinantes(self):
+        with self._lock:
+            return bool(self._assinantes)
+
+    # Com vários workers, cada processo tem seu broker. Uma thread por
+    # processo (só enquanto houver clientes) lê o contador de versão
+    # "pedido" e avisa quando outro processo escreveu.
+    def _iniciar_vigia(self):
+        if not app.config['EVENTOS_POLL_S'] or (self._vigia and self._vigia.is_alive()):
+            return
+        self._vigia = threading.Thread(target=self._vigiar, name='vigia-eventos', daemon=True)
+        self._vigia.start()
+
+    def _vigiar(self):
+        while True:
+            time.sleep(app.config['EVENTOS_POLL_S'])
+            if not self.tem_assinantes():
+                return
+            try:
+                with app.app_context():
+                    versao = _versao(db_connection(), 'pedido')
+            except sqlite3.Error:
+                continue
+            if self.ultima_versao is None:
+                self.ultima_versao = versao
+            elif versao > self.ultima_versao:
+                self.publicar({'tipo': 'alterado', 'versao': versao})
+
+
+broker_eventos = BrokerEventos()
+
+
+# -----------------------------------------------------------
+# Publica um evento compacto de pedido depois do commit
+# -----------------------------------------------------------
+def _publicar_pedido(conn, tipo, pedido_id):
+    broker_eventos.publicar({'tipo': tipo, 'pedidoid': pedido_id, 'versao': _versao(conn, 'pedido')})
+
+
+# -----------------------------------------------------------
+# API: feed de alterações desde uma versão
+# GET /api/pedidos/changes?since=<versao>[&limit=N]
+# Devolve só os pedidos criados/alterados depois de "since"
+# (em ordem de versão) e os ids excluídos (tombstones).
+# Se "mais" vier true, chame de novo com since=versao.
+# -----------------------------------------------------------
+@app.route('/api/pedidos/changes', methods=['GET'])
+def listar_alteracoes():
+    try:
+        desde = int(request.args['since'])
+        limite = int(request.args.get('limit', app.config['PAGINA_LIMITE_MAXIMO']))
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Informe since (versão) como número inteiro'}), 400
+    limite = max(1, min(limite, app.config['PAGINA_LIMITE_MAXIMO']))
+
+    conn = db_connection()
+    atual = _versao(conn, 'pedido')
+
+    # Versão do cliente maior que a do banco (ex.: banco recriado):
+    # não dá para calcular o delta, o cliente precisa recarregar
+    if desde > atual:
+        return jsonify({'versao': atual, 'recarregar': True, 'alterados': [], 'excluidos': [], 'mais': False})
+
+    alterados = conn.execute(
+        f'{SQL_PEDIDOS} WHERE p.versao > ? ORDER BY p.versao LIMIT ?', (desde, limite + 1)
+    ).fetchall()
+    mais = len(alterados) > limite
+    alterados = alterados[:limite]
+    ate = alterados[-1]['versao'] if mais else atual
+
+    excluidos = conn.execute(
+        'SELECT pedidoid FROM pedido_excluido WHERE versao > ? AND versao <= ? ORDER BY versao',
+        (desde, ate)
+    ).fetchall()
+
+    return jsonify({
+        'versao': ate,
+        'recarregar': False,
+        'alterados': [_decodificar_pedido(dict(p), _catalogo()['nomes']) for p in alterados],
+        'excluidos': [e['pedidoid'] for e in excluidos],
+        'mais': mais,
+    })
+
+
+# -----------------------------------------------------------
+# API: stream de eventos (Server-Sent Events)
+# Cada escrita em pedido gera um evento {"tipo", "pedidoid", "versao"};
+# o cliente reage sincronizando pelo /api/pedidos/changes.
+# Retoma de onde parou com o header Last-Event-ID (ou ?ultimo=).
+# -----------------------------------------------------------
+@app.route('/api/eventos')
+def eventos():
+    ultimo = request.headers.get('Last-Event-ID') or request.args.get('ultimo')
+    try:
+        ultimo_id = int(ultimo) if ultimo else None
+    except ValueError:
+        ultimo_id = None
+
+    # Assina já na requisição para não perder eventos publicados
+    # antes de o gerador começar a rodar
+    assinante = broker_eventos.assinar(ultimo_id)
+    if assinante is None:
+        return jsonify({'error': 'Limite de conexões de eventos atingido'}), 503
+
+    def gerar():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                recarregar, pendentes = assinante.aguardar(app.config['EVENTOS_HEARTBEAT_S'])
+                if recarregar:
+                    yield 'data: {"tipo": "recarregar"}\n\n'
+                if not recarregar and not pendentes:
+                    yield ': ping\n\n'
+                for evento_id, dados in pendentes:
+                    yield f'id: {evento_id}\ndata: {app.json.dumps(dados)}\n\n'
+        finally:
+            broker_eventos.cancelar(assinante)
+
+    resposta = Response(gerar(), mimetype='text/event-stream')
+    resposta.headers['Cache-Control'] = 'no-cache'
+    resposta.headers['X-Accel-Buffering'] = 'no'  # proxies não devem segurar o stream
+    return resposta
+
+
+# Comandos de escrita compartilhados pelas rotas unitárias e em lote
+SQL_INSERIR_PEDIDO = """
+    INSERT INTO pedido (name, rg, nome_produto, nome_rosh, essencia, observacao,
+                        criacao, atualizacao, criacao_epoch, atualizacao_epoch)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_ATUALIZAR_PEDIDO = """
+    UPDATE pedido
+    SET name = ?, rg = ?, nome_produto = ?, nome_rosh = ?, essencia = ?, atualizacao = ?, observacao = ?,
+        atualizacao_epoch = ?
+    WHERE pedidoid = ?
+"""
+
+SQL_ATUALIZAR_ATIVO = "UPDATE pedido SET ativo = ?, atualizacao = ?, atualizacao_epoch = ? WHERE pedidoid = ?"
+
+
+# -----------------------------------------------------------
+# Extrai os campos de um pedido enviados pelo front-end.
+# Produto e rosh chegam pelo nome e são gravados pelo id, usando
+# o cache do catálogo. Lança ValueError se o nome não existe.
+# -----------------------------------------------------------
+def _campos_pedido(data):
+    ids = _catalogo()['ids']
+    return (
+        data.get('nome'),
+        data.get('rg'),
+        _id_catalogo(ids['nome_produto'], data.get('produto'), 'Produto'),
+        _id_catalogo(ids['nome_rosh'], data.get('rosh'), 'Rosh'),
+        data.get('essencia'),
+        data.get('observacao'),
+    )
+
+
+def _id_catalogo(ids, nome, rotulo):
+    if nome is None or nome == '':
+        return None
+    try:
+        return ids[nome]
+    except (KeyError, TypeError):
+        raise ValueError(f'{rotulo} não cadastrado: {nome}')
+
+
+# -----------------------------------------------------------
+# API: criar um novo pedido
+# Recebe JSON no corpo do POST
+# -----------------------------------------------------------
+@app.route('/api/pedido', methods=['POST'])
+def criar_pedido():
+    data = request.json
+    try:
+        nome, rg, produto, rosh, essencia, observacao = _campos_pedido(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Instante em epoch UTC; o texto local é derivado dele
+    agora = int(time.time())
+    local = _epoch_para_local(agora)
+
+    valores = (nome, rg, produto, rosh, essencia, observacao, local, local, agora, agora)
+    pedido_id = _escrever(lambda conn: conn.execute(SQL_INSERIR_PEDIDO, valores).lastrowid)
+    _publicar_pedido(db_connection(), 'criado', pedido_id)
+
+    return jsonify({'message': 'Pedido criado com sucesso!'}), 201
+
+
+# -----------------------------------------------------------
+# Resposta quando a escrita de um pedido não alterou nenhuma linha:
+# pedidos arquivados são só leitura (409); senão não existe (404)
+# -----------------------------------------------------------
+ERRO_ARQUIVADO = 'Pedido arquivado: somente leitura'
+
+
+# Quais dos ids estão no banco de arquivo
+def _ids_arquivados(ids):
+    conn = db_connection()
+    if not ids or not _anexar_arquivo(conn):
+        return set()
+    ids = list(ids)
+    return {linha[0] for linha in conn.execute(
+        f"SELECT pedidoid FROM arquivo.pedido WHERE pedidoid IN ({','.join('?' * len(ids))})", ids
+    )}
+
+
+def _pedido_nao_alterado(pedido_id):
+    if _ids_arquivados([pedido_id]):
+        return jsonify({'error': ERRO_ARQUIVADO}), 409
+    return jsonify({'error': 'Pedido não encontrado'}), 404
+
+
+# -----------------------------------------------------------
+# API: excluir pedido pelo ID
+# -----------------------------------------------------------
+@app.route('/api/pedido/<int:pedido_id>', methods=['DELETE'])
+def deletar_pedido(pedido_id):
+    alterados = _escrever(lambda conn: conn.execute('DELETE FROM pedido WHERE pedidoid = ?', (pedido_id,)).rowcount)
+    if not alterados:
+        return _pedido_nao_alterado(pedido_id)
+    _publicar_pedido(db_connection(), 'excluido', pedido_id)
+    return jsonify({'message': 'Pedido excluído com sucesso'})
+
+
 # -----------------------------------------------------------
-# Conexão com o banco SQLite
-# Retorna conexão configurada para acessar colunas como dicts
+# API: atualizar o status "ativo" de um pedido (checkbox)
+# Apenas aceita valores 0 ou 1
 # -----------------------------------------------------------
-def db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # permite acessar resultado por nome da coluna
-    return conn
+@app.route('/api/pedido/<int:pedido_id>/ativo', methods=['PUT'])
+def atualizar_ativo(pedido_id):
+    app.logger.debug('PUT ativo do pedido %s', pedido_id)
+
+    data = request.json
+    ativo = data.get('ativo')
+
+    # Validação: apenas 0 ou 1 são permitidos
+    if ativo not in [0, 1]:
+        return jsonify({'error': 'Valor de ativo inválido'}), 400
+
+    agora = int(time.time())
+
+    valores = (ativo, _epoch_para_local(agora), agora, pedido_id)
+    if not _escrever(lambda conn: conn.execute(SQL_ATUALIZAR_ATIVO, valores).rowcount):
+        return _pedido_nao_alterado(pedido_id)
+    _publicar_pedido(db_connection(), 'ativo', pedido_id)
+
+    return jsonify({'message': 'Status atualizado com sucesso'}), 200
 
 
 # -----------------------------------------------------------
-# Rota inicial "/"
-# Exige login — se não estiver logado, redireciona ao /login
-# Se logado, renderiza a página principal
+# API: atualizar um pedido inteiro (PUT)
 # -----------------------------------------------------------
-@app.route('/')
-def index():
-    if 'usuario' not in session:
-        return redirect(url_for('login'))
-    return render_template('index.html', admin=session.get('admin', False))
+@app.route('/api/pedido/<int:pedido_id>', methods=['PUT'])
+def atualizar_pedido(pedido_id):
+    data = request.json
+    try:
+        nome, rg, produto, rosh, essencia, observacao = _campos_pedido(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    agora = int(time.time())
+
+    valores = (nome, rg, produto, rosh, essencia, _epoch_para_local(agora), observacao, agora, pedido_id)
+    if not _escrever(lambda conn: conn.execute(SQL_ATUALIZAR_PEDIDO, valores).rowcount):
+        return _pedido_nao_alterado(pedido_id)
+    _publicar_pedido(db_connection(), 'atualizado', pedido_id)
+
+    return jsonify({'message': 'Pedido atualizado com sucesso'})
+
+
+# Máximo de itens aceitos por requisição em lote
+app.config['LOTE_MAXIMO'] = 500
 
 
 # -----------------------------------------------------------
-# Rota alternativa "/index" (mesmo comportamento da "/")
+# Validação de um item de lote.
+# Retorna a mensagem de erro ou None se o item é válido.
 # -----------------------------------------------------------
-@app.route('/index')
-def index_page():
-    if 'usuario' not in session:
-        return redirect(url_for('login'))
-    return render_template('index.html', admin=session.get('admin', False))
+def _erro_pedido(item):
+    if not isinstance(item, dict):
+        return 'Item deve ser um objeto'
+    for campo in ('nome', 'rg'):
+        if not isinstance(item.get(campo), str) or not item[campo].strip():
+            return f'Campo obrigatório: {campo}'
+    try:
+        _campos_pedido(item)
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+def _erro_id(item):
+    if not isinstance(item, dict):
+        return 'Item deve ser um objeto'
+    if not isinstance(item.get('id'), int) or isinstance(item.get('id'), bool):
+        return 'Campo obrigatório: id (inteiro)'
+    return None
+
+
+def _erro_ativo(item):
+    erro = _erro_id(item)
+    if erro:
+        return erro
+    if item.get('ativo') not in [0, 1]:
+        return 'Valor de ativo inválido'
+    return None
 
 
 # -----------------------------------------------------------
-# Página de histórico completo de pedidos
-# Apenas ADMIN pode acessar
+# Lê uma lista do corpo da requisição em lote ("chave": [...]),
+# aceitando também a lista direto no corpo. Chave ausente → [];
+# qualquer coisa que não seja lista → None (a rota responde 400)
 # -----------------------------------------------------------
-@app.route('/historico')
-def historico():
+def _lista_do_lote(data, chave):
+    if isinstance(data, list) and chave == 'pedidos':
+        return data
+    if isinstance(data, dict):
+        valor = data.get(chave)
+        if valor is None:
+            return []
+        return valor if isinstance(valor, list) else None
+    return None
 
-    # Se não estiver logado → volta ao login
-    if 'usuario' not in session:
-        return redirect(url_for('login'))
 
-    # Se não for admin → redireciona para a tela principal
-    if not session.get('admin'):
-        return redirect(url_for('index'))
+def _resposta_erros_lote(erros):
+    return jsonify({
+        'error': 'Lote inválido: nada foi gravado',
+        'resultados': erros,
+    }), 400
 
-    # Admin pode acessar o histórico
-    return render_template('historico.html', admin=True)
+
+# -----------------------------------------------------------
+# API: criar vários pedidos em uma transação
+# POST /api/pedidos/batch  {"pedidos": [{nome, rg, produto, ...}, ...]}
+# Valida tudo antes; se algum item for inválido, nada é gravado.
+# Um único executemany + um único commit (um fsync) para o lote.
+# -----------------------------------------------------------
+@app.route('/api/pedidos/batch', methods=['POST'])
+def criar_pedidos_lote():
+    itens = _lista_do_lote(request.get_json(silent=True), 'pedidos')
+    if not itens:
+        return jsonify({'error': 'Envie uma lista de pedidos'}), 400
+    if len(itens) > app.config['LOTE_MAXIMO']:
+        return jsonify({'error': f"Máximo de {app.config['LOTE_MAXIMO']} itens por lote"}), 400
+
+    erros = [{'indice': i, 'ok': False, 'error': e} for i, e in enumerate(map(_erro_pedido, itens)) if e]
+    if erros:
+        return _resposta_erros_lote(erros)
+
+    agora = int(time.time())
+    local = _epoch_para_local(agora)
+    valores = [_campos_pedido(item) + (local, local, agora, agora) for item in itens]
+
+    def inserir(conn):
+        # Com o lock de escrita, os ids do AUTOINCREMENT saem em sequência
+        linha = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'pedido'").fetchone()
+        primeiro = (linha[0] if linha else 0) + 1
+        conn.executemany(SQL_INSERIR_PEDIDO, valores)
+        return list(range(primeiro, primeiro + len(itens)))
+
+    ids = _escrever(inserir)
+    broker_eventos.publicar({'tipo': 'lote', 'pedidoids': ids, 'versao': _versao(db_connection(), 'pedido')})
+
+    return jsonify({
+        'message': f'{len(ids)} pedidos criados com sucesso!',
+        'resultados': [{'indice': i, 'ok': True, 'pedidoid': pid} for i, pid in enumerate(ids)],
+    }), 201
 
 
 # -----------------------------------------------------------
-# Rota de logout
-# Limpa totalmente a sessão e manda para o login
+# API: atualizar vários pedidos e/ou status "ativo" em uma transação
+# PATCH /api/pedidos/batch
+#   {"atualizacoes": [{id, nome, rg, produto, ...}],
+#    "ativos": [{id, ativo}]}
+# Itens inválidos cancelam o lote inteiro; ids inexistentes ou
+# arquivados (só leitura) são informados no resultado do item e o
+# resto é aplicado.
 # -----------------------------------------------------------
-@app.route('/logout')
-def logout():
-    session.clear()
-    return redirect(url_for('login'))
+@app.route('/api/pedidos/batch', methods=['PATCH'])
+def atualizar_pedidos_lote():
+    data = request.get_json(silent=True)
+    atualizacoes = _lista_do_lote(data, 'atualizacoes')
+    ativos = _lista_do_lote(data, 'ativos')
+    if atualizacoes is None or ativos is None or not (atualizacoes or ativos):
+        return jsonify({'error': 'Envie "atualizacoes" e/ou "ativos"'}), 400
+    if len(atualizacoes) + len(ativos) > app.config['LOTE_MAXIMO']:
+        return jsonify({'error': f"Máximo de {app.config['LOTE_MAXIMO']} itens por lote"}), 400
+
+    erros = [
+        {'lista': 'atualizacoes', 'indice': i, 'ok': False, 'error': e}
+        for i, e in enumerate(_erro_id(item) or _erro_pedido(item) for item in atualizacoes) if e
+    ] + [
+        {'lista': 'ativos', 'indice': i, 'ok': False, 'error': e}
+        for i, e in enumerate(map(_erro_ativo, ativos)) if e
+    ]
+    if erros:
+        return _resposta_erros_lote(erros)
+
+    agora = int(time.time())
+    local = _epoch_para_local(agora)
+    ids = {item['id'] for item in atualizacoes} | {item['id'] for item in ativos}
+    campos = [_campos_pedido(item) for item in atualizacoes]
+
+    def aplicar(conn):
+        marcadores = ','.join('?' * len(ids))
+        existentes = {
+            linha[0] for linha in
+            conn.execute(f'SELECT pedidoid FROM pedido WHERE pedidoid IN ({marcadores})', list(ids))
+        }
+        conn.executemany(SQL_ATUALIZAR_PEDIDO, [
+            campos_item[:5] + (local, campos_item[5], agora, item['id'])
+            for item, campos_item in zip(atualizacoes, campos) if item['id'] in existentes
+        ])
+        conn.executemany(SQL_ATUALIZAR_ATIVO, [
+            (item['ativo'], local, agora, item['id'])
+            for item in ativos if item['id'] in existentes
+        ])
+        return existentes
+
+    existentes = _escrever(aplicar)
+    if existentes:
+        broker_eventos.publicar({
+            'tipo': 'lote', 'pedidoids': sorted(existentes), 'versao': _versao(db_connection(), 'pedido'),
+        })
+
+    arquivados = _ids_arquivados(ids - existentes)
+
+    def resultado(lista, indice, item):
+        if item['id'] in existentes:
+            return {'lista': lista, 'indice': indice, 'ok': True, 'pedidoid': item['id']}
+        return {'lista': lista, 'indice': indice, 'ok': False, 'pedidoid': item['id'],
+                'error': ERRO_ARQUIVADO if item['id'] in arquivados else 'Pedido não encontrado'}
+
+    return jsonify({
+        'message': 'Lote processado',
+        'resultados': [resultado('atualizacoes', i, item) for i, item in enumerate(atualizacoes)]
+                      + [resultado('ativos', i, item) for i, item in enumerate(ativos)],
+    })
 
 
 # -----------------------------------------------------------
-# API: retorna lista de produtos cadastrados
+# API: resumo de pedidos e faturamento
+# Lê a tabela resumo_diario (mantida por triggers), então o custo
+# depende do número de dias, não do número de pedidos.
+# Parâmetros opcionais:
+# - de / ate  → intervalo de dias locais (AAAA-MM-DD, inclusivo)
+# - agrupar   → "dia" (padrão), "mes" ou "ano"
 # -----------------------------------------------------------
-@app.route('/api/produtos')
-def listar_produtos():
+PERIODOS_RESUMO = {'dia': 10, 'mes': 7, 'ano': 4}  # tamanho do prefixo de "dia"
+
+
+@app.route('/api/resumo', methods=['GET'])
+def resumo():
+    de = request.args.get('de')
+    ate = request.args.get('ate')
+    agrupar = request.args.get('agrupar', 'dia')
+
+    try:
+        for data in (de, ate):
+            if data:
+                datetime.strptime(data, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'Datas devem estar no formato AAAA-MM-DD'}), 400
+    if agrupar not in PERIODOS_RESUMO:
+        return jsonify({'error': 'agrupar deve ser dia, mes ou ano'}), 400
+
+    filtros, params = [], []
+    if de:
+        filtros.append('r.dia >= ?')
+        params.append(de)
+    if ate:
+        filtros.append('r.dia <= ?')
+        params.append(ate)
+    where = _where(filtros)
+
+    catalogo = _catalogo()
     conn = db_connection()
-    produtos = conn.execute('SELECT nome FROM produto').fetchall()
-    conn.close()
-    return jsonify([p['nome'] for p in produtos])
+    por_produto = {
+        r['produto']: r['quantidade'] for r in conn.execute(f"""
+            SELECT r.produto, SUM(r.quantidade) AS quantidade
+            FROM resumo_diario r{where}
+            GROUP BY r.produto
+        """, params)
+    }
+    periodos = conn.execute(f"""
+        SELECT substr(r.dia, 1, {PERIODOS_RESUMO[agrupar]}) AS periodo,
+               SUM(r.quantidade) AS quantidade,
+               SUM(r.quantidade * COALESCE(pr.preco, 0)) AS receita
+        FROM resumo_diario r
+        LEFT JOIN produto pr ON pr.produtoid = r.produto{where}
+        GROUP BY periodo
+        HAVING SUM(r.quantidade) > 0
+        ORDER BY periodo
+    """, params).fetchall()
+
+    # Produtos cadastrados primeiro (na ordem do cadastro); pedidos
+    # sem produto (ou de um produto excluído) entram no fim, com preço 0
+    # Pelo produtoid (não pelo nome): com nomes repetidos no cadastro,
+    # cada id tem o próprio item
+    itens = []
+    precos = catalogo['precos']
+    for produtoid, nome in catalogo['nomes']['nome_produto'].items():
+        quantidade = por_produto.pop(produtoid, 0)
+        itens.append({
+            'produto': nome,
+            'preco': precos[produtoid],
+            'quantidade': quantidade,
+            'receita': quantidade * precos[produtoid],
+        })
+    sem_produto = sum(por_produto.values())
+    if sem_produto:
+        itens.append({'produto': '', 'preco': 0, 'quantidade': sem_produto, 'receita': 0})
+
+    return jsonify({
+        'produtos': itens,
+        'periodos': [dict(p) for p in periodos],
+        'total': {
+            'quantidade': sum(i['quantidade'] for i in itens),
+            'receita': sum(i['receita'] for i in itens),
+        },
+    })
+
+
+# Tarefas pesadas de administração em segundo plano (/api/jobs)
+app.config['TAREFAS_THREADS'] = 1            # tarefas rodando ao mesmo tempo por processo
+app.config['TAREFAS_PENDENTES_MAXIMO'] = 20  # tarefas na fila ou rodando (todos os processos) antes do 503
+app.config['TAREFAS_DIR'] = None             # None → pasta "tarefas" ao lado do banco
+app.config['TAREFAS_BATIMENTO_S'] = 2        # intervalo mínimo entre gravações de progresso
+app.config['TAREFAS_ORFA_S'] = 60            # sem batimento por esse tempo → o worker morreu
+app.config['TAREFAS_TENTATIVAS'] = 3         # execuções de uma tarefa retomável antes de desistir
+app.config['TAREFAS_PAUSA_S'] = 0.01         # folga entre lotes para as rotas de pedidos
+app.config['TAREFAS_LOTE'] = 1000            # pedidos por lote na reindexação da busca
+app.config['TAREFAS_RETENCAO_S'] = 7 * 86400 # tarefas terminadas (e seus arquivos) apagadas depois disso
+
+STATUS_TAREFA_FINAIS = ('concluida', 'falhou', 'cancelada')
+
+
+class TarefaCancelada(Exception):
+    pass
 
 
 # -----------------------------------------------------------
-# API: retorna lista de roshs cadastrados
+# O que a função de uma tarefa recebe: o id e o progresso().
+# progresso(fração) grava o avanço e o batimento no banco (no
+# máximo a cada TAREFAS_BATIMENTO_S), lê o pedido de cancelamento
+# (que pode ter vindo por outro worker) e dá a folga entre lotes.
+# Se a tarefa não está mais "executando" (a varredura a deu como
+# órfã), também para: ela não pertence mais a este worker.
 # -----------------------------------------------------------
-@app.route('/api/roshs')
-def listar_roshs():
-    conn = db_connection()
-    roshs = conn.execute('SELECT nome FROM rosh').fetchall()
-    conn.close()
-    return jsonify([r['nome'] for r in roshs])
+class ContextoTarefa:
+
+    def __init__(self, tarefaid):
+        self.tarefaid = tarefaid
+        self._ultimo = 0
+
+    def progresso(self, fracao):
+        agora = time.monotonic()
+        if agora - self._ultimo >= app.config['TAREFAS_BATIMENTO_S']:
+            self._ultimo = agora
+            conn = db_connection()
+            linha = conn.execute("""
+                UPDATE tarefa SET progresso = ?, batimento_epoch = ?
+                WHERE tarefaid = ? AND status = 'executando'
+                RETURNING cancelar
+            """, (min(max(fracao, 0), 1), int(time.time()), self.tarefaid)).fetchone()
+            conn.commit()
+            if linha is None or linha[0]:
+                raise TarefaCancelada()
+        time.sleep(app.config['TAREFAS_PAUSA_S'])
+
+
+def _pasta_tarefas():
+    pasta = app.config['TAREFAS_DIR'] or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'tarefas')
+    os.makedirs(pasta, exist_ok=True)
+    return pasta
 
 
 # -----------------------------------------------------------
-# API: listar pedidos dos últimos 60 dias
+# Tarefa "exportar_csv": o mesmo CSV de /api/pedidos/export.csv
+# (mesmos filtros), gravado num arquivo para baixar depois.
+# Não é retomável: se o worker morrer, a tarefa falha.
 # -----------------------------------------------------------
-@app.route('/api/pedidos', methods=['GET'])
-def listar_pedidos():
+def _validar_exportacao(parametros):
+    _filtros_exportacao(parametros, _catalogo())
+
+
+def _tarefa_exportar_csv(contexto, parametros):
+    catalogo = _catalogo()
+    filtros, params = _filtros_exportacao(parametros, catalogo)
     conn = db_connection()
-    pedidos = conn.execute(
-        "SELECT * FROM pedido WHERE criacao >= DATETIME('now', '-60 days')"
-    ).fetchall()
-    conn.close()
-    return jsonify([dict(p) for p in pedidos])
+    arquivo = _anexar_arquivo(conn)
+
+    total = conn.execute(f'SELECT COUNT(*) FROM main.pedido p{_where(filtros)}', params).fetchone()[0]
+    if arquivo:
+        total += conn.execute(f'SELECT COUNT(*) FROM arquivo.pedido p{_where(filtros)}', params).fetchone()[0]
+
+    nome = f'tarefa_{contexto.tarefaid}.csv'
+    caminho = os.path.join(_pasta_tarefas(), nome)
+    linhas = 0
+    partes = _partes_csv(*_sql_exportacao(filtros, params, arquivo), catalogo, arquivo)
+    try:
+        with open(caminho + '.parcial', 'w', encoding='utf-8', newline='') as saida:
+            for texto, quantidade in partes:
+                saida.write(texto)
+                linhas += quantidade
+                contexto.progresso(linhas / total if total else 1)
+        os.replace(caminho + '.parcial', caminho)
+    finally:
+        partes.close()
+        if os.path.exists(caminho + '.parcial'):
+            os.unlink(caminho + '.parcial')
+    return {'arquivo': nome, 'linhas': linhas}
 
 
 # -----------------------------------------------------------
-# API: listar TODOS os pedidos do banco
-# (sem filtro de data)
+# Tarefa "arquivar": arquivamento sob demanda (parâmetro opcional
+# idade_dias). Retomável: os lotes são idempotentes.
+# A idade mínima é a janela de recentes: a mudança para o arquivo
+# não muda a versão "pedido", então um pedido ainda na janela
+# sumiria da listagem com a ETag antiga valendo (304).
 # -----------------------------------------------------------
-@app.route('/api/pedidos/todos', methods=['GET'])
-def listar_todos_pedidos():
-    conn = db_connection()
-    pedidos = conn.execute("SELECT * FROM pedido").fetchall()
-    conn.close()
-    return jsonify([dict(p) for p in pedidos])
+IDADE_DIAS_MAXIMA = 36500  # 100 anos; acima disso o epoch limite estoura
+
+
+def _validar_arquivamento(parametros):
+    idade = parametros.get('idade_dias')
+    if idade is None:
+        return
+    minima = app.config['JANELA_RECENTES_DIAS']
+    # "not (... <= ...)" também recusa NaN
+    if not isinstance(idade, (int, float)) or isinstance(idade, bool) or not (minima <= idade <= IDADE_DIAS_MAXIMA):
+        raise ValueError(f'idade_dias deve ser um número entre {minima} e {IDADE_DIAS_MAXIMA}')
+
+
+def _tarefa_arquivar(contexto, parametros):
+    idade_dias = parametros.get('idade_dias', app.config['ARQUIVO_IDADE_DIAS'])
+    total = db_connection().execute(
+        'SELECT COUNT(*) FROM pedido WHERE criacao_epoch < ?', (int(time.time() - idade_dias * 86400),)
+    ).fetchone()[0]
+    movidos = arquivar_pedidos_antigos(idade_dias, lambda movidos: contexto.progresso(movidos / (total or 1)))
+    return {'movidos': movidos}
 
 
 # -----------------------------------------------------------
-# API: criar um novo pedido
-# Recebe JSON no corpo do POST
+# Tarefa "reindexar_busca": refaz o índice FTS dos dois bancos em
+# faixas de pedidoid (uma transação curta por faixa), com os nomes
+# atuais do catálogo (produto renomeado passa a ser achado pelo
+# nome novo). Retomável: cada faixa é apagada e reinserida.
 # -----------------------------------------------------------
-@app.route('/api/pedido', methods=['POST'])
-def criar_pedido():
-    data = request.json
+def _tarefa_reindexar_busca(contexto, parametros):
+    selecao = ', '.join({'nome_produto': 'pr.nome', 'nome_rosh': 'r.nome'}.get(c, f'p.{c}') for c in COLUNAS_BUSCA)
+    pool = _obter_pool()
+    conn = pool.obter()
+    try:
+        arquivo = _anexar_arquivo(conn)
+        bancos = ['main'] + (['arquivo'] if arquivo else [])
+        maximo = max(
+            [conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM pedido_fts').fetchone()[0]]
+            + [conn.execute(f'SELECT COALESCE(MAX(pedidoid), 0) FROM {b}.pedido').fetchone()[0] for b in bancos]
+        )
 
-    # Extrai campos enviados pelo front-end
-    nome = data.get('nome')
-    rg = data.get('rg')
-    produto = data.get('produto')
-    rosh = data.get('rosh')
-    essencia = data.get('essencia')
-    observacao = data.get('observacao')
+        lote = app.config['TAREFAS_LOTE']
+        for inicio in range(0, maximo + 1, lote):
+            faixa = (inicio, inicio + lote)
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM pedido_fts WHERE rowid >= ? AND rowid < ?', faixa)
+            for banco in bancos:
+                conn.execute(f"""
+                    INSERT INTO pedido_fts (rowid, {', '.join(COLUNAS_BUSCA)})
+                    SELECT p.pedidoid, {selecao}
+                    FROM {banco}.pedido p
+                    LEFT JOIN main.produto pr ON pr.produtoid = p.nome_produto
+                    LEFT JOIN main.rosh r ON r.roshid = p.nome_rosh
+                    WHERE p.pedidoid >= ? AND p.pedidoid < ?
+                """, faixa)
+            conn.commit()
+            contexto.progresso(min(inicio + lote, maximo) / (maximo or 1))
 
-    conn = db_connection()
-    conn.execute("""
-        INSERT INTO pedido (name, rg, nome_produto, nome_rosh, essencia, observacao)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (nome, rg, produto, rosh, essencia, observacao))
-    conn.commit()
-    conn.close()
+        conn.execute("INSERT INTO pedido_fts (pedido_fts) VALUES ('optimize')")
+        conn.commit()
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        pool.devolver(conn)
+    return {'pedidos': maximo}
 
-    return jsonify({'message': 'Pedido criado com sucesso!'}), 201
+
+# Tipos de tarefa: função, validação dos parâmetros (lança
+# ValueError) e se pode recomeçar depois de um reinício
+TIPOS_TAREFA = {
+    'exportar_csv': {'funcao': _tarefa_exportar_csv, 'validar': _validar_exportacao, 'retomavel': False},
+    'arquivar': {'funcao': _tarefa_arquivar, 'validar': _validar_arquivamento, 'retomavel': True},
+    'reindexar_busca': {'funcao': _tarefa_reindexar_busca, 'validar': None, 'retomavel': True},
+}
 
 
 # -----------------------------------------------------------
-# API: excluir pedido pelo ID
+# Executor das tarefas: poucas threads próprias (TAREFAS_THREADS),
+# separadas das threads que atendem as requisições, então uma
+# exportação longa nunca ocupa a vez de uma estação lançando
+# pedidos. Cada processo tem o seu (recriado depois do fork).
 # -----------------------------------------------------------
-@app.route('/api/pedido/<int:pedido_id>', methods=['DELETE'])
-def deletar_pedido(pedido_id):
-    conn = db_connection()
-    conn.execute('DELETE FROM pedido WHERE pedidoid = ?', (pedido_id,))
-    conn.commit()
-    conn.close()
-    return jsonify({'message': 'Pedido excluído com sucesso'})
+_executor_tarefas = None
+_tarefas_locais = set()   # ids já entregues ao executor deste processo
+_tarefas_lock = threading.Lock()
+
+
+def _reiniciar_executor_tarefas():
+    global _executor_tarefas
+    with _tarefas_lock:
+        _executor_tarefas = None
+        _tarefas_locais.clear()
+
+
+def _submeter_tarefa(tarefaid):
+    global _executor_tarefas
+    with _tarefas_lock:
+        if tarefaid in _tarefas_locais:
+            return
+        if _executor_tarefas is None:
+            _executor_tarefas = ThreadPoolExecutor(
+                max_workers=app.config['TAREFAS_THREADS'], thread_name_prefix='tarefa'
+            )
+        _tarefas_locais.add(tarefaid)
+    _executor_tarefas.submit(_executar_tarefa, tarefaid)
 
 
 # -----------------------------------------------------------
-# API: atualizar o status "ativo" de um pedido (checkbox)
-# Apenas aceita valores 0 ou 1
+# Batimento independente do progresso(): enquanto a função da
+# tarefa roda, uma thread renova batimento_epoch a cada quarto de
+# TAREFAS_ORFA_S. Assim um passo longo sem progresso (COUNT(*)
+# inicial, 'optimize' do FTS) não faz a tarefa parecer órfã para
+# a varredura dos outros workers. Usa uma conexão própria do pool.
 # -----------------------------------------------------------
-@app.route('/api/pedido/<int:pedido_id>/ativo', methods=['PUT'])
-def atualizar_ativo(pedido_id):
-    print(f"Received PUT request for pedido_id: {pedido_id}")
+def _manter_batimento(tarefaid, parar):
+    pool = _obter_pool()
+    while not parar.wait(app.config['TAREFAS_ORFA_S'] / 4):
+        conn = pool.obter()
+        try:
+            conn.execute(
+                "UPDATE tarefa SET batimento_epoch = ? WHERE tarefaid = ? AND status = 'executando'",
+                (int(time.time()), tarefaid)
+            )
+            conn.commit()
+        except sqlite3.Error:
+            app.logger.exception('Falha ao renovar o batimento da tarefa %s', tarefaid)
+        finally:
+            pool.devolver(conn)
 
-    data = request.json
-    ativo = data.get('ativo')
 
-    # Validação: apenas 0 ou 1 são permitidos
-    if ativo not in [0, 1]:
-        return jsonify({'error': 'Valor de ativo inválido'}), 400
+def _apagar_resultado(resultado):
+    if resultado and resultado.get('arquivo'):
+        try:
+            os.unlink(os.path.join(_pasta_tarefas(), resultado['arquivo']))
+        except FileNotFoundError:
+            pass
+
+
+# -----------------------------------------------------------
+# Roda uma tarefa no executor. O UPDATE condicional reserva a
+# tarefa: se ela foi cancelada antes de começar ou outro processo
+# já a pegou, não faz nada. O estado final também só é gravado se
+# a tarefa ainda está "executando" (não foi dada como órfã).
+# -----------------------------------------------------------
+def _executar_tarefa(tarefaid):
+    try:
+        with app.app_context():
+            conn = db_connection()
+            agora = int(time.time())
+            reservada = conn.execute("""
+                UPDATE tarefa
+                SET status = 'executando', inicio_epoch = ?, batimento_epoch = ?, tentativas = tentativas + 1
+                WHERE tarefaid = ? AND status = 'pendente'
+            """, (agora, agora, tarefaid)).rowcount
+            conn.commit()
+            if not reservada:
+                return
+
+            tarefa = conn.execute('SELECT tipo, parametros FROM tarefa WHERE tarefaid = ?', (tarefaid,)).fetchone()
+            resultado, mensagem = None, None
+            parar = threading.Event()
+            batimento = threading.Thread(
+                target=_manter_batimento, args=(tarefaid, parar), name=f'tarefa-{tarefaid}-batimento', daemon=True
+            )
+            batimento.start()
+            try:
+                resultado = TIPOS_TAREFA[tarefa['tipo']]['funcao'](
+                    ContextoTarefa(tarefaid), app.json.loads(tarefa['parametros'])
+                )
+                status = 'concluida'
+            except TarefaCancelada:
+                status, mensagem = 'cancelada', 'Cancelada pelo administrador'
+            except Exception as e:
+                app.logger.exception('Falha na tarefa %s', tarefaid)
+                status, mensagem = 'falhou', str(e)
+            finally:
+                parar.set()
+                batimento.join()
 
+            gravada = conn.execute("""
+                UPDATE tarefa
+                SET status = ?, mensagem = ?, resultado = ?, fim_epoch = ?,
+                    progresso = CASE WHEN ? = 'concluida' THEN 1 ELSE progresso END
+                WHERE tarefaid = ? AND status = 'executando'
+            """, (status, mensagem, None if resultado is None else app.json.dumps(resultado),
+                  int(time.time()), status, tarefaid)).rowcount
+            conn.commit()
+            if not gravada:
+                # Dada como órfã no meio do caminho: o estado que vale
+                # é o da varredura, e o arquivo gerado não é de ninguém
+                _apagar_resultado(resultado)
+    finally:
+        with _tarefas_lock:
+            _tarefas_locais.discard(tarefaid)
+
+
+# -----------------------------------------------------------
+# Tarefas de um worker que morreu (sem batimento há TAREFAS_ORFA_S):
+# as retomáveis voltam para a fila, as outras são marcadas como
+# falhas. Pendentes paradas também são entregues a este processo
+# (a reserva em _executar_tarefa evita rodar duas vezes).
+# Tarefas terminadas há mais de TAREFAS_RETENCAO_S são apagadas,
+# junto com o arquivo de resultado.
+# -----------------------------------------------------------
+def recuperar_tarefas():
     conn = db_connection()
-    conn.execute(
-        "UPDATE pedido SET ativo = ?, atualizacao = ? WHERE pedidoid = ?",
-        (ativo, datetime.now(), pedido_id)
-    )
+    limite = int(time.time()) - app.config['TAREFAS_ORFA_S']
+
+    expiradas = conn.execute(
+        f"DELETE FROM tarefa WHERE status IN ({', '.join('?' * len(STATUS_TAREFA_FINAIS))}) AND fim_epoch < ? "
+        "RETURNING resultado",
+        STATUS_TAREFA_FINAIS + (int(time.time()) - app.config['TAREFAS_RETENCAO_S'],)
+    ).fetchall()
     conn.commit()
-    conn.close()
+    for linha in expiradas:
+        _apagar_resultado(app.json.loads(linha['resultado']) if linha['resultado'] else None)
 
-    return jsonify({'message': 'Status atualizado com sucesso'}), 200
+    for tarefa in conn.execute("""
+        SELECT tarefaid, tipo, tentativas FROM tarefa
+        WHERE status = 'executando' AND batimento_epoch < ?
+    """, (limite,)).fetchall():
+        tipo = TIPOS_TAREFA.get(tarefa['tipo'])
+        if tipo and tipo['retomavel'] and tarefa['tentativas'] < app.config['TAREFAS_TENTATIVAS']:
+            novo = ('pendente', 'Retomada após reinício do servidor', None)
+        else:
+            novo = ('falhou', 'Interrompida por reinício do servidor', int(time.time()))
+        conn.execute("""
+            UPDATE tarefa SET status = ?, mensagem = ?, fim_epoch = ?
+            WHERE tarefaid = ? AND status = 'executando' AND batimento_epoch < ?
+        """, novo + (tarefa['tarefaid'], limite))
+    conn.commit()
+
+    for tarefa in conn.execute("SELECT tarefaid FROM tarefa WHERE status = 'pendente'").fetchall():
+        _submeter_tarefa(tarefa['tarefaid'])
 
 
 # -----------------------------------------------------------
-# API: atualizar um pedido inteiro (PUT)
+# Na subida do processo (e a cada TAREFAS_ORFA_S), recupera as
+# tarefas órfãs. Chamada pelo __main__ e pelo serve.py.
 # -----------------------------------------------------------
-@app.route('/api/pedido/<int:pedido_id>', methods=['PUT'])
-def atualizar_pedido(pedido_id):
-    data = request.json
+def iniciar_tarefas():
+    def rodar():
+        while True:
+            try:
+                with app.app_context():
+                    recuperar_tarefas()
+            except Exception:
+                app.logger.exception('Falha ao recuperar tarefas')
+            time.sleep(app.config['TAREFAS_ORFA_S'])
 
-    # Extrai os dados enviados pelo front-end
-    nome = data.get('nome')
-    rg = data.get('rg')
-    produto = data.get('produto')
-    rosh = data.get('rosh')
-    essencia = data.get('essencia')
-    observacao = data.get('observacao')
+    threading.Thread(target=rodar, name='tarefas', daemon=True).start()
 
-    conn = db_connection()
-    conn.execute("""
-        UPDATE pedido
-        SET name = ?, rg = ?, nome_produto = ?, nome_rosh = ?, essencia = ?, atualizacao = ?, observacao = ?
-        WHERE pedidoid = ?
-    """, (nome, rg, produto, rosh, essencia, datetime.now(), observacao, pedido_id))
-    conn.commit()
-    conn.close()
 
-    return jsonify({'message': 'Pedido atualizado com sucesso'})
+def _tarefa_json(linha):
+    resultado = app.json.loads(linha['resultado']) if linha['resultado'] else None
+    return {
+        'id': linha['tarefaid'],
+        'tipo': linha['tipo'],
+        'parametros': app.json.loads(linha['parametros']),
+        'status': linha['status'],
+        'progresso': round(linha['progresso'], 4),
+        'mensagem': linha['mensagem'],
+        'resultado': resultado,
+        'resultado_url': (
+            url_for('baixar_resultado_tarefa', tarefaid=linha['tarefaid'])
+            if resultado and 'arquivo' in resultado else None
+        ),
+        'cancelamento_pedido': bool(linha['cancelar']),
+        'usuario': linha['usuario'],
+        'criacao': _epoch_para_local(linha['criacao_epoch']),
+        'inicio': _epoch_para_local(linha['inicio_epoch']) if linha['inicio_epoch'] else None,
+        'fim': _epoch_para_local(linha['fim_epoch']) if linha['fim_epoch'] else None,
+    }
+
+
+def _buscar_tarefa(tarefaid):
+    return db_connection().execute('SELECT * FROM tarefa WHERE tarefaid = ?', (tarefaid,)).fetchone()
+
+
+# -----------------------------------------------------------
+# API de tarefas (somente ADMIN)
+# POST /api/jobs                 {"tipo": "...", "parametros": {...}} → 202
+# GET  /api/jobs[?status=...]    últimas tarefas
+# GET  /api/jobs/<id>            estado e progresso (polling)
+# POST /api/jobs/<id>/cancel     cancela (na hora se ainda não começou)
+# GET  /api/jobs/<id>/resultado  baixa o arquivo gerado
+# -----------------------------------------------------------
+@app.before_request
+def _tarefas_somente_admin():
+    if request.path.startswith('/api/jobs') and not session.get('admin'):
+        return jsonify({'error': 'Acesso restrito ao administrador'}), 403
+
+
+@app.route('/api/jobs', methods=['POST'])
+def criar_tarefa():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Corpo deve ser um objeto JSON'}), 400
+    # Só texto: um tipo não hashable (lista, objeto) quebraria o .get
+    tipo = TIPOS_TAREFA.get(data.get('tipo')) if isinstance(data.get('tipo'), str) else None
+    if tipo is None:
+        return jsonify({'error': f"tipo deve ser um de: {', '.join(TIPOS_TAREFA)}"}), 400
+    parametros = data.get('parametros') or {}
+    if not isinstance(parametros, dict):
+        return jsonify({'error': 'parametros deve ser um objeto'}), 400
+    try:
+        if tipo['validar']:
+            tipo['validar'](parametros)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def inserir(conn):
+        ocupadas = conn.execute(
+            "SELECT COUNT(*) FROM tarefa WHERE status IN ('pendente', 'executando')"
+        ).fetchone()[0]
+        if ocupadas >= app.config['TAREFAS_PENDENTES_MAXIMO']:
+            return None
+        return conn.execute(
+            'INSERT INTO tarefa (tipo, parametros, usuario, criacao_epoch) VALUES (?, ?, ?, ?)',
+            (data['tipo'], app.json.dumps(parametros), session.get('usuario'), int(time.time()))
+        ).lastrowid
+
+    tarefaid = _escrever(inserir)
+    if tarefaid is None:
+        resposta = jsonify({'error': 'Muitas tarefas na fila, tente mais tarde'})
+        resposta.status_code = 503
+        resposta.headers['Retry-After'] = '30'
+        return resposta
+
+    _submeter_tarefa(tarefaid)
+    resposta = jsonify(_tarefa_json(_buscar_tarefa(tarefaid)))
+    resposta.status_code = 202
+    resposta.headers['Location'] = url_for('obter_tarefa', tarefaid=tarefaid)
+    return resposta
+
+
+@app.route('/api/jobs', methods=['GET'])
+def listar_tarefas():
+    try:
+        limite = min(int(request.args.get('limit', 50)), app.config['PAGINA_LIMITE_MAXIMO'])
+    except ValueError:
+        return jsonify({'error': 'limit deve ser um número inteiro'}), 400
+
+    filtros, params = [], []
+    if request.args.get('status'):
+        filtros.append('status = ?')
+        params.append(request.args['status'])
+    linhas = db_connection().execute(
+        f'SELECT * FROM tarefa{_where(filtros)} ORDER BY tarefaid DESC LIMIT ?', params + [limite]
+    ).fetchall()
+    return jsonify({'tarefas': [_tarefa_json(linha) for linha in linhas]})
+
+
+@app.route('/api/jobs/<int:tarefaid>', methods=['GET'])
+def obter_tarefa(tarefaid):
+    linha = _buscar_tarefa(tarefaid)
+    if linha is None:
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+    return jsonify(_tarefa_json(linha))
+
+
+@app.route('/api/jobs/<int:tarefaid>/cancel', methods=['POST'])
+def cancelar_tarefa(tarefaid):
+    def cancelar(conn):
+        # Pendente: cancela na hora. Executando: a própria tarefa para
+        # no próximo progresso() (pode estar em outro processo).
+        conn.execute("""
+            UPDATE tarefa
+            SET status = CASE WHEN status = 'pendente' THEN 'cancelada' ELSE status END,
+                fim_epoch = CASE WHEN status = 'pendente' THEN ? ELSE fim_epoch END,
+                cancelar = 1
+            WHERE tarefaid = ? AND status IN ('pendente', 'executando')
+        """, (int(time.time()), tarefaid))
+
+    linha = _buscar_tarefa(tarefaid)
+    if linha is None:
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+    if linha['status'] in STATUS_TAREFA_FINAIS:
+        return jsonify({'error': f"Tarefa já terminou ({linha['status']})"}), 409
+
+    _escrever(cancelar)
+    return jsonify(_tarefa_json(_buscar_tarefa(tarefaid))), 202
+
+
+@app.route('/api/jobs/<int:tarefaid>/resultado', methods=['GET'])
+def baixar_resultado_tarefa(tarefaid):
+    linha = _buscar_tarefa(tarefaid)
+    if linha is None:
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+    resultado = app.json.loads(linha['resultado']) if linha['resultado'] else {}
+    caminho = os.path.join(_pasta_tarefas(), resultado.get('arquivo') or '')
+    if linha['status'] != 'concluida' or not resultado.get('arquivo') or not os.path.exists(caminho):
+        return jsonify({'error': 'Tarefa sem arquivo de resultado'}), 409
+    return send_file(caminho, mimetype='text/csv', as_attachment=True,
+                     download_name=f'pedidos_tarefa_{tarefaid}.csv')
+
+
+# Proteção do login: cada check_password_hash (scrypt) custa dezenas
+# de ms de CPU e bastante memória, então as tentativas passam por
+# baldes de tokens (por IP e por usuário) e um limite de verificações
+# simultâneas antes de chegar ao hash
+app.config['LOGIN_HASH_METODO'] = 'scrypt:32768:8:1'  # hashes em outro formato são refeitos no próximo login
+app.config['LOGIN_IP_RAJADA'] = 20                  # tentativas seguidas por IP
+app.config['LOGIN_IP_POR_MINUTO'] = 10              # reposição do balde por IP
+app.config['LOGIN_USUARIO_RAJADA'] = 10             # tentativas seguidas por nome de usuário
+app.config['LOGIN_USUARIO_POR_MINUTO'] = 5          # reposição do balde por usuário
+app.config['LOGIN_HASHES_SIMULTANEOS'] = 2          # verificações de senha em paralelo por processo
+app.config['LOGIN_ESPERA_HASH_S'] = 2               # espera por uma vaga de verificação antes do 429
+app.config['LOGIN_DESCONHECIDOS_TTL_S'] = 300       # validade do cache de usuários inexistentes
+app.config['LOGIN_CHAVES_MAXIMO'] = 10000           # chaves guardadas em memória (baldes e cache)
+
+
+# -----------------------------------------------------------
+# Baldes de tokens por chave (IP ou nome de usuário).
+# Cada tentativa gasta um token; o balde se repõe a "por_minuto"
+# tokens por minuto até "rajada". Guarda no máximo
+# LOGIN_CHAVES_MAXIMO chaves, descartando as usadas há mais tempo.
+# -----------------------------------------------------------
+class LimitadorTentativas:
+
+    def __init__(self):
+        self._baldes = OrderedDict()  # chave → (tokens, instante)
+        self._lock = threading.Lock()
+
+    # Retorna 0 se a tentativa pode seguir, ou os segundos até o próximo token
+    def consumir(self, chave, rajada, por_minuto):
+        agora = time.monotonic()
+        taxa = por_minuto / 60
+        with self._lock:
+            tokens, instante = self._baldes.pop(chave, (rajada, agora))
+            tokens = min(rajada, tokens + (agora - instante) * taxa)
+            if tokens >= 1:
+                tokens -= 1
+                espera = 0
+            else:
+                espera = (1 - tokens) / taxa
+            self._baldes[chave] = (tokens, agora)
+            while len(self._baldes) > app.config['LOGIN_CHAVES_MAXIMO']:
+                self._baldes.popitem(last=False)
+        return espera
+
+    def limpar(self):
+        with self._lock:
+            self._baldes.clear()
+
+
+limitador_ip = LimitadorTentativas()
+limitador_usuario = LimitadorTentativas()
+
+
+# -----------------------------------------------------------
+# Cache negativo: nomes que não existem na tabela user, para não
+# ir ao banco a cada tentativa com o mesmo nome. Como não há
+# cadastro de usuários pela aplicação, um TTL curto basta.
+# -----------------------------------------------------------
+_usuarios_desconhecidos = OrderedDict()  # nome → expira em (monotonic)
+_usuarios_desconhecidos_lock = threading.Lock()
+
+
+def _usuario_desconhecido(nome):
+    with _usuarios_desconhecidos_lock:
+        expira = _usuarios_desconhecidos.get(nome)
+        if expira is not None and expira < time.monotonic():
+            del _usuarios_desconhecidos[nome]
+            expira = None
+        return expira is not None
+
+
+def _marcar_desconhecido(nome):
+    with _usuarios_desconhecidos_lock:
+        _usuarios_desconhecidos.pop(nome, None)
+        _usuarios_desconhecidos[nome] = time.monotonic() + app.config['LOGIN_DESCONHECIDOS_TTL_S']
+        while len(_usuarios_desconhecidos) > app.config['LOGIN_CHAVES_MAXIMO']:
+            _usuarios_desconhecidos.popitem(last=False)
+
+
+# -----------------------------------------------------------
+# Verificação de senha com limite de paralelismo.
+# O tempo médio de uma verificação real é acompanhado (média
+# móvel) para que um usuário inexistente demore o mesmo tanto:
+# a resposta não revela quais nomes existem, mas a espera é um
+# sleep, sem gastar CPU com um hash de mentira.
+# -----------------------------------------------------------
+_semaforo_hash = None
+_semaforo_hash_lock = threading.Lock()
+_tempo_medio_hash = 0.05
+
+
+def _obter_semaforo_hash():
+    global _semaforo_hash
+    with _semaforo_hash_lock:
+        limite = app.config['LOGIN_HASHES_SIMULTANEOS']
+        if _semaforo_hash is None or _semaforo_hash[0] != limite:
+            _semaforo_hash = (limite, threading.BoundedSemaphore(limite))
+        return _semaforo_hash[1]
+
+
+# Retorna True/False, ou None se não houve vaga para verificar a tempo
+def _verificar_senha(senha_hash, senha):
+    global _tempo_medio_hash
+    semaforo = _obter_semaforo_hash()
+    if not semaforo.acquire(timeout=app.config['LOGIN_ESPERA_HASH_S']):
+        return None
+    try:
+        inicio = time.perf_counter()
+        correta = check_password_hash(senha_hash, senha)
+        _tempo_medio_hash = 0.8 * _tempo_medio_hash + 0.2 * (time.perf_counter() - inicio)
+    finally:
+        semaforo.release()
+    return correta
+
+
+# Hash gravado com parâmetros diferentes de LOGIN_HASH_METODO?
+def _hash_desatualizado(senha_hash):
+    return senha_hash.split('$', 1)[0] != app.config['LOGIN_HASH_METODO']
+
+
+# -----------------------------------------------------------
+# Resposta para tentativas barradas pelos limites: a própria
+# página de login com 429 e Retry-After
+# -----------------------------------------------------------
+def _muitas_tentativas(espera):
+    flash('Muitas tentativas de login. Aguarde e tente novamente.')
+    resposta = Response(render_template('Login.html'), status=429)
+    resposta.headers['Retry-After'] = str(max(1, math.ceil(espera)))
+    return resposta
 
 
 # -----------------------------------------------------------
@@ -231,15 +3516,42 @@ def login():
         nome = request.form['usuario']
         senha = request.form['senha']
 
-        conn = db_connection()
-        user = conn.execute(
-            'SELECT * FROM user WHERE nome = ?',
-            (nome,)
-        ).fetchone()
-        conn.close()
+        # Limites por IP e por usuário antes de qualquer trabalho caro
+        espera = limitador_ip.consumir(
+            request.remote_addr, app.config['LOGIN_IP_RAJADA'], app.config['LOGIN_IP_POR_MINUTO']
+        ) or limitador_usuario.consumir(
+            nome, app.config['LOGIN_USUARIO_RAJADA'], app.config['LOGIN_USUARIO_POR_MINUTO']
+        )
+        if espera:
+            return _muitas_tentativas(espera)
+
+        user = None
+        if not _usuario_desconhecido(nome):
+            conn = db_connection()
+            user = conn.execute(
+                'SELECT * FROM user WHERE nome = ?',
+                (nome,)
+            ).fetchone()
+            if user is None:
+                _marcar_desconhecido(nome)
+
+        if user is None:
+            time.sleep(_tempo_medio_hash)  # mesmo tempo de uma senha errada
+            correta = False
+        else:
+            correta = _verificar_senha(user['senha'], senha)
+            if correta is None:
+                return _muitas_tentativas(1)
 
         # Se usuário existe e senha está correta
-        if user and check_password_hash(user['senha'], senha):
+        if correta:
+            # Regrava o hash com os parâmetros atuais, se mudaram
+            if _hash_desatualizado(user['senha']):
+                novo_hash = generate_password_hash(senha, method=app.config['LOGIN_HASH_METODO'])
+                _escrever(lambda c: c.execute(
+                    'UPDATE user SET senha = ? WHERE userid = ?', (novo_hash, user['userid'])
+                ))
+
             session.permanent = True
             session['usuario'] = user['nome']
             session['admin'] = bool(user['admin'])  # Pode ser admin = True/False
@@ -255,7 +3567,136 @@ def login():
 
 
 # -----------------------------------------------------------
-# Execução do servidor Flask
+# Rota /metrics no formato texto do Prometheus. Além dos
+# acumuladores, traz o tamanho do banco principal, do WAL e do
+# arquivo de pedidos antigos. Cada processo responde com os seus
+# números (rótulo "pid"); o Prometheus soma as séries.
+# -----------------------------------------------------------
+def _rotulos(**valores):
+    partes = []
+    for nome, valor in valores.items():
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        partes.append(f'{nome}="{valor}"')
+    return '{' + ','.join(partes) + '}'
+
+
+def _tamanho(caminho):
+    try:
+        return os.path.getsize(caminho)
+    except OSError:
+        return 0
+
+
+def _texto_metricas():
+    pid = os.getpid()
+    with metricas._lock:
+        em_andamento = metricas.em_andamento
+        requisicoes = {chave: list(serie) for chave, serie in metricas.requisicoes.items()}
+        consultas = {sql: list(serie) for sql, serie in metricas.sql.items()}
+
+    linhas = [
+        '# HELP fumaca_requisicao_segundos Latência das requisições por rota.',
+        '# TYPE fumaca_requisicao_segundos histogram',
+    ]
+    for (endpoint, metodo, status), serie in sorted(requisicoes.items()):
+        base = dict(endpoint=endpoint, metodo=metodo, status=status, pid=pid)
+        acumulado = 0
+        for limite, contagem in zip(FAIXAS_LATENCIA_S + ('+Inf',), serie):
+            acumulado += contagem
+            linhas.append(f'fumaca_requisicao_segundos_bucket{_rotulos(**base, le=limite)} {acumulado}')
+        linhas.append(f'fumaca_requisicao_segundos_sum{_rotulos(**base)} {serie[-2]:.6f}')
+        linhas.append(f'fumaca_requisicao_segundos_count{_rotulos(**base)} {serie[-1]}')
+
+    linhas += [
+        '# HELP fumaca_requisicoes_em_andamento Requisições sendo atendidas agora.',
+        '# TYPE fumaca_requisicoes_em_andamento gauge',
+        f'fumaca_requisicoes_em_andamento{_rotulos(pid=pid)} {em_andamento}',
+    ]
+
+    for indice, nome, tipo, ajuda in (
+        (0, 'fumaca_sql_execucoes_total', 'counter', 'Execuções de cada consulta SQL (normalizada).'),
+        (1, 'fumaca_sql_segundos_total', 'counter', 'Tempo gasto em cada consulta, incluindo a leitura das linhas.'),
+        (2, 'fumaca_sql_linhas_total', 'counter', 'Linhas devolvidas por cada consulta.'),
+        (3, 'fumaca_sql_erros_total', 'counter', 'Execuções que terminaram em erro do SQLite.'),
+    ):
+        linhas += [f'# HELP {nome} {ajuda}', f'# TYPE {nome} {tipo}']
+        for sql, serie in sorted(consultas.items()):
+            valor = f'{serie[indice]:.6f}' if indice == 1 else serie[indice]
+            linhas.append(f'{nome}{_rotulos(sql=sql, pid=pid)} {valor}')
+
+    linhas += [
+        '# HELP fumaca_banco_bytes Tamanho em disco dos arquivos do banco.',
+        '# TYPE fumaca_banco_bytes gauge',
+    ]
+    for arquivo, caminho in (
+        ('principal', DB_PATH),
+        ('wal', DB_PATH + '-wal'),
+        ('arquivo', _caminho_arquivo()),
+    ):
+        linhas.append(f'fumaca_banco_bytes{_rotulos(arquivo=arquivo, pid=pid)} {_tamanho(caminho)}')
+
+    return '\n'.join(linhas) + '\n'
+
+
+@app.route('/metrics')
+def metrics():
+    if not app.config['METRICAS_ATIVAS']:
+        return jsonify({'error': 'Métricas desativadas'}), 404
+    return Response(_texto_metricas(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# -----------------------------------------------------------
+# Diagnóstico (somente ADMIN): consultas que mais consumiram
+# tempo no processo, com o plano de execução das que passaram
+# do limite de lentidão (CONSULTAS_LENTAS_MS) e as tabelas lidas
+# por inteiro, sem índice. Parâmetro opcional: limit.
+# -----------------------------------------------------------
+@app.route('/api/diagnostico/consultas', methods=['GET'])
+def diagnostico_consultas():
+    if not session.get('admin'):
+        return jsonify({'error': 'Acesso restrito ao administrador'}), 403
+
+    try:
+        limite = int(request.args.get('limit', app.config['CONSULTAS_LENTAS_TOP']))
+    except ValueError:
+        return jsonify({'error': 'limit deve ser um número inteiro'}), 400
+
+    with metricas._lock:
+        consultas = {sql: list(serie) for sql, serie in metricas.sql.items()}
+    with consultas_lentas._lock:
+        lentas = {sql: dict(registro) for sql, registro in consultas_lentas.registros.items()}
+
+    mais_lentas = sorted(consultas.items(), key=lambda item: item[1][1], reverse=True)[:max(limite, 0)]
+    resultado = []
+    for sql, (execucoes, segundos, linhas, erros) in mais_lentas:
+        lenta = lentas.get(sql, {})
+        resultado.append({
+            'sql': sql,
+            'execucoes': execucoes,
+            'total_ms': round(segundos * 1000, 3),
+            'media_ms': round(segundos * 1000 / execucoes, 3) if execucoes else 0,
+            'linhas': linhas,
+            'erros': erros,
+            'lentas': lenta.get('lentas', 0),
+            'maior_lenta_ms': round(lenta.get('maior_segundos', 0) * 1000, 3),
+            'parametros': lenta.get('parametros'),
+            'plano': lenta.get('plano'),
+            'varreduras_completas': varreduras_completas(lenta.get('plano')),
+        })
+
+    return jsonify({
+        'limite_lenta_ms': app.config['CONSULTAS_LENTAS_MS'],
+        'pid': os.getpid(),
+        'consultas': resultado,
+    })
+
+
+# -----------------------------------------------------------
+# Execução do servidor Flask (desenvolvimento, um processo).
+# Em produção use "python serve.py" (vários processos e threads).
 # -----------------------------------------------------------
 if __name__ == '__main__':
+    preparar_estaticos()
+    iniciar_arquivamento_automatico()
+    iniciar_tarefas()
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,389 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from werkzeug.security import generate_password_hash
+
+import app as app_module
+from app import app
+
+
+# -----------------------------------------------------------
+# Benchmark das rotas da API com dados sintéticos.
+#
+# Gera um banco com meses de pedidos (todos os produtos e roshs,
+# movimento concentrado à noite), mede cada rota pelo test client
+# do Flask e grava os resultados em JSON (p50/p95/p99, linhas/s,
+# pico de alocações Python de cada rota). Com --comparar, aponta as
+# rotas que ficaram mais lentas que a execução anterior.
+#
+#   python benchmark.py --linhas 100k --saida bench.json
+#   python benchmark.py --linhas 100k --comparar bench.json
+#
+# O banco gerado fica em cache (--dir) e cada execução mede uma
+# cópia dele, pois as rotas de escrita alteram os dados.
+# -----------------------------------------------------------
+
+NOMES = ['Ana', 'Bruno', 'Carla', 'Diego', 'Eduarda', 'Felipe', 'Gabriela', 'Henrique',
+         'Isabela', 'João', 'Larissa', 'Marcos', 'Natália', 'Otávio', 'Paula', 'Rafael']
+SOBRENOMES = ['Silva', 'Souza', 'Oliveira', 'Santos', 'Pereira', 'Lima', 'Costa',
+              'Almeida', 'Ferreira', 'Rodrigues', 'Mendonça', 'Araújo']
+ROSHS = ['Mix', 'Único']
+ESSENCIAS = ['Uva', 'Menta', 'Melancia', 'Pêssego', 'Limão', 'Morango', 'Maracujá', 'Blueberry']
+OBSERVACOES = ['', '', '', 'Mesa externa', 'Trocar carvão', 'Sem gelo', 'Aniversário']
+
+# Pedidos recentes "editados" depois da carga, para o contador de
+# versão andar e /api/pedidos/changes ter o que devolver
+ALTERADOS = 200
+
+# Chance de um pedido sair em cada hora do dia (a casa enche à noite)
+PESO_HORAS = [4, 3, 2, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 2, 3, 5, 7, 8, 9, 9, 7]
+
+ESQUEMA = """
+    CREATE TABLE produto (produtoid INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT);
+    CREATE TABLE rosh (roshid INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT);
+    CREATE TABLE pedido (
+        pedidoid INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        rg TEXT NOT NULL,
+        nome_produto INTEGER,
+        nome_rosh INTEGER,
+        essencia TEXT,
+        criacao DATETIME DEFAULT (DATETIME('now', '-3 hours')),
+        atualizacao DATETIME DEFAULT (DATETIME('now', '-3 hours')),
+        observacao TEXT,
+        ativo INTEGER DEFAULT 0
+    );
+    CREATE TABLE user (
+        userid INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT NOT NULL,
+        senha TEXT NOT NULL,
+        admin INTEGER DEFAULT 0
+    );
+"""
+
+
+# "10k" → 10000, "2M" → 2000000
+def quantidade(texto):
+    multiplicador = {'k': 1_000, 'm': 1_000_000}.get(texto[-1].lower(), 1)
+    numero = texto[:-1] if multiplicador > 1 else texto
+    return int(float(numero) * multiplicador)
+
+
+# -----------------------------------------------------------
+# Gerador de pedidos sintéticos: "linhas" pedidos espalhados
+# pelos últimos "meses", em ordem de criação (como na casa).
+# Só os pedidos das últimas horas podem estar ativos.
+# -----------------------------------------------------------
+def gerar_pedidos(linhas, meses, semente):
+    aleatorio = random.Random(semente)
+    produtos = list(app_module.PRECOS_INICIAIS)
+    pesos_produto = [30, 35, 20, 10, 5][:len(produtos)]
+    fuso = timezone(timedelta(hours=app.config['FUSO_HORARIO_HORAS']))
+    agora = datetime.now(fuso).replace(microsecond=0)
+    inicio = agora - timedelta(days=30 * meses)
+    dias = (agora - inicio).days or 1
+    horas = range(24)
+
+    for i in range(linhas):
+        dia = inicio + timedelta(days=i * dias // linhas)
+        instante = dia.replace(
+            hour=aleatorio.choices(horas, PESO_HORAS)[0],
+            minute=aleatorio.randrange(60), second=aleatorio.randrange(60),
+        )
+        instante = min(instante, agora)
+        texto = instante.strftime('%Y-%m-%d %H:%M:%S')
+        recente = agora - instante < timedelta(hours=4)
+        yield (
+            f'{aleatorio.choice(NOMES)} {aleatorio.choice(SOBRENOMES)}',
+            str(aleatorio.randrange(10_000_000, 99_999_999)),
+            aleatorio.choices(produtos, pesos_produto)[0],
+            aleatorio.choice(ROSHS),
+            aleatorio.choice(ESSENCIAS),
+            texto,
+            texto,
+            aleatorio.choice(OBSERVACOES),
+            int(recente and aleatorio.random() < 0.5),
+        )
+
+
+# -----------------------------------------------------------
+# Cria (ou reaproveita) o banco sintético e aplica as migrações
+# do app. As linhas entram antes das migrações, que fazem o
+# backfill de epoch, resumo e busca de uma vez (bem mais rápido
+# que disparar os triggers linha a linha).
+# -----------------------------------------------------------
+def gerar_banco(caminho, linhas, meses, semente):
+    if os.path.exists(caminho):
+        return caminho
+
+    temporario = caminho + '.gerando'
+    if os.path.exists(temporario):
+        os.unlink(temporario)
+
+    conn = sqlite3.connect(temporario)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.executescript(ESQUEMA)
+    conn.executemany('INSERT INTO produto (nome) VALUES (?)', [(p,) for p in app_module.PRECOS_INICIAIS])
+    conn.executemany('INSERT INTO rosh (nome) VALUES (?)', [(r,) for r in ROSHS])
+    senha = generate_password_hash('admin123', method=app.config['LOGIN_HASH_METODO'])
+    conn.execute("INSERT INTO user (nome, senha, admin) VALUES ('adm', ?, 1)", (senha,))
+    conn.executemany("""
+        INSERT INTO pedido (name, rg, nome_produto, nome_rosh, essencia, criacao, atualizacao, observacao, ativo)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, gerar_pedidos(linhas, meses, semente))
+    conn.commit()
+    conn.close()
+
+    conn = app_module._abrir_conexao(temporario)
+    app_module.migrar_esquema(conn)
+    # O backfill deixa todos na versão 0; o UPDATE passa pelo trigger
+    # de versão, como uma edição feita pela tela
+    conn.execute('UPDATE pedido SET ativo = ativo WHERE pedidoid > (SELECT MAX(pedidoid) FROM pedido) - ?',
+                 (ALTERADOS,))
+    conn.commit()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+
+    os.replace(temporario, caminho)
+    return caminho
+
+
+# -----------------------------------------------------------
+# Quantas linhas (pedidos) vieram na resposta, para linhas/s
+# -----------------------------------------------------------
+def contar_linhas(resposta):
+    if resposta.mimetype == 'application/x-ndjson':
+        blocos = [json.loads(l) for l in resposta.get_data(as_text=True).splitlines() if l]
+        return sum(b.get('linhas', 1) if isinstance(b, dict) and 'colunas' in b else 1 for b in blocos)
+    if not resposta.is_json:
+        return 0
+    dados = resposta.get_json()
+    if isinstance(dados, dict) and 'colunas' not in dados:
+        dados = dados.get('pedidos', dados.get('alterados', []))
+    if isinstance(dados, dict):
+        return dados.get('linhas', 0)  # formato colunar
+    return len(dados) if isinstance(dados, list) else 0
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    if len(ordenados) == 1:
+        return ordenados[0]
+    return statistics.quantiles(ordenados, n=100, method='inclusive')[p - 1]
+
+
+# -----------------------------------------------------------
+# Pico das alocações Python de uma requisição, medido com
+# tracemalloc numa chamada a mais, fora das repetições cronometradas
+# (o tracemalloc deixa tudo mais lento). Não é o RSS: memória do
+# SQLite (cache de páginas, ordenações) e o que o alocador não
+# devolve ao sistema ficam de fora. Serve para comparar as rotas
+# entre si e entre execuções; o pico é zerado a cada rota (o
+# ru_maxrss do processo só sobe e repetiria a rota mais pesada).
+# -----------------------------------------------------------
+def pico_alocacao_kb(client, metodo, caminho, dados):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        resposta = client.open(caminho, method=metodo, json=dados)
+        resposta.get_data()
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return pico // 1024
+
+
+# -----------------------------------------------------------
+# Rotas medidas: (nome, método, url, corpo JSON).
+# url/corpo podem ser funções (recebem o número da repetição),
+# para as escritas não repetirem o mesmo pedido.
+# -----------------------------------------------------------
+def rotas(maior_id, linhas, versao):
+    def pedido(i):
+        return {'nome': f'Bench {i}', 'rg': str(i), 'produto': 'Aluguel Pequeno',
+                'rosh': 'Mix', 'essencia': 'Uva', 'observacao': ''}
+
+    lista = [
+        ('catalogo', 'GET', '/api/catalogo', None),
+        ('produtos', 'GET', '/api/produtos', None),
+        ('roshs', 'GET', '/api/roshs', None),
+        ('pedidos', 'GET', '/api/pedidos', None),
+        ('pedidos_colunar', 'GET', '/api/pedidos?format=columnar', None),
+        ('pedidos_pagina', 'GET', '/api/pedidos?limit=50&total=1', None),
+        ('pedidos_pagina_profunda', 'GET', f'/api/pedidos/todos?limit=50&after={max(maior_id // 2, 1)}', None),
+        ('todos_stream', 'GET', '/api/pedidos/todos?stream=1', None),
+        ('todos_stream_colunar', 'GET', '/api/pedidos/todos?stream=1&format=columnar', None),
+        ('busca', 'GET', '/api/pedidos/busca?q=ana uva&limit=50', None),
+        ('busca_recentes', 'GET', '/api/pedidos/busca?q=mesa&limit=50&recentes=1', None),
+        ('changes', 'GET', f'/api/pedidos/changes?since={max(versao - 100, 0)}', None),
+        ('resumo', 'GET', '/api/resumo', None),
+        ('resumo_por_dia', 'GET', '/api/resumo?agrupar=dia', None),
+        ('index', 'GET', '/index', None),
+        ('criar', 'POST', '/api/pedido', pedido),
+        ('criar_lote_50', 'POST', '/api/pedidos/batch', lambda i: [pedido(i * 50 + j) for j in range(50)]),
+        ('atualizar_lote_50', 'PATCH', '/api/pedidos/batch',
+         lambda i: {'ativos': [{'id': maior_id - j, 'ativo': i % 2} for j in range(50)]}),
+        ('atualizar', 'PUT', lambda i: f'/api/pedido/{maior_id - i}', pedido),
+        ('ativo', 'PUT', lambda i: f'/api/pedido/{maior_id - i}/ativo', lambda i: {'ativo': i % 2}),
+        ('excluir', 'DELETE', lambda i: f'/api/pedido/{maior_id - 1000 - i}', None),
+    ]
+    # A lista completa monta tudo em memória: só em históricos menores
+    if linhas <= 200_000:
+        lista.insert(5, ('todos', 'GET', '/api/pedidos/todos', None))
+    return lista
+
+
+def medir(client, metodo, url, corpo, repeticoes, aquecimento):
+    gc.collect()  # lixo da rota anterior não conta para esta
+    tempos, total_linhas, erros = [], 0, 0
+    for i in range(-aquecimento, repeticoes):
+        caminho = url(i) if callable(url) else url
+        dados = corpo(i) if callable(corpo) else corpo
+        inicio = time.perf_counter()
+        resposta = client.open(caminho, method=metodo, json=dados)
+        resposta.get_data()  # consome o streaming inteiro
+        decorrido = time.perf_counter() - inicio
+        if i < 0:
+            continue
+        tempos.append(decorrido)
+        if resposta.status_code >= 400:
+            erros += 1
+        total_linhas += contar_linhas(resposta)
+
+    caminho = url(repeticoes) if callable(url) else url
+    dados = corpo(repeticoes) if callable(corpo) else corpo
+    return {
+        'repeticoes': repeticoes,
+        'p50_ms': round(percentil(tempos, 50) * 1000, 3),
+        'p95_ms': round(percentil(tempos, 95) * 1000, 3),
+        'p99_ms': round(percentil(tempos, 99) * 1000, 3),
+        'media_ms': round(statistics.fmean(tempos) * 1000, 3),
+        'linhas': total_linhas // repeticoes,
+        'linhas_por_s': round(total_linhas / sum(tempos)) if total_linhas else 0,
+        'alocacao_pico_kb': pico_alocacao_kb(client, metodo, caminho, dados),
+        'erros': erros,
+    }
+
+
+# -----------------------------------------------------------
+# Compara com uma execução anterior: uma rota regrediu se a
+# mediana (p50, a métrica menos sensível a um pico isolado)
+# ficou mais de "tolerancia" acima da anterior e por mais de
+# 1 ms, para não acusar ruído em rotas muito rápidas
+# -----------------------------------------------------------
+def comparar(atual, anterior, tolerancia):
+    regressoes = []
+    for nome, novo in atual['rotas'].items():
+        antigo = anterior['rotas'].get(nome)
+        if antigo is None:
+            continue
+        limite = antigo['p50_ms'] * (1 + tolerancia)
+        if novo['p50_ms'] > limite and novo['p50_ms'] - antigo['p50_ms'] > 1:
+            regressoes.append((nome, antigo['p50_ms'], novo['p50_ms']))
+    return regressoes
+
+
+def argumentos(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark das rotas com pedidos sintéticos')
+    parser.add_argument('--linhas', type=quantidade, default=quantidade('10k'), help='ex.: 10k, 1M, 10M')
+    parser.add_argument('--meses', type=int, default=6, help='período coberto pelos pedidos')
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--repeticoes', type=int, default=20)
+    parser.add_argument('--aquecimento', type=int, default=2)
+    parser.add_argument('--rotas', help='nomes separados por vírgula (padrão: todas)')
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(), 'fumaca_bench'),
+                        help='onde guardar os bancos gerados')
+    parser.add_argument('--saida', default='bench_output.json')
+    parser.add_argument('--comparar', help='JSON de uma execução anterior')
+    parser.add_argument('--tolerancia', type=float, default=0.15, help='aumento de p50 aceito (0.15 = 15%%)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = argumentos(argv)
+    os.makedirs(args.dir, exist_ok=True)
+
+    # "v2": bancos gerados antes das alterações sintéticas não servem
+    base = os.path.join(args.dir, f'pedidos_{args.linhas}_{args.meses}m_{args.semente}_v2.db')
+    inicio = time.perf_counter()
+    gerar_banco(base, args.linhas, args.meses, args.semente)
+    print(f'Banco com {args.linhas} pedidos pronto em {time.perf_counter() - inicio:.1f}s ({base})')
+
+    trabalho = os.path.join(args.dir, 'trabalho.db')
+    for sufixo in ('', '-wal', '-shm'):
+        if os.path.exists(trabalho + sufixo):
+            os.unlink(trabalho + sufixo)
+    shutil.copyfile(base, trabalho)
+
+    app_module.DB_PATH = trabalho
+    app.config.update(TESTING=True, LOGIN_IP_RAJADA=10 ** 9, LOGIN_USUARIO_RAJADA=10 ** 9)
+    client = app.test_client()
+    client.post('/login', data={'usuario': 'adm', 'senha': 'admin123'})
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        maior_id = conn.execute('SELECT MAX(pedidoid) FROM pedido').fetchone()[0] or 0
+        versao = app_module._versao(conn, 'pedido')
+
+    escolhidas = set(args.rotas.split(',')) if args.rotas else None
+    resultados = {}
+    for nome, metodo, url, corpo in rotas(maior_id, args.linhas, versao):
+        if escolhidas and nome not in escolhidas:
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):  # prints das rotas não poluem a saída
+            resultados[nome] = medir(client, metodo, url, corpo, args.repeticoes, args.aquecimento)
+        r = resultados[nome]
+        print(f"{nome:26} p50 {r['p50_ms']:9.2f} ms  p95 {r['p95_ms']:9.2f} ms  "
+              f"p99 {r['p99_ms']:9.2f} ms  {r['linhas_por_s']:>10} linhas/s  erros {r['erros']}")
+
+    app_module.fechar_conexoes()
+
+    atual = {
+        'meta': {
+            'linhas': args.linhas,
+            'meses': args.meses,
+            'semente': args.semente,
+            'repeticoes': args.repeticoes,
+            'data': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'plataforma': platform.platform(),
+        },
+        'rotas': resultados,
+    }
+    with open(args.saida, 'w', encoding='utf-8') as arquivo:
+        json.dump(atual, arquivo, indent=2, ensure_ascii=False)
+    print(f'Resultados gravados em {args.saida}')
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as arquivo:
+            anterior = json.load(arquivo)
+        if anterior['meta'].get('linhas') != args.linhas:
+            print('Aviso: a execução anterior usou outro volume de pedidos')
+        regressoes = comparar(atual, anterior, args.tolerancia)
+        for nome, antes, depois in regressoes:
+            print(f'REGRESSÃO {nome}: p50 {antes:.2f} ms → {depois:.2f} ms')
+        if regressoes:
+            return 1
+        print('Nenhuma regressão acima da tolerância')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
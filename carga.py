@@ -0,0 +1,467 @@
+import argparse
+import gzip
+import http.client
+import json
+import os
+import random
+import secrets
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+from werkzeug.security import generate_password_hash
+
+import app as app_module
+from app import app, FilaEscritaCheia
+
+
+# -----------------------------------------------------------
+# Teste de carga: simula uma sexta-feira à noite.
+#
+# N estações fazem login pelo /login (como o navegador), abrem o
+# index.html e ficam em loop: listam a página atual, consultam o
+# feed de alterações, criam pedidos e marcam "ativo". Um admin
+# abre o /historico e puxa o histórico e o resumo de tempos em
+# tempos. Roda dentro do processo (test client do Flask) ou contra
+# um servidor em --url (ex.: python serve.py).
+#
+#   python carga.py --estacoes 12 --duracao 60 --perfil sexta
+#   python carga.py --url http://127.0.0.1:5000 --banco db/pedidos_db.db --estacoes 30
+#
+# No processo, a carga roda sobre uma cópia temporária do banco
+# (--banco ou o do app), apagada no fim: o banco real não recebe
+# os pedidos nem os usuários do teste.
+#
+# Cada estação entra com o próprio usuário (estacao1, estacao2, ...,
+# criados no banco se faltarem), como no bar: com um usuário só, o
+# limite de tentativas de login por usuário barraria o próprio
+# teste. A senha deles é sorteada a cada execução (ou --senha) e,
+# contra um servidor em --url, os usuários criados são apagados no
+# fim. No processo, o limite por IP também é afrouxado durante a
+# execução (todas as estações vêm do mesmo endereço); contra um
+# servidor em --url, LOGIN_IP_RAJADA dele precisa cobrir as estações.
+#
+# Só usa a biblioteca padrão.
+# -----------------------------------------------------------
+
+# Perfis de cenário: peso de cada ação das estações, pausa entre
+# ações (tempo do atendente) e intervalo entre as ações do admin
+PERFIS = {
+    'sexta': {
+        'acoes': {'listar': 35, 'alteracoes': 30, 'criar': 15, 'ativo': 12, 'atualizar': 3, 'buscar': 5},
+        'pausa_s': 0.5,
+        'admin_intervalo_s': 10,
+    },
+    'leitura': {
+        'acoes': {'listar': 55, 'alteracoes': 35, 'buscar': 10},
+        'pausa_s': 0.2,
+        'admin_intervalo_s': 5,
+    },
+    'escrita': {
+        'acoes': {'criar': 40, 'ativo': 30, 'atualizar': 10, 'listar': 15, 'alteracoes': 5},
+        'pausa_s': 0.05,
+        'admin_intervalo_s': 30,
+    },
+}
+
+# Limites superiores (ms) das faixas do histograma de latência
+FAIXAS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf')]
+
+ESSENCIAS = ['Uva', 'Menta', 'Melancia', 'Pêssego', 'Limão']
+
+
+# -----------------------------------------------------------
+# Clientes: mesma interface para o test client e para HTTP.
+# requisitar() retorna (status, corpo em bytes) e lança exceção
+# para falhas de conexão (ou, no processo, erros do app).
+# -----------------------------------------------------------
+class ClienteLocal:
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def requisitar(self, metodo, caminho, json_corpo=None, formulario=None):
+        # Fecha a resposta, como o servidor faria (fecha as métricas da rota)
+        with self.client.open(caminho, method=metodo, json=json_corpo, data=formulario) as resposta:
+            return resposta.status_code, resposta.get_data()
+
+
+class ClienteHttp:
+    """Conexão keep-alive por estação, com o cookie de sessão guardado."""
+
+    def __init__(self, url):
+        partes = urlsplit(url)
+        self.host, self.porta = partes.hostname, partes.port or 80
+        self.cookies = SimpleCookie()
+        self.conexao = None
+
+    def requisitar(self, metodo, caminho, json_corpo=None, formulario=None):
+        cabecalhos = {'Accept-Encoding': 'gzip'}
+        corpo = None
+        if json_corpo is not None:
+            corpo = json.dumps(json_corpo).encode()
+            cabecalhos['Content-Type'] = 'application/json'
+        elif formulario is not None:
+            corpo = urlencode(formulario).encode()
+            cabecalhos['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            cabecalhos['Cookie'] = '; '.join(f'{c.key}={c.value}' for c in self.cookies.values())
+
+        for tentativa in range(2):  # reabre uma vez se o servidor fechou a conexão
+            if self.conexao is None:
+                self.conexao = http.client.HTTPConnection(self.host, self.porta, timeout=30)
+            try:
+                self.conexao.request(metodo, caminho, body=corpo, headers=cabecalhos)
+                resposta = self.conexao.getresponse()
+                dados = resposta.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                self.conexao.close()
+                self.conexao = None
+                if tentativa:
+                    raise
+
+        for cookie in resposta.headers.get_all('Set-Cookie') or []:
+            self.cookies.load(cookie)
+        if resposta.getheader('Content-Encoding') == 'gzip':
+            dados = gzip.decompress(dados)
+        return resposta.status, dados
+
+
+# -----------------------------------------------------------
+# Resultados compartilhados entre as threads
+# -----------------------------------------------------------
+class Resultados:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = {}   # ação → [segundos]
+        self.erros = {}       # tipo → quantidade
+        self.erros_por_acao = {}
+
+    def registrar(self, acao, segundos, erro=None):
+        with self._lock:
+            self.latencias.setdefault(acao, []).append(segundos)
+            if erro:
+                self.erros[erro] = self.erros.get(erro, 0) + 1
+                self.erros_por_acao[acao] = self.erros_por_acao.get(acao, 0) + 1
+
+
+# Classifica a resposta/exceção em um tipo de erro (ou None)
+def _tipo_erro(status=None, excecao=None):
+    if excecao is not None:
+        if isinstance(excecao, sqlite3.OperationalError) and 'locked' in str(excecao):
+            return 'sqlite_lock'
+        if isinstance(excecao, FilaEscritaCheia):
+            return 'fila_escrita_cheia'
+        if isinstance(excecao, (ConnectionError, TimeoutError, http.client.HTTPException)):
+            return 'conexao'
+        return 'excecao'
+    if status == 503:
+        return 'fila_escrita_cheia'  # escritor único sem vaga (503 + Retry-After)
+    if status == 429:
+        return 'login_limitado'
+    if status >= 500:
+        return 'http_5xx'
+    if status >= 400:
+        return 'http_4xx'
+    return None
+
+
+def _executar(cliente, resultados, acao, metodo, caminho, **kwargs):
+    inicio = time.perf_counter()
+    try:
+        status, corpo = cliente.requisitar(metodo, caminho, **kwargs)
+    except Exception as e:
+        resultados.registrar(acao, time.perf_counter() - inicio, _tipo_erro(excecao=e))
+        return None
+    resultados.registrar(acao, time.perf_counter() - inicio, _tipo_erro(status))
+    return corpo if status < 400 else None
+
+
+def _login(cliente, resultados, usuario, senha):
+    _executar(cliente, resultados, 'login', 'POST', '/login',
+              formulario={'usuario': usuario, 'senha': senha})
+
+
+# -----------------------------------------------------------
+# Uma estação: login, index.html e o loop de ações do perfil
+# -----------------------------------------------------------
+def estacao(numero, cliente, resultados, perfil, fim, credenciais, semente):
+    aleatorio = random.Random(semente + numero)
+    usuario, senha = credenciais
+    _login(cliente, resultados, _usuario_da_estacao(usuario, numero), senha)
+    _executar(cliente, resultados, 'index', 'GET', '/index')
+    corpo = _executar(cliente, resultados, 'catalogo', 'GET', '/api/catalogo')
+
+    # Os pedidos usam os produtos e roshs do catálogo, como a tela
+    catalogo = json.loads(corpo) if corpo else {}
+    produtos = [p['nome'] for p in catalogo.get('produtos', [])] or list(app_module.PRECOS_INICIAIS)
+    roshs = catalogo.get('roshs') or ['Mix', 'Único']
+
+    acoes, pesos = zip(*perfil['acoes'].items())
+    ids_visiveis, versao = [], 0
+    contador = 0
+
+    def pedido():
+        return {
+            'nome': f'Estação {numero} cliente {contador}', 'rg': str(aleatorio.randrange(10**7, 10**8)),
+            'produto': aleatorio.choice(produtos), 'rosh': aleatorio.choice(roshs),
+            'essencia': aleatorio.choice(ESSENCIAS), 'observacao': '',
+        }
+
+    while time.monotonic() < fim:
+        acao = aleatorio.choices(acoes, pesos)[0]
+        contador += 1
+
+        if acao == 'listar' or (acao in ('ativo', 'atualizar') and not ids_visiveis):
+            corpo = _executar(cliente, resultados, 'listar', 'GET',
+                              '/api/pedidos?limit=50&total=1&format=columnar')
+            if corpo:
+                dados = json.loads(corpo)
+                bloco = dados['pedidos']
+                ids_visiveis = bloco['valores'][bloco['colunas'].index('pedidoid')]
+                versao = dados['versao']
+        elif acao == 'alteracoes':
+            corpo = _executar(cliente, resultados, acao, 'GET', f'/api/pedidos/changes?since={versao}')
+            if corpo:
+                versao = json.loads(corpo)['versao']
+        elif acao == 'criar':
+            _executar(cliente, resultados, acao, 'POST', '/api/pedido', json_corpo=pedido())
+        elif acao == 'ativo':
+            _executar(cliente, resultados, acao, 'PUT', f'/api/pedido/{aleatorio.choice(ids_visiveis)}/ativo',
+                      json_corpo={'ativo': aleatorio.randint(0, 1)})
+        elif acao == 'atualizar':
+            _executar(cliente, resultados, acao, 'PUT', f'/api/pedido/{aleatorio.choice(ids_visiveis)}',
+                      json_corpo=pedido())
+        elif acao == 'buscar':
+            termo = aleatorio.choice(ESSENCIAS + ['Estação', 'cliente'])
+            _executar(cliente, resultados, acao, 'GET', f'/api/pedidos/busca?q={termo}&recentes=1&limit=50')
+
+        if perfil['pausa_s']:
+            time.sleep(aleatorio.uniform(0.5, 1.5) * perfil['pausa_s'])
+
+
+# -----------------------------------------------------------
+# O admin: abre o /historico e puxa o que a página puxa
+# (resumo e histórico completo em streaming colunar)
+# -----------------------------------------------------------
+def admin(cliente, resultados, perfil, fim, credenciais):
+    _login(cliente, resultados, *credenciais)
+    while time.monotonic() < fim:
+        _executar(cliente, resultados, 'historico', 'GET', '/historico')
+        _executar(cliente, resultados, 'resumo', 'GET', '/api/resumo')
+        _executar(cliente, resultados, 'historico_stream', 'GET', '/api/pedidos/todos?stream=1&format=columnar')
+        time.sleep(max(0, min(perfil['admin_intervalo_s'], fim - time.monotonic())))
+
+
+def percentil(valores, p):
+    if len(valores) == 1:
+        return valores[0]
+    return statistics.quantiles(valores, n=100, method='inclusive')[p - 1]
+
+
+def histograma(valores):
+    contagem = [0] * len(FAIXAS_MS)
+    for segundos in valores:
+        ms = segundos * 1000
+        contagem[next(i for i, limite in enumerate(FAIXAS_MS) if ms <= limite)] += 1
+    return {('+inf' if limite == float('inf') else f'<={limite:g}ms'): n for limite, n in zip(FAIXAS_MS, contagem)}
+
+
+def relatorio(resultados, duracao):
+    acoes = {}
+    for acao, valores in sorted(resultados.latencias.items()):
+        acoes[acao] = {
+            'requisicoes': len(valores),
+            'erros': resultados.erros_por_acao.get(acao, 0),
+            'p50_ms': round(percentil(valores, 50) * 1000, 2),
+            'p95_ms': round(percentil(valores, 95) * 1000, 2),
+            'p99_ms': round(percentil(valores, 99) * 1000, 2),
+            'histograma': histograma(valores),
+        }
+    total = sum(a['requisicoes'] for a in acoes.values())
+    return {
+        'duracao_s': round(duracao, 1),
+        'requisicoes': total,
+        'vazao_rps': round(total / duracao, 1) if duracao else 0,
+        'erros': dict(resultados.erros),
+        'acoes': acoes,
+    }
+
+
+def imprimir(dados):
+    print(f"\n{dados['requisicoes']} requisições em {dados['duracao_s']}s → {dados['vazao_rps']} req/s")
+    print(f"Erros: {dados['erros'] or 'nenhum'}\n")
+    print(f"{'ação':18} {'req':>7} {'erros':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for acao, a in dados['acoes'].items():
+        print(f"{acao:18} {a['requisicoes']:>7} {a['erros']:>6} {a['p50_ms']:>9} {a['p95_ms']:>9} {a['p99_ms']:>9}")
+
+    print('\nHistograma (todas as ações):')
+    geral = {}
+    for a in dados['acoes'].values():
+        for faixa, n in a['histograma'].items():
+            geral[faixa] = geral.get(faixa, 0) + n
+    maior = max(geral.values()) or 1
+    for faixa, n in geral.items():
+        print(f"{faixa:>10} {n:>8} {'#' * round(40 * n / maior)}")
+
+
+def argumentos(argv=None):
+    parser = argparse.ArgumentParser(description='Teste de carga simulando estações do bar')
+    parser.add_argument('--url', help='servidor já rodando (ex.: http://127.0.0.1:5000); sem isso roda no processo')
+    parser.add_argument('--banco', help='banco do servidor em --url; no processo, o banco copiado (padrão: o do app)')
+    parser.add_argument('--perfil', choices=sorted(PERFIS), default='sexta')
+    parser.add_argument('--estacoes', type=int, default=8)
+    parser.add_argument('--admins', type=int, default=1)
+    parser.add_argument('--duracao', type=float, default=30, help='segundos')
+    parser.add_argument('--pausa', type=float, help='substitui a pausa do perfil (segundos; 0 = sem pausa)')
+    parser.add_argument('--usuario', default='estacao{n}',
+                        help='usuário das estações; "{n}" vira o número da estação (1, 2, ...)')
+    parser.add_argument('--senha', help='senha das estações (padrão: sorteada a cada execução)')
+    parser.add_argument('--admin-usuario', default='adm')
+    parser.add_argument('--admin-senha', default='admin123')
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--saida', help='grava o relatório em JSON')
+    return parser.parse_args(argv)
+
+
+def _usuario_da_estacao(usuario, numero):
+    return usuario.replace('{n}', str(numero + 1))
+
+
+# -----------------------------------------------------------
+# Cria no banco os usuários das estações que ainda não existem
+# (usuário comum, com a senha de --senha). Com um nome sem "{n}"
+# todas as estações usam o mesmo usuário, que já deve existir.
+# Retorna os nomes criados (para remover_usuarios no fim).
+# -----------------------------------------------------------
+def preparar_usuarios(args, caminho):
+    if '{n}' not in args.usuario:
+        return []
+
+    nomes = [_usuario_da_estacao(args.usuario, i) for i in range(args.estacoes)]
+    conn = sqlite3.connect(caminho, timeout=30)
+    try:
+        existentes = {linha[0] for linha in conn.execute(
+            f"SELECT nome FROM user WHERE nome IN ({','.join('?' * len(nomes))})", nomes
+        )}
+        faltando = [nome for nome in nomes if nome not in existentes]
+        if faltando:
+            senha = generate_password_hash(args.senha, method=app.config['LOGIN_HASH_METODO'])
+            conn.executemany('INSERT INTO user (nome, senha, admin) VALUES (?, ?, 0)',
+                             [(nome, senha) for nome in faltando])
+            conn.commit()
+    finally:
+        conn.close()
+    return faltando
+
+
+def remover_usuarios(caminho, nomes):
+    if not nomes:
+        return
+    conn = sqlite3.connect(caminho, timeout=30)
+    try:
+        conn.execute(f"DELETE FROM user WHERE nome IN ({','.join('?' * len(nomes))})", nomes)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# Cópia consistente do banco (a API de backup inclui o que ainda
+# está no WAL), em um diretório temporário
+def copiar_banco(origem, diretorio):
+    destino = os.path.join(diretorio, os.path.basename(origem))
+    fonte = sqlite3.connect(origem, timeout=30)
+    copia = sqlite3.connect(destino)
+    try:
+        fonte.backup(copia)
+    finally:
+        copia.close()
+        fonte.close()
+    return destino
+
+
+def executar(args):
+    perfil = dict(PERFIS[args.perfil])
+    if args.pausa is not None:
+        perfil['pausa_s'] = args.pausa
+
+    if args.senha is None:
+        args.senha = secrets.token_urlsafe(16)
+
+    caminho = args.banco or app_module.DB_PATH
+    if not os.path.exists(caminho):
+        raise SystemExit(f'Banco {caminho} não encontrado: informe --banco com o banco do servidor')
+
+    # Configuração alterada só durante a execução no processo
+    config_original = {}
+    banco_original = app_module.DB_PATH
+    temporario = None
+    if args.url:
+        def novo_cliente():
+            return ClienteHttp(args.url)
+    else:
+        temporario = tempfile.mkdtemp(prefix='carga_')
+        caminho = app_module.DB_PATH = copiar_banco(caminho, temporario)
+        config_original = {
+            chave: app.config.get(chave) for chave in ('PROPAGATE_EXCEPTIONS', 'LOGIN_IP_RAJADA')
+        }
+        # Exceções do app chegam ao driver (para separar os locks do SQLite)
+        app.config['PROPAGATE_EXCEPTIONS'] = True
+        # Todas as estações fazem login do mesmo "IP" do test client
+        app.config['LOGIN_IP_RAJADA'] = max(app.config['LOGIN_IP_RAJADA'], args.estacoes + args.admins)
+        novo_cliente = ClienteLocal
+
+    criados = []
+    try:
+        criados = preparar_usuarios(args, caminho)  # antes do relógio: o hash da senha é lento
+        resultados = Resultados()
+        fim = time.monotonic() + args.duracao
+        threads = [
+            threading.Thread(target=estacao, args=(
+                i, novo_cliente(), resultados, perfil, fim, (args.usuario, args.senha), args.semente
+            ), daemon=True)
+            for i in range(args.estacoes)
+        ] + [
+            threading.Thread(target=admin, args=(
+                novo_cliente(), resultados, perfil, fim, (args.admin_usuario, args.admin_senha)
+            ), daemon=True)
+            for _ in range(args.admins)
+        ]
+
+        inicio = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duracao = time.monotonic() - inicio
+    finally:
+        app.config.update(config_original)
+        if args.url:
+            remover_usuarios(caminho, criados)
+        else:
+            app_module.fechar_conexoes()
+            app_module.DB_PATH = banco_original
+            shutil.rmtree(temporario, ignore_errors=True)
+    return relatorio(resultados, duracao)
+
+
+def main(argv=None):
+    args = argumentos(argv)
+    dados = executar(args)
+    imprimir(dados)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(dados, arquivo, indent=2, ensure_ascii=False)
+    return 1 if dados['erros'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import argparse
+import os
+
+import app as app_module
+from app import app
+
+
+# -----------------------------------------------------------
+# Servidor de produção (substitui o app.run de desenvolvimento)
+#
+# Usa o gunicorn com processos pré-forkados, cada um com um pool
+# de threads (worker "gthread"), para usar todos os núcleos.
+# Cada worker abre as próprias conexões SQLite depois do fork.
+#
+# Sinais para o processo principal:
+# - HUP  → recarrega a configuração e troca os workers sem derrubar conexões
+# - TERM → desligamento gracioso (espera até --graceful-timeout)
+# - INT/QUIT → desligamento imediato
+#
+# Todas as opções também podem vir de variáveis de ambiente
+# (SERVE_WORKERS, SERVE_THREADS, ...), o que facilita no Docker.
+# -----------------------------------------------------------
+def _env(nome, padrao):
+    return type(padrao)(os.environ.get(nome, padrao))
+
+
+def argumentos(argv=None):
+    parser = argparse.ArgumentParser(description='Servidor de produção do FumacaStoke')
+    parser.add_argument('--bind', default=_env('SERVE_BIND', '0.0.0.0:5000'))
+    parser.add_argument('--workers', type=int, default=_env('SERVE_WORKERS', os.cpu_count() or 1),
+                        help='processos (padrão: um por núcleo)')
+    parser.add_argument('--threads', type=int, default=_env('SERVE_THREADS', 16),
+                        help='threads por processo; cada estação com /api/eventos aberto ocupa uma')
+    parser.add_argument('--threads-livres', type=int, default=_env('SERVE_THREADS_LIVRES', 4),
+                        help='threads por processo que nunca ficam presas em /api/eventos '
+                             '(o limite de conexões SSE é threads - threads-livres)')
+    parser.add_argument('--backlog', type=int, default=_env('SERVE_BACKLOG', 256),
+                        help='fila de conexões aguardando atendimento')
+    parser.add_argument('--max-conexoes', type=int, default=_env('SERVE_MAX_CONEXOES', 500),
+                        help='conexões simultâneas por processo (inclui keep-alive)')
+    parser.add_argument('--timeout', type=int, default=_env('SERVE_TIMEOUT', 60),
+                        help='segundos sem sinal de vida antes de reiniciar um worker')
+    parser.add_argument('--graceful-timeout', type=int, default=_env('SERVE_GRACEFUL_TIMEOUT', 30),
+                        help='espera pelas requisições em andamento no desligamento')
+    parser.add_argument('--keepalive', type=int, default=_env('SERVE_KEEPALIVE', 5))
+    parser.add_argument('--max-requests', type=int, default=_env('SERVE_MAX_REQUESTS', 0),
+                        help='reinicia o worker após N requisições (0 = nunca)')
+    args = parser.parse_args(argv)
+    if args.threads - args.threads_livres < 1:
+        parser.error('--threads deve ser maior que --threads-livres (sobra thread para /api/eventos)')
+    return args
+
+
+# -----------------------------------------------------------
+# No gthread cada stream de /api/eventos prende uma thread até a
+# estação fechar a página. O limite de assinantes por processo
+# deixa "threads-livres" para as rotas de pedidos: a estação a
+# mais recebe 503 (e volta ao polling) em vez de travar o worker.
+# -----------------------------------------------------------
+def limitar_eventos(args):
+    limite = min(app.config['EVENTOS_MAX_ASSINANTES'], args.threads - args.threads_livres)
+    app.config['EVENTOS_MAX_ASSINANTES'] = limite
+    return limite
+
+
+# -----------------------------------------------------------
+# Hook do gunicorn no processo filho: descarta conexões e a
+# thread do escritor herdadas do pai, liga o arquivamento
+# automático (só um worker por intervalo chega a arquivar) e
+# recupera as tarefas de segundo plano de workers que morreram
+# -----------------------------------------------------------
+def _pos_fork(server, worker):
+    app_module.reiniciar_conexoes_pos_fork()
+    app_module.iniciar_arquivamento_automatico()
+    app_module.iniciar_tarefas()
+
+
+def opcoes_gunicorn(args):
+    return {
+        'bind': args.bind,
+        'workers': args.workers,
+        'worker_class': 'gthread',
+        'threads': args.threads,
+        'backlog': args.backlog,
+        'worker_connections': args.max_conexoes,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'keepalive': args.keepalive,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10,
+        'preload_app': True,
+        'post_fork': _pos_fork,
+        'accesslog': '-',
+    }
+
+
+# -----------------------------------------------------------
+# Aplica as migrações uma vez no processo principal, antes do
+# fork, e fecha as conexões (os workers abrem as suas). Também
+# gera os estáticos com impressão digital: os workers herdam o
+# manifesto pronto.
+# -----------------------------------------------------------
+def _preparar_banco():
+    with app.app_context():
+        app_module.db_connection()
+    app_module.fechar_conexoes()
+    app_module.preparar_estaticos()
+    app_module.verificar_idade_arquivo()  # antes do fork: nenhum worker sobe com ela errada
+
+
+def main(argv=None):
+    args = argumentos(argv)
+    _preparar_banco()
+
+    if os.name == 'nt':
+        # O gunicorn depende de fork: no Windows (desenvolvimento)
+        # fica o servidor do Werkzeug com threads, em um processo
+        from werkzeug.serving import run_simple
+        print('gunicorn indisponível no Windows; usando o servidor do Werkzeug (1 processo)')
+        host, _, porta = args.bind.rpartition(':')
+        app_module.iniciar_arquivamento_automatico()
+        app_module.iniciar_tarefas()
+        run_simple(host, int(porta), app, threaded=True)
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    limitar_eventos(args)  # antes do fork: os workers herdam a config
+
+    class Servidor(BaseApplication):
+
+        def load_config(self):
+            for chave, valor in opcoes_gunicorn(args).items():
+                self.cfg.set(chave, valor)
+
+        def load(self):
+            return app
+
+    Servidor().run()
+
+
+if __name__ == '__main__':
+    main()
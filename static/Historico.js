@@ -16,36 +16,76 @@
                 tbody.appendChild(tr);
             }
 
-            const valorPorProduto = {
-                'Aluguel Médio': 50,
-                'Aluguel Pequeno': 40,
-                'Reposição': 25,
-                'Funcionário': 20,
-                'Da casa':0
-            };
+            // Preço de cada produto, vindo do servidor (/api/resumo)
+            let valorPorProduto = {};
             
             let pedidosArmazenados = []; 
 
+            // Converte a resposta colunar (?format=columnar) de volta em
+            // uma lista de pedidos: uma coluna por campo e, nas colunas
+            // com dicionário (produto, rosh), o índice do valor.
+            function decodificarColunar(bloco) {
+                const colunas = bloco.colunas.map((nome, i) => {
+                    const dicionario = bloco.dicionarios[nome];
+                    const valores = bloco.valores[i];
+                    return dicionario ? valores.map(indice => dicionario[indice]) : valores;
+                });
+
+                const pedidos = new Array(bloco.linhas);
+                for (let linha = 0; linha < bloco.linhas; linha++) {
+                    const pedido = {};
+                    bloco.colunas.forEach((nome, i) => { pedido[nome] = colunas[i][linha]; });
+                    pedidos[linha] = pedido;
+                }
+                return pedidos;
+            }
+
+            // Lê o histórico em streaming (NDJSON, formato colunar): cada
+            // linha é um bloco com um lote de pedidos. Os lotes são
+            // desenhados conforme chegam, sem esperar o download inteiro
+            // nem montar um JSON gigante em memória.
             async function carregarPedidos(){
-                const res = await fetch('/api/pedidos/todos');
-                const pedidos = await res.json();
+                await Resumo();
+
+                const res = await fetch('/api/pedidos/todos?format=columnar', {
+                    headers: { 'Accept': 'application/x-ndjson' }
+                });
                 const tbody = document.querySelector('#tabelaPedidos tbody');
                 tbody.innerHTML = '';
                 
-                pedidosArmazenados = pedidos;
+                pedidosArmazenados = [];
 
+                const leitor = res.body.getReader();
+                const decoder = new TextDecoder();
+                let resto = '';
 
-                if (pedidos.length === 0) {
+                while (true) {
+                    const { done, value } = await leitor.read();
+                    if (done) break;
+
+                    resto += decoder.decode(value, { stream: true });
+                    const linhas = resto.split('\n');
+                    resto = linhas.pop(); // última linha pode estar incompleta
+
+                    linhas.forEach(linha => {
+                        if (linha) adicionarBloco(linha);
+                    });
+                }
+
+                if (resto.trim()) {
+                    adicionarBloco(resto);
+                }
+
+                if (pedidosArmazenados.length === 0) {
                     renderEmptyTableMessage(tbody, 'Não há histórico de pedidos registrado.');
-                    Resumo(); 
-                    return; 
                 }
+            }
 
-                pedidos.forEach(pedido => {
+            function adicionarBloco(linha) {
+                decodificarColunar(JSON.parse(linha)).forEach(pedido => {
+                    pedidosArmazenados.push(pedido);
                     adicionarLinhaTabela(pedido);
                 });
-                
-                Resumo(); 
             }
 
             window.onload = async () => {
@@ -72,63 +112,37 @@
                 tbody.prepend(tr); 
             }
 
-            function Resumo() {
-                const linhas = Array.from(document.querySelectorAll('#tabelaPedidos tbody tr'));
-                
-                const resumo = {};
-                let totalGeral = 0;
-                let quantidadeGeral = 0;
-
-                linhas.forEach(linha => {
-
-                    if (linha.style.display === 'none' || linha.classList.contains('msg-vazio')) {
-                        return;
-                    }
-                    
-                    const produto = linha.children[3].textContent;
-                    const valor = parseFloat(linha.children[8].textContent) || 0; 
-
-                    if (!resumo[produto]) {
-                        resumo[produto] = { quantidade: 0, total: 0 };
-                    }
-
-                    resumo[produto].quantidade += 1;
-                    resumo[produto].total += valor;
+            // Resumo por produto calculado no servidor (GROUP BY sobre a
+            // tabela de resumo diário), sem depender das linhas baixadas.
+            async function Resumo() {
+                const res = await fetch('/api/resumo');
+                const resumo = await res.json();
 
-                    quantidadeGeral += 1;
-                    totalGeral += valor;
+                valorPorProduto = {};
+                resumo.produtos.forEach(item => {
+                    valorPorProduto[item.produto] = item.preco;
                 });
 
-                const ordemProdutos = [
-                    'Aluguel Pequeno',
-                    'Aluguel Médio',
-                    'Reposição',
-                    'Funcionário',
-                    'Da casa'
-                    ];
                 const tbodyResumo = document.querySelector('#tabelaResumo tbody');
                 tbodyResumo.innerHTML = '';
 
-                if (quantidadeGeral === 0) {
+                if (resumo.total.quantidade === 0) {
                      const trVazio = document.createElement('tr');
-                     trVazio.innerHTML = `<td colspan="3" class="text-center text-muted">Resumo indisponível ou filtro ativo.</td>`;
+                     trVazio.innerHTML = `<td colspan="3" class="text-center text-muted">Resumo indisponível.</td>`;
                      tbodyResumo.appendChild(trVazio);
                      return;
                 }
 
-                ordemProdutos.forEach(produto => {
-                    const dados = resumo[produto];
-                    if (dados) {
-                        const { quantidade, total } = dados;
-
-                        const tr = document.createElement('tr');
-                        tr.innerHTML = `
-                        <td>${produto}</td>
-                        <td>${quantidade}</td>
-                        <td>R$ ${total.toFixed(2)}</td>
-                        `;
-                        tbodyResumo.appendChild(tr);
-                    }
+                resumo.produtos.forEach(item => {
+                    if (item.quantidade === 0) return;
+
+                    const tr = document.createElement('tr');
+                    tr.innerHTML = `
+                    <td>${item.produto}</td>
+                    <td>${item.quantidade}</td>
+                    <td>R$ ${item.receita.toFixed(2)}</td>
+                    `;
+                    tbodyResumo.appendChild(tr);
                 });
 
                 // Adiciona linha de total geral
@@ -137,40 +151,52 @@
 
                 trTotal.innerHTML = `
                 <td>Total Geral</td>
-                <td>${quantidadeGeral}</td>
-                <td>R$ ${totalGeral.toFixed(2)}</td>
+                <td>${resumo.total.quantidade}</td>
+                <td>R$ ${resumo.total.receita.toFixed(2)}</td>
                 `;
                 tbodyResumo.appendChild(trTotal);
             }
 
+            // Busca no servidor (FTS) com debounce, em todo o histórico.
+            // Com o filtro vazio, volta a mostrar as linhas já carregadas.
+            let timerBusca = null;
+
             document.getElementById('filtroPedidos').addEventListener('input', function () {
-                const filtro = this.value.toLowerCase();
-                const tbody = document.querySelector('#tabelaPedidos tbody');
-                const linhas = document.querySelectorAll('#tabelaPedidos tbody tr');
-                let linhasVisiveis = 0;
+                const filtro = this.value.trim();
+                clearTimeout(timerBusca);
 
-                // Remove a mensagem de "vazio" anterior se houver
-                document.querySelectorAll('#tabelaPedidos tbody .msg-vazio').forEach(el => el.remove()); 
+                if (!filtro) {
+                    renderizarPedidos(pedidosArmazenados, 'Não há histórico de pedidos registrado.');
+                    return;
+                }
 
-                linhas.forEach(linha => {
-                    // Ignora a linha da mensagem vazia se ela existir (previne erros)
-                    if (linha.classList.contains('msg-vazio')) return; 
+                timerBusca = setTimeout(async () => {
+                    const res = await fetch(`/api/pedidos/busca?q=${encodeURIComponent(filtro)}&limit=200`);
+                    const dados = await res.json();
 
-                    const textoLinha = linha.textContent.toLowerCase();
-                    const corresponde = textoLinha.includes(filtro);
-                    linha.style.display = corresponde ? '' : 'none';
-                    if (corresponde) {
-                        linhasVisiveis++;
-                    }
-                });
+                    // Ignora respostas de buscas antigas (usuário continuou digitando)
+                    if (document.getElementById('filtroPedidos').value.trim() !== filtro) return;
 
-                if (linhasVisiveis === 0) {
-                    renderEmptyTableMessage(tbody, 'Nenhum registro de pedido encontrado com base neste filtro.');
-                }
-                
-                Resumo();
+                    // Invertido: com o prepend, o resultado mais relevante fica no topo
+                    renderizarPedidos([...dados.pedidos].reverse(), 'Nenhum registro de pedido encontrado com base neste filtro.');
+                }, 250);
             });
 
+            function renderizarPedidos(pedidos, mensagemVazia) {
+                const tbody = document.querySelector('#tabelaPedidos tbody');
+                tbody.innerHTML = '';
+
+                if (pedidos.length === 0) {
+                    renderEmptyTableMessage(tbody, mensagemVazia);
+                    return;
+                }
+
+                // adicionarLinhaTabela usa prepend: o último da lista fica no topo
+                pedidos.forEach(pedido => {
+                    adicionarLinhaTabela(pedido);
+                });
+            }
+
             document.querySelectorAll('#tabelaPedidos th').forEach((th, index) => {
                 th.style.cursor = 'pointer';
                 let ascendente = true;
@@ -17,11 +17,13 @@
 
         let pedidoEditadoId = null;
 
+        // Catálogo (produtos e roshs) carregado uma vez por página.
+        // O navegador guarda a resposta em cache (ETag/Cache-Control).
+        let catalogo = { produtos: [], roshs: [] };
+
         async function carregarDropdowns() {
-            const produtoRes = await fetch('/api/produtos');
-            const produtos = await produtoRes.json();
-            const roshRes = await fetch('/api/roshs');
-            const roshs = await roshRes.json();
+            const res = await fetch('/api/catalogo');
+            catalogo = await res.json();
 
             const produtoSelect = document.getElementById('produtos');
             const roshSelect = document.getElementById('roshs');
@@ -29,14 +31,14 @@
             produtoSelect.innerHTML = '<option value="" hidden></option>';
             roshSelect.innerHTML = '<option value="" hidden></option>';
 
-            produtos.forEach(prod => {
+            catalogo.produtos.forEach(({ nome: prod }) => {
                 const option = document.createElement('option');
                 option.value = prod;
                 option.textContent = prod;
                 produtoSelect.appendChild(option);
             });
 
-            roshs.forEach(rosh => {
+            catalogo.roshs.forEach(rosh => {
                 const option = document.createElement('option');
                 option.value = rosh;
                 option.textContent = rosh;
@@ -44,16 +46,40 @@
             });
         }
 
-        async function carregarPedidos() {
-            try {
-                const res = await fetch('/api/pedidos');
-                const pedidos = await res.json();
+        // Converte a resposta colunar (?format=columnar) de volta em
+        // uma lista de pedidos: uma coluna por campo e, nas colunas
+        // com dicionário (produto, rosh), o índice do valor.
+        function decodificarColunar(bloco) {
+            const colunas = bloco.colunas.map((nome, i) => {
+                const dicionario = bloco.dicionarios[nome];
+                const valores = bloco.valores[i];
+                return dicionario ? valores.map(indice => dicionario[indice]) : valores;
+            });
+
+            const pedidos = new Array(bloco.linhas);
+            for (let linha = 0; linha < bloco.linhas; linha++) {
+                const pedido = {};
+                bloco.colunas.forEach((nome, i) => { pedido[nome] = colunas[i][linha]; });
+                pedidos[linha] = pedido;
+            }
+            return pedidos;
+        }
 
-                pedidos.sort((a, b) => b.pedidoid - a.pedidoid);
+        // Carrega uma página de pedidos do servidor (formato colunar).
+        // "cursor" é o trecho da query string (ex.: "&after=120") e
+        // "pagina" o número exibido para o usuário.
+        async function carregarPedidos(cursor = '', pagina = 1) {
+            try {
+                const res = await fetch(`/api/pedidos?limit=${itensPorPagina}&total=1&format=columnar${cursor}`);
+                const dados = await res.json();
 
-                pedidosArmazenados = pedidos;
-                paginaAtual = 1;
-                exibirPagina(paginaAtual);
+                pedidosArmazenados = decodificarColunar(dados.pedidos);
+                totalPedidos = dados.total;
+                versaoSincronizada = dados.versao;
+                cursorProximo = dados.proximo;
+                cursorAnterior = dados.anterior;
+                cursorPagina = cursor;
+                exibirPagina(pagina);
 
             } catch (error) {
                 console.error('Erro ao carregar pedidos:', error);
@@ -64,9 +90,109 @@
             }
         }
 
+        // Recarrega a página que está na tela
+        function recarregarPaginaAtual() {
+            return carregarPedidos(cursorPagina, paginaAtual);
+        }
+
+        // Busca só o que mudou desde a última versão vista
+        // (/api/pedidos/changes) e aplica na página atual,
+        // em vez de baixar a listagem inteira de novo.
+        let sincronizando = null;
+        let sincronizarDeNovo = false;
+
+        // Junta chamadas simultâneas (evento SSE + resposta da própria
+        // escrita) numa sincronização só, repetindo uma vez no fim
+        async function sincronizar() {
+            if (sincronizando) {
+                sincronizarDeNovo = true;
+                return sincronizando;
+            }
+            sincronizando = (async () => {
+                do {
+                    sincronizarDeNovo = false;
+                    await sincronizarAgora();
+                } while (sincronizarDeNovo);
+            })();
+            try {
+                await sincronizando;
+            } finally {
+                sincronizando = null;
+            }
+        }
+
+        async function sincronizarAgora() {
+            if (versaoSincronizada === null) return carregarPedidos();
+
+            try {
+                let mais = true;
+                while (mais) {
+                    const res = await fetch(`/api/pedidos/changes?since=${versaoSincronizada}`);
+                    const delta = await res.json();
+
+                    if (delta.recarregar) return recarregarPaginaAtual();
+
+                    delta.alterados.forEach(aplicarAlteracao);
+                    delta.excluidos.forEach(aplicarExclusao);
+
+                    versaoSincronizada = delta.versao;
+                    mais = delta.mais;
+                }
+                exibirPagina(paginaAtual);
+            } catch (error) {
+                console.error('Erro ao sincronizar pedidos:', error);
+                recarregarPaginaAtual();
+            }
+        }
+
+        function aplicarAlteracao(pedido) {
+            const indice = pedidosArmazenados.findIndex(p => p.pedidoid === pedido.pedidoid);
+            if (indice >= 0) {
+                pedidosArmazenados[indice] = pedido;
+                return;
+            }
+
+            // Pedido novo: só entra na tela se estamos na primeira página
+            const maiorId = pedidosArmazenados.length ? pedidosArmazenados[0].pedidoid : 0;
+            if (pedido.pedidoid > maiorId) {
+                totalPedidos += 1;
+                if (paginaAtual === 1) {
+                    pedidosArmazenados.unshift(pedido);
+                    if (pedidosArmazenados.length > itensPorPagina) {
+                        pedidosArmazenados.pop();
+                        cursorProximo = pedidosArmazenados[pedidosArmazenados.length - 1].pedidoid;
+                    }
+                }
+            }
+        }
+
+        function aplicarExclusao(pedidoId) {
+            const indice = pedidosArmazenados.findIndex(p => p.pedidoid === pedidoId);
+            if (indice >= 0) {
+                pedidosArmazenados.splice(indice, 1);
+                totalPedidos -= 1;
+            }
+        }
+
+        // Escuta os eventos do servidor: quando outra estação cria,
+        // edita, exclui ou marca um pedido, sincroniza a tabela.
+        // O EventSource reconecta sozinho enviando Last-Event-ID.
+        function escutarEventos() {
+            const fonte = new EventSource('/api/eventos');
+            fonte.onmessage = (mensagem) => {
+                const evento = JSON.parse(mensagem.data);
+                if (evento.tipo === 'recarregar') {
+                    recarregarPaginaAtual();
+                } else if (evento.versao === undefined || versaoSincronizada === null || evento.versao > versaoSincronizada) {
+                    sincronizar();
+                }
+            };
+        }
+
         window.onload = async () => {
             await carregarDropdowns();
             await carregarPedidos();
+            escutarEventos();
         }
 
         document.getElementById('btnEnviar').addEventListener('click', async function () {
@@ -90,7 +216,7 @@
 
                 // Limpar formulário
                 document.getElementById('formPedido').reset();
-                carregarPedidos();
+                sincronizar();
 
             } else {
                 alert('Por favor, preencha todos os campos.');
@@ -144,6 +270,7 @@
                 })
                 .then(data => {
                     console.log('Status atualizado:', data);
+                    sincronizar();
                 })
                 .catch(error => {
                     alert('Erro ao atualizar o status.');
@@ -167,12 +294,10 @@
             document.getElementById('editEssencia').value = tr.cells[5].textContent;
             document.getElementById('editObservacao').value = tr.cells[6].textContent;
 
-            const produtoRes = await fetch('/api/produtos');
-            const produtos = await produtoRes.json();
             const produtoSelect = document.getElementById('editProduto');
             produtoSelect.innerHTML = ''; // limpa antes de preencher
 
-            produtos.forEach(prod => {
+            catalogo.produtos.forEach(({ nome: prod }) => {
                 const option = document.createElement('option');
                 option.value = prod;
                 option.textContent = prod;
@@ -180,12 +305,10 @@
                 produtoSelect.appendChild(option);
             });
 
-            const roshRes = await fetch('/api/roshs');
-            const roshs = await roshRes.json();
             const roshSelect = document.getElementById('editRosh');
             roshSelect.innerHTML = ''; // limpa antes de preencher
 
-            roshs.forEach(rosh => {
+            catalogo.roshs.forEach(rosh => {
                 const option = document.createElement('option');
                 option.value = rosh;
                 option.textContent = rosh;
@@ -258,7 +381,7 @@
 
                 if (resposta.ok) {
                     $('#editModal').modal('hide');
-                    await carregarPedidos();
+                    await sincronizar();
                 } else {
                     alert('Erro ao atualizar o pedido.');
                 }
@@ -299,7 +422,7 @@
                 const resposta = await fetch(`/api/pedido/${pedidoIdParaExcluir}`, { method: 'DELETE' });
 
                 if (resposta.ok) {
-                    carregarPedidos(); // Atualiza a tabela
+                    sincronizar(); // Atualiza a tabela
                 } else {
                     alert('Erro ao excluir o pedido no servidor.');
                     console.error('Erro DELETE:', resposta.statusText);
@@ -340,6 +463,11 @@
 
         let pedidosArmazenados = [];
                 let paginaAtual = 1;
+                let totalPedidos = 0;
+                let cursorPagina = '';
+                let cursorProximo = null;
+                let cursorAnterior = null;
+                let versaoSincronizada = null;
                 const itensPorPagina = 10;
 
             function exibirPagina(pagina) {
@@ -354,74 +482,80 @@
                     return;
                 }
 
-                const inicio = (pagina - 1) * itensPorPagina;
-                const fim = inicio + itensPorPagina;
-                const pedidosPagina = pedidosArmazenados.slice(inicio, fim);
-
-                pedidosPagina.forEach(pedido => adicionarLinhaTabela(pedido));
+                // O servidor já devolve somente os pedidos desta página
+                pedidosArmazenados.forEach(pedido => adicionarLinhaTabela(pedido));
 
                 paginaAtual = pagina;
                 atualizarPaginacao();
                 }
 
             function atualizarPaginacao() {
-                const totalPaginas = Math.ceil(pedidosArmazenados.length / itensPorPagina);
+                const totalPaginas = Math.ceil(totalPedidos / itensPorPagina);
                 const paginacaoDiv = document.getElementById('paginacao');
                 paginacaoDiv.innerHTML = '';
 
                 if (totalPaginas <= 1) return;
 
-                const criarBotaoSeta = (simbolo, novaPagina, habilitar) => {
+                const criarBotaoSeta = (simbolo, cursor, novaPagina) => {
                     const btn = document.createElement('button');
                     btn.textContent = simbolo;
                     btn.className = 'btn btn-outline-primary btn-sm';
-                    btn.disabled = !habilitar;
-                    if (habilitar) {
-                    btn.onclick = () => exibirPagina(novaPagina);
+                    btn.disabled = cursor === null;
+                    if (cursor !== null) {
+                    btn.onclick = () => carregarPedidos(cursor, novaPagina);
                     }
                     return btn;
                 };
 
-                const anteriorHabilitado = paginaAtual > 1;
-                paginacaoDiv.appendChild(criarBotaoSeta('‹', paginaAtual - 1, anteriorHabilitado));
+                const cursorVoltar = cursorAnterior !== null ? `&before=${cursorAnterior}` : null;
+                paginacaoDiv.appendChild(criarBotaoSeta('‹', cursorVoltar, paginaAtual - 1));
 
                 const texto = document.createElement('span');
                 texto.textContent = `${paginaAtual} / ${totalPaginas}`;
                 texto.className = 'mx-2 fw-bold';
                 paginacaoDiv.appendChild(texto);
 
-                const proximoHabilitado = paginaAtual < totalPaginas;
-                paginacaoDiv.appendChild(criarBotaoSeta('›', paginaAtual + 1, proximoHabilitado));
+                const cursorAvancar = cursorProximo !== null ? `&after=${cursorProximo}` : null;
+                paginacaoDiv.appendChild(criarBotaoSeta('›', cursorAvancar, paginaAtual + 1));
                 }
 
+            // Busca no servidor (FTS) com debounce: espera o usuário parar
+            // de digitar por um instante antes de consultar.
+            let timerBusca = null;
+
             document.getElementById('filtroPedidos').addEventListener('input', function () {
-            const termo = this.value.trim().toLowerCase();
-            const tbody = document.querySelector('#tabelaPedidos tbody');
-            tbody.innerHTML = '';
-
-            const resultadosFiltrados = pedidosArmazenados.filter(pedido => {
-                const texto = (
-                pedido.pedidoid +
-                pedido.name +
-                pedido.rg +
-                pedido.nome_produto +
-                pedido.nome_rosh +
-                pedido.essencia +
-                pedido.observacao +
-                pedido.criacao
-                ).toLowerCase();
-
-                return texto.includes(termo);
+            const termo = this.value.trim();
+            clearTimeout(timerBusca);
+
+            if (!termo) {
+                recarregarPaginaAtual();
+                return;
+            }
+
+            timerBusca = setTimeout(() => buscarPedidos(termo), 250);
             });
 
-            if (resultadosFiltrados.length === 0) {
-                renderEmptyTableMessage(tbody, 'Nenhum pedido encontrado com base no filtro atual.');
-                document.getElementById('paginacao').style.display = 'none';
-            } else {
+            async function buscarPedidos(termo) {
+            const tbody = document.querySelector('#tabelaPedidos tbody');
+
+            try {
+                const res = await fetch(`/api/pedidos/busca?q=${encodeURIComponent(termo)}&recentes=1&limit=50`);
+                const dados = await res.json();
+
+                // Ignora respostas de buscas antigas (usuário continuou digitando)
+                if (document.getElementById('filtroPedidos').value.trim() !== termo) return;
+
+                tbody.innerHTML = '';
                 document.getElementById('paginacao').style.display = 'none'; // Continua escondida durante a filtragem
 
-                resultadosFiltrados.forEach(pedido => {
-                    adicionarLinhaTabela(pedido);
-                });
+                if (dados.pedidos.length === 0) {
+                    renderEmptyTableMessage(tbody, 'Nenhum pedido encontrado com base no filtro atual.');
+                } else {
+                    dados.pedidos.forEach(pedido => {
+                        adicionarLinhaTabela(pedido);
+                    });
+                }
+            } catch (error) {
+                console.error('Erro na busca de pedidos:', error);
             }
-            });
\ No newline at end of file
+            }
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import shutil
 import sys
 import tempfile
 import pytest
@@ -43,6 +44,21 @@ def app():
     app_module.DB_PATH = temp_db.name
     flask_app.config["TESTING"] = True  # ativa modo de teste no Flask
 
+    # Zera os limites de tentativas de login e o cache de usuários
+    # inexistentes (estado em memória do processo, compartilhado
+    # entre os testes)
+    app_module.limitador_ip.limpar()
+    app_module.limitador_usuario.limpar()
+    app_module._usuarios_desconhecidos.clear()
+    app_module.metricas.limpar()
+    app_module.consultas_lentas.limpar()
+
+    # Estáticos com impressão digital vão para uma pasta temporária
+    # (não suja static/dist do projeto)
+    pasta_estaticos = tempfile.mkdtemp()
+    flask_app.config["ESTATICOS_DIR"] = pasta_estaticos
+    app_module._manifesto_estaticos = {}
+
     conn = sqlite3.connect(temp_db.name)
     cursor = conn.cursor()
 
@@ -64,8 +80,8 @@ def app():
             pedidoid INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
             rg TEXT NOT NULL,
-            nome_produto TEXT,
-            nome_rosh TEXT,
+            nome_produto INTEGER,
+            nome_rosh INTEGER,
             essencia TEXT,
             criacao DATETIME DEFAULT (DATETIME('now')),
             atualizacao DATETIME DEFAULT (DATETIME('now')),
@@ -112,8 +128,15 @@ def app():
     yield flask_app
 
     # Após todos os testes que usam essa fixture terminarem,
-    # remove o arquivo de banco de dados temporário.
-    os.unlink(temp_db.name)
+    # fecha as conexões do pool e remove o banco temporário e o
+    # banco de arquivo, se algum teste o criou
+    # (incluindo os arquivos -wal/-shm do modo WAL).
+    app_module.fechar_conexoes()
+    for caminho in (temp_db.name, app_module._caminho_arquivo()):
+        for sufixo in ("", "-wal", "-shm"):
+            if os.path.exists(caminho + sufixo):
+                os.unlink(caminho + sufixo)
+    shutil.rmtree(pasta_estaticos, ignore_errors=True)
 
 
 @pytest.fixture
@@ -1,4 +1,5 @@
 import json
+import os
 
 # Função auxiliar para facilitar o login durante os testes.
 # Em vez de repetir client.post("/login", ...) em todo teste,
@@ -393,3 +394,2176 @@ def test_login_ja_logado_redireciona_para_index(client):
     res = client.get("/login", follow_redirects=False)
     assert res.status_code == 302
     assert "/index" in res.headers["Location"] or res.headers["Location"].endswith("/")
+
+
+# -------------------------------------------------------------------
+#                 TESTES DO POOL DE CONEXÕES SQLITE
+# -------------------------------------------------------------------
+
+def test_pool_reaproveita_conexao_entre_requisicoes(app):
+    """
+    A conexão usada numa requisição volta ao pool no fim do
+    app context e é reaproveitada pela próxima.
+    """
+    import app as app_module
+
+    with app.app_context():
+        primeira = app_module.db_connection()
+        # Dentro do mesmo contexto, sempre a mesma conexão
+        assert app_module.db_connection() is primeira
+
+    with app.app_context():
+        assert app_module.db_connection() is primeira
+
+
+def test_pool_aplica_pragmas_de_desempenho(app):
+    """
+    As conexões do pool saem configuradas com WAL, synchronous=NORMAL
+    e busy_timeout.
+    """
+    import app as app_module
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == app.config["SQLITE_BUSY_TIMEOUT_MS"]
+
+
+def test_pool_descarta_transacao_pendente_ao_devolver(app):
+    """
+    Uma transação esquecida aberta não vaza para a próxima requisição.
+    """
+    import app as app_module
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.execute("INSERT INTO rosh (nome) VALUES ('Temporario')")
+        assert conn.in_transaction
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        assert not conn.in_transaction
+        assert conn.execute("SELECT COUNT(*) FROM rosh WHERE nome = 'Temporario'").fetchone()[0] == 0
+
+
+# -------------------------------------------------------------------
+#                TESTES DA PAGINAÇÃO POR CURSOR (KEYSET)
+# -------------------------------------------------------------------
+
+def criar_pedidos(client, quantidade):
+    """
+    Cria vários pedidos via API (nomes "Cliente 1", "Cliente 2"...).
+    """
+    for i in range(1, quantidade + 1):
+        client.post(
+            "/api/pedido",
+            data=json.dumps({
+                "nome": f"Cliente {i}",
+                "rg": str(i),
+                "produto": "Aluguel Pequeno",
+                "rosh": "Mix",
+                "essencia": "Uva",
+                "observacao": "OK",
+            }),
+            content_type="application/json",
+        )
+
+
+def test_paginacao_percorre_paginas_com_cursor(client):
+    """
+    Com ?limit, a API devolve uma página por vez (mais novos primeiro)
+    e o cursor "proximo" leva à página seguinte até acabar.
+    """
+    criar_pedidos(client, 5)
+
+    res = client.get("/api/pedidos?limit=2&total=1")
+    assert res.status_code == 200
+    pagina = res.get_json()
+    assert [p["pedidoid"] for p in pagina["pedidos"]] == [5, 4]
+    assert pagina["total"] == 5
+    assert pagina["anterior"] is None
+
+    pagina = client.get(f"/api/pedidos?limit=2&after={pagina['proximo']}").get_json()
+    assert [p["pedidoid"] for p in pagina["pedidos"]] == [3, 2]
+    assert pagina["anterior"] == 3
+
+    pagina = client.get(f"/api/pedidos?limit=2&after={pagina['proximo']}").get_json()
+    assert [p["pedidoid"] for p in pagina["pedidos"]] == [1]
+    assert pagina["proximo"] is None
+
+
+def test_paginacao_before_volta_para_pagina_anterior(client):
+    """
+    O cursor "before" devolve a página imediatamente mais nova,
+    na mesma ordem (decrescente).
+    """
+    criar_pedidos(client, 5)
+
+    pagina = client.get("/api/pedidos/todos?limit=2&before=2").get_json()
+    assert [p["pedidoid"] for p in pagina["pedidos"]] == [4, 3]
+    assert pagina["proximo"] == 3
+    assert pagina["anterior"] == 4
+
+
+def test_paginacao_parametros_invalidos(client):
+    """
+    limit fora do intervalo ou cursores conflitantes → 400.
+    """
+    assert client.get("/api/pedidos?limit=0").status_code == 400
+    assert client.get("/api/pedidos?limit=abc").status_code == 400
+    assert client.get("/api/pedidos/todos?limit=2&after=5&before=1").status_code == 400
+
+
+# -------------------------------------------------------------------
+#                 TESTES DO STREAMING NDJSON DO HISTÓRICO
+# -------------------------------------------------------------------
+
+def test_historico_stream_ndjson(client, app, monkeypatch):
+    """
+    Com ?stream=1, /api/pedidos/todos devolve um pedido JSON por linha,
+    em ordem de pedidoid, mesmo quando há mais linhas que um lote.
+    """
+    monkeypatch.setitem(app.config, "STREAM_LOTE", 2)
+    criar_pedidos(client, 5)
+
+    res = client.get("/api/pedidos/todos?stream=1")
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+
+    linhas = res.get_data(as_text=True).splitlines()
+    pedidos = [json.loads(linha) for linha in linhas]
+    assert [p["pedidoid"] for p in pedidos] == [1, 2, 3, 4, 5]
+    assert pedidos[0]["name"] == "Cliente 1"
+
+
+def test_historico_stream_pelo_header_accept(client):
+    """
+    O header Accept: application/x-ndjson também ativa o streaming.
+    """
+    criar_pedidos(client, 1)
+    res = client.get("/api/pedidos/todos", headers={"Accept": "application/x-ndjson"})
+    assert res.mimetype == "application/x-ndjson"
+    assert json.loads(res.get_data(as_text=True))["name"] == "Cliente 1"
+
+
+# -------------------------------------------------------------------
+#            TESTES DA MIGRAÇÃO: EPOCH UTC E ÍNDICES EM PEDIDO
+# -------------------------------------------------------------------
+
+def test_migracao_cria_colunas_epoch_e_indices(app):
+    """
+    Na primeira conexão o app migra o schema: adiciona as colunas
+    epoch e os índices de acesso em "pedido".
+    """
+    import app as app_module
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        colunas = {c[1] for c in conn.execute("PRAGMA table_info(pedido)")}
+        indices = {i[1] for i in conn.execute("PRAGMA index_list(pedido)")}
+
+    assert {"criacao_epoch", "atualizacao_epoch"} <= colunas
+    assert {"idx_pedido_criacao_epoch", "idx_pedido_ativo_criacao", "idx_pedido_produto_criacao"} <= indices
+
+
+def test_criar_pedido_grava_epoch_e_texto_local(client, app):
+    """
+    O pedido criado guarda o instante em epoch UTC e o texto
+    "criacao" no horário local (UTC-3), derivado do mesmo instante.
+    """
+    import time
+    from datetime import datetime, timezone
+
+    antes = int(time.time())
+    criar_pedidos(client, 1)
+    pedido = client.get("/api/pedidos/todos").get_json()[0]
+
+    assert pedido["criacao_epoch"] >= antes
+    utc = datetime.fromtimestamp(pedido["criacao_epoch"], timezone.utc).replace(tzinfo=None)
+    local = datetime.strptime(pedido["criacao"], "%Y-%m-%d %H:%M:%S")
+    assert (utc - local).total_seconds() == -app.config["FUSO_HORARIO_HORAS"] * 3600
+
+
+def test_listar_pedidos_usa_indice_e_ignora_antigos(client, app):
+    """
+    Pedidos fora da janela de 60 dias não aparecem em /api/pedidos,
+    e o filtro é resolvido pelo índice em criacao_epoch.
+    """
+    import time
+    import app as app_module
+
+    criar_pedidos(client, 1)
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.execute(
+            "INSERT INTO pedido (name, rg, criacao_epoch) VALUES ('Antigo', '1', ?)",
+            (int(time.time()) - 90 * 86400,)
+        )
+        conn.commit()
+        plano = " ".join(
+            str(linha[3]) for linha in conn.execute(
+                f"EXPLAIN QUERY PLAN {app_module.SQL_PEDIDOS} WHERE {app_module.FILTRO_RECENTES}", (0,)
+            )
+        )
+
+    nomes = [p["name"] for p in client.get("/api/pedidos").get_json()]
+    assert nomes == ["Cliente 1"]
+    assert "idx_pedido_criacao_epoch" in plano
+
+
+# -------------------------------------------------------------------
+#              TESTES DO RESUMO DE FATURAMENTO (/api/resumo)
+# -------------------------------------------------------------------
+
+def test_resumo_soma_pedidos_com_preco_do_produto(client):
+    """
+    O resumo conta os pedidos por produto e calcula a receita com
+    o preço gravado em "produto" (Aluguel Pequeno = 40).
+    """
+    criar_pedidos(client, 3)
+
+    res = client.get("/api/resumo")
+    assert res.status_code == 200
+    dados = res.get_json()
+
+    item = next(i for i in dados["produtos"] if i["produto"] == "Aluguel Pequeno")
+    assert item["quantidade"] == 3
+    assert item["receita"] == 120
+    assert dados["total"] == {"quantidade": 3, "receita": 120}
+    assert len(dados["periodos"]) == 1
+
+
+def test_resumo_acompanha_edicao_e_exclusao(client, app):
+    """
+    Os triggers mantêm o resumo_diario em dia quando um pedido
+    muda de produto ou é excluído.
+    """
+    import app as app_module
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.execute("INSERT INTO produto (nome, preco) VALUES ('Reposição', 25)")
+        conn.commit()
+
+    criar_pedidos(client, 2)
+    client.put(
+        "/api/pedido/1",
+        data=json.dumps({
+            "nome": "Cliente 1", "rg": "1", "produto": "Reposição",
+            "rosh": "Mix", "essencia": "Uva", "observacao": "OK",
+        }),
+        content_type="application/json",
+    )
+    client.delete("/api/pedido/2")
+
+    dados = client.get("/api/resumo").get_json()
+    quantidades = {i["produto"]: i["quantidade"] for i in dados["produtos"]}
+    assert quantidades == {"Aluguel Pequeno": 0, "Reposição": 1}
+    assert dados["total"]["receita"] == 25
+
+
+def test_resumo_com_nome_de_produto_repetido(client, app):
+    """
+    Dois produtos com o mesmo nome no cadastro (a migração não
+    deduplica): os pedidos do segundo id contam no item dele, com o
+    preço dele, e não como "sem produto".
+    """
+    import app as app_module
+
+    criar_pedidos(client, 1)
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.execute("UPDATE produto SET preco = 40 WHERE produtoid = 1")
+        segundo = conn.execute("INSERT INTO produto (nome, preco) VALUES ('Aluguel Pequeno', 30)").lastrowid
+        conn.execute(
+            "INSERT INTO pedido (name, rg, nome_produto, nome_rosh, criacao_epoch) "
+            "VALUES ('Outro', '2', ?, 1, CAST(strftime('%s', 'now') AS INTEGER))",
+            (segundo,),
+        )
+        conn.commit()
+
+    resumo = client.get("/api/resumo").get_json()
+    itens = [(i["produto"], i["preco"], i["quantidade"]) for i in resumo["produtos"]]
+    assert itens == [("Aluguel Pequeno", 40, 1), ("Aluguel Pequeno", 30, 1)]
+    assert resumo["total"] == {"quantidade": 2, "receita": 70}
+
+
+def test_resumo_filtro_de_datas_e_validacao(client):
+    """
+    Fora do intervalo pedido não há pedidos; datas mal formatadas → 400.
+    """
+    criar_pedidos(client, 1)
+
+    dados = client.get("/api/resumo?de=2000-01-01&ate=2000-12-31&agrupar=mes").get_json()
+    assert dados["total"]["quantidade"] == 0
+    assert dados["periodos"] == []
+
+    assert client.get("/api/resumo?de=01/01/2000").status_code == 400
+    assert client.get("/api/resumo?agrupar=semana").status_code == 400
+
+
+# -------------------------------------------------------------------
+#              TESTES DO CATÁLOGO EM CACHE (/api/catalogo)
+# -------------------------------------------------------------------
+
+def test_catalogo_devolve_produtos_e_roshs_com_cache(client):
+    """
+    /api/catalogo junta produtos (com preço) e roshs, com ETag e
+    Cache-Control para o navegador reaproveitar a resposta.
+    """
+    res = client.get("/api/catalogo")
+    assert res.status_code == 200
+    dados = res.get_json()
+    assert {"nome": "Aluguel Pequeno", "preco": 40} in dados["produtos"]
+    assert dados["roshs"] == ["Mix"]
+    assert res.headers["ETag"]
+    assert "max-age" in res.headers["Cache-Control"]
+
+    # Revalidação com a mesma ETag → 304 sem corpo
+    res = client.get("/api/catalogo", headers={"If-None-Match": res.headers["ETag"]})
+    assert res.status_code == 304
+
+
+def test_catalogo_invalida_quando_produto_muda(client, app):
+    """
+    Alterar "produto" incrementa a versão (trigger) e o cache é
+    refeito: a ETag muda e o novo produto aparece nas duas rotas.
+    """
+    import app as app_module
+
+    antes = client.get("/api/produtos")
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.execute("INSERT INTO produto (nome, preco) VALUES ('Da casa', 0)")
+        conn.commit()
+
+    depois = client.get("/api/produtos", headers={"If-None-Match": antes.headers["ETag"]})
+    assert depois.status_code == 200
+    assert depois.headers["ETag"] != antes.headers["ETag"]
+    assert "Da casa" in depois.get_json()
+    assert "Da casa" in [p["nome"] for p in client.get("/api/catalogo").get_json()["produtos"]]
+
+
+# -------------------------------------------------------------------
+#          TESTES DO GET CONDICIONAL (ETag / If-None-Match)
+# -------------------------------------------------------------------
+
+def test_listagem_responde_304_quando_nada_mudou(client):
+    """
+    Repetir a listagem com a ETag recebida devolve 304 sem corpo.
+    """
+    criar_pedidos(client, 2)
+
+    res = client.get("/api/pedidos")
+    etag = res.headers["ETag"]
+    assert res.status_code == 200
+    assert "no-cache" in res.headers["Cache-Control"]
+
+    res = client.get("/api/pedidos", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.data == b""
+
+
+def test_listagem_etag_muda_apos_escrita(client):
+    """
+    Qualquer escrita em pedido (ex.: toggle de ativo) muda a versão
+    e invalida a ETag das duas listagens.
+    """
+    criar_pedidos(client, 1)
+    etag_recentes = client.get("/api/pedidos").headers["ETag"]
+    etag_todos = client.get("/api/pedidos/todos").headers["ETag"]
+
+    client.put(
+        "/api/pedido/1/ativo",
+        data=json.dumps({"ativo": 1}),
+        content_type="application/json",
+    )
+
+    res = client.get("/api/pedidos", headers={"If-None-Match": etag_recentes})
+    assert res.status_code == 200
+    assert res.get_json()[0]["ativo"] == 1
+    res = client.get("/api/pedidos/todos", headers={"If-None-Match": etag_todos})
+    assert res.status_code == 200
+
+
+def test_listagem_etag_muda_ao_renomear_produto(client, app):
+    """
+    Os pedidos saem com o nome do produto: renomear o produto no
+    catálogo invalida a ETag mesmo sem escrita em pedido.
+    """
+    import app as app_module
+
+    criar_pedidos(client, 1)
+    etag = client.get("/api/pedidos").headers["ETag"]
+
+    conn = app_module._abrir_conexao(app_module.DB_PATH)
+    conn.execute("UPDATE produto SET nome = 'Aluguel Mini' WHERE nome = 'Aluguel Pequeno'")
+    conn.commit()
+    conn.close()
+
+    res = client.get("/api/pedidos", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert "Aluguel Mini" in res.get_data(as_text=True)
+
+
+def test_listagem_etag_depende_dos_parametros(client):
+    """
+    Páginas diferentes têm ETags diferentes (a ETag de uma não
+    pode gerar 304 na outra).
+    """
+    criar_pedidos(client, 3)
+    etag = client.get("/api/pedidos?limit=1").headers["ETag"]
+
+    res = client.get("/api/pedidos?limit=2", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+
+
+def test_listagem_todos_valida_antes_do_304_e_ignora_a_hora(client, monkeypatch):
+    """
+    Parâmetro inválido é 400 mesmo com If-None-Match que casaria; a
+    ETag do histórico completo não muda quando vira a hora (só a das
+    recentes, que dependem da janela).
+    """
+    import time
+
+    criar_pedidos(client, 1)
+    for consulta in ("format=xml", "stream=talvez", "limit=abc"):
+        res = client.get(f"/api/pedidos/todos?{consulta}", headers={"If-None-Match": "*"})
+        assert res.status_code == 400, consulta
+
+    etag_todos = client.get("/api/pedidos/todos").headers["ETag"]
+    etag_recentes = client.get("/api/pedidos").headers["ETag"]
+
+    agora = time.time()
+    monkeypatch.setattr(time, "time", lambda: agora + 3600)
+    assert client.get("/api/pedidos/todos", headers={"If-None-Match": etag_todos}).status_code == 304
+    assert client.get("/api/pedidos", headers={"If-None-Match": etag_recentes}).status_code == 200
+
+
+# -------------------------------------------------------------------
+#            TESTES DO FEED DE ALTERAÇÕES (/api/pedidos/changes)
+# -------------------------------------------------------------------
+
+def test_changes_nao_perde_escrita_entre_listagem_e_versao(client, app, monkeypatch):
+    """
+    Uma escrita que entra logo depois da consulta da página (antes da
+    resposta) aparece no /changes a partir da versão devolvida.
+    """
+    import app as app_module
+
+    criar_pedidos(client, 1)
+    consultar = app_module._consultar_tuplas
+
+    def consultar_e_escrever(conn, sql, params):
+        resultado = consultar(conn, sql, params)
+        escrita = app_module._abrir_conexao(app_module.DB_PATH)
+        escrita.execute("UPDATE pedido SET essencia = 'Menta' WHERE pedidoid = 1")
+        escrita.commit()
+        escrita.close()
+        return resultado
+
+    monkeypatch.setattr(app_module, "_consultar_tuplas", consultar_e_escrever)
+    pagina = client.get("/api/pedidos?limit=10").get_json()
+    monkeypatch.setattr(app_module, "_consultar_tuplas", consultar)
+
+    assert pagina["pedidos"][0]["essencia"] == "Uva"
+    alterados = client.get(f"/api/pedidos/changes?since={pagina['versao']}").get_json()["alterados"]
+    assert [(p["pedidoid"], p["essencia"]) for p in alterados] == [(1, "Menta")]
+
+
+def test_changes_devolve_somente_o_que_mudou(client):
+    """
+    Depois de pegar a versão da listagem, o feed devolve apenas os
+    pedidos criados/alterados e os ids excluídos desde então.
+    """
+    criar_pedidos(client, 3)
+    versao = client.get("/api/pedidos?limit=10").get_json()["versao"]
+
+    client.put(
+        "/api/pedido/2/ativo",
+        data=json.dumps({"ativo": 1}),
+        content_type="application/json",
+    )
+    client.delete("/api/pedido/3")
+    criar_pedidos(client, 1)  # vira o pedido 4
+
+    res = client.get(f"/api/pedidos/changes?since={versao}")
+    assert res.status_code == 200
+    delta = res.get_json()
+
+    assert [p["pedidoid"] for p in delta["alterados"]] == [2, 4]
+    assert delta["alterados"][0]["ativo"] == 1
+    assert delta["excluidos"] == [3]
+    assert delta["mais"] is False
+
+    # Sem novas escritas, o feed volta vazio
+    vazio = client.get(f"/api/pedidos/changes?since={delta['versao']}").get_json()
+    assert vazio["alterados"] == [] and vazio["excluidos"] == []
+
+
+def test_changes_paginado_pelo_limit(client):
+    """
+    Com limit menor que o número de alterações, o feed devolve
+    "mais": true e a versão de onde continuar.
+    """
+    criar_pedidos(client, 3)
+
+    primeira = client.get("/api/pedidos/changes?since=0&limit=2").get_json()
+    assert [p["pedidoid"] for p in primeira["alterados"]] == [1, 2]
+    assert primeira["mais"] is True
+
+    segunda = client.get(f"/api/pedidos/changes?since={primeira['versao']}&limit=2").get_json()
+    assert [p["pedidoid"] for p in segunda["alterados"]] == [3]
+    assert segunda["mais"] is False
+
+
+def test_changes_valida_parametros_e_versao_futura(client):
+    """
+    since ausente → 400; since maior que a versão do banco → recarregar.
+    """
+    assert client.get("/api/pedidos/changes").status_code == 400
+    assert client.get("/api/pedidos/changes?since=999999").get_json()["recarregar"] is True
+
+
+# -------------------------------------------------------------------
+#              TESTES DOS EVENTOS EM TEMPO REAL (SSE)
+# -------------------------------------------------------------------
+
+def ler_evento(fluxo):
+    """
+    Lê o próximo bloco do stream SSE ignorando heartbeats (": ping").
+    """
+    while True:
+        bloco = next(fluxo).decode()
+        if not bloco.startswith(":"):
+            return bloco
+
+
+def test_eventos_sse_recebe_escritas_de_pedido(client, app, monkeypatch):
+    """
+    Uma estação conectada em /api/eventos recebe um evento para
+    cada criação e toggle de ativo, com id para retomada.
+    """
+    monkeypatch.setitem(app.config, "EVENTOS_HEARTBEAT_S", 0.05)
+
+    res = client.get("/api/eventos")
+    assert res.mimetype == "text/event-stream"
+    fluxo = iter(res.response)
+    assert ler_evento(fluxo).startswith("retry:")
+
+    criar_pedidos(client, 1)
+    client.put(
+        "/api/pedido/1/ativo",
+        data=json.dumps({"ativo": 1}),
+        content_type="application/json",
+    )
+
+    criado = ler_evento(fluxo)
+    assert criado.startswith("id: ")
+    dados = json.loads(criado.split("data: ", 1)[1])
+    assert dados["tipo"] == "criado" and dados["pedidoid"] == 1
+
+    ativo = json.loads(ler_evento(fluxo).split("data: ", 1)[1])
+    assert ativo["tipo"] == "ativo"
+    assert ativo["versao"] > dados["versao"]
+
+    res.close()
+
+
+def test_eventos_retoma_com_last_event_id(client, app, monkeypatch):
+    """
+    Reconectando com Last-Event-ID, o cliente recebe os eventos
+    publicados enquanto estava desconectado.
+    """
+    monkeypatch.setitem(app.config, "EVENTOS_HEARTBEAT_S", 0.05)
+
+    res = client.get("/api/eventos")
+    fluxo = iter(res.response)
+    ler_evento(fluxo)
+    criar_pedidos(client, 1)
+    ultimo_id = ler_evento(fluxo).split("\n")[0].split(": ")[1]
+    res.close()
+
+    criar_pedidos(client, 1)  # publicado sem ninguém ouvindo
+
+    res = client.get("/api/eventos", headers={"Last-Event-ID": ultimo_id})
+    fluxo = iter(res.response)
+    ler_evento(fluxo)
+    perdido = json.loads(ler_evento(fluxo).split("data: ", 1)[1])
+    assert perdido["pedidoid"] == 2
+    res.close()
+
+
+def test_eventos_fila_cheia_pede_recarga(app, monkeypatch):
+    """
+    Um cliente lento não acumula eventos além do limite: a fila é
+    descartada e ele recebe "recarregar".
+    """
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "EVENTOS_FILA_ASSINANTE", 2)
+    monkeypatch.setitem(app.config, "EVENTOS_POLL_S", 0)
+    broker = app_module.BrokerEventos()
+    assinante = broker.assinar()
+
+    for i in range(5):
+        broker.publicar({"tipo": "criado", "pedidoid": i})
+
+    recarregar, eventos = assinante.aguardar(0)
+    assert recarregar is True
+    assert len(eventos) <= 2
+
+
+# -------------------------------------------------------------------
+#                  TESTES DAS ROTAS EM LOTE (BATCH)
+# -------------------------------------------------------------------
+
+def test_lote_cria_varios_pedidos_em_uma_transacao(client):
+    """
+    POST /api/pedidos/batch cria todos os pedidos e devolve o id
+    de cada item, na ordem enviada.
+    """
+    criar_pedidos(client, 1)
+    lote = [
+        {"nome": f"Lote {i}", "rg": str(i), "produto": "Aluguel Pequeno", "rosh": "Mix",
+         "essencia": "Uva", "observacao": "OK"}
+        for i in range(3)
+    ]
+
+    res = client.post("/api/pedidos/batch", json={"pedidos": lote})
+    assert res.status_code == 201
+    resultados = res.get_json()["resultados"]
+    assert [r["pedidoid"] for r in resultados] == [2, 3, 4]
+
+    nomes = {p["pedidoid"]: p["name"] for p in client.get("/api/pedidos/todos").get_json()}
+    assert nomes[2] == "Lote 0" and nomes[4] == "Lote 2"
+
+
+def test_lote_invalido_nao_grava_nada(client):
+    """
+    Se qualquer item for inválido, a resposta é 400 com o erro por
+    item e nenhum pedido é criado.
+    """
+    res = client.post("/api/pedidos/batch", json={"pedidos": [
+        {"nome": "Ok", "rg": "1"},
+        {"nome": "", "rg": "2"},
+    ]})
+    assert res.status_code == 400
+    assert res.get_json()["resultados"][0]["indice"] == 1
+    assert client.get("/api/pedidos/todos").get_json() == []
+
+
+def test_lote_que_nao_e_lista_responde_400(client):
+    """
+    "pedidos", "atualizacoes" ou "ativos" que não sejam listas
+    (número, texto, objeto) → 400, sem erro interno.
+    """
+    for corpo in ({"pedidos": 5}, {"pedidos": "abc"}, {"pedidos": {"nome": "X"}}):
+        assert client.post("/api/pedidos/batch", json=corpo).status_code == 400
+
+    criar_pedidos(client, 1)
+    for corpo in ({"atualizacoes": 5}, {"ativos": "abc"}, {"ativos": [{"id": 1, "ativo": 1}], "atualizacoes": {}}):
+        assert client.patch("/api/pedidos/batch", json=corpo).status_code == 400
+    assert client.get("/api/pedidos/todos").get_json()[0]["ativo"] == 0
+
+
+def test_lote_patch_atualiza_e_alterna_ativo(client):
+    """
+    PATCH /api/pedidos/batch aplica edições e toggles juntos;
+    ids inexistentes aparecem como erro no próprio item.
+    """
+    criar_pedidos(client, 3)
+
+    res = client.patch("/api/pedidos/batch", json={
+        "atualizacoes": [{"id": 1, "nome": "Editado", "rg": "9", "produto": "Aluguel Pequeno",
+                          "rosh": "Mix", "essencia": "Menta", "observacao": "Alterado"}],
+        "ativos": [{"id": 2, "ativo": 1}, {"id": 3, "ativo": 1}, {"id": 99, "ativo": 1}],
+    })
+    assert res.status_code == 200
+    resultados = res.get_json()["resultados"]
+    assert [r["ok"] for r in resultados] == [True, True, True, False]
+    assert resultados[-1]["error"] == "Pedido não encontrado"
+
+    pedidos = {p["pedidoid"]: p for p in client.get("/api/pedidos/todos").get_json()}
+    assert pedidos[1]["name"] == "Editado" and pedidos[1]["essencia"] == "Menta"
+    assert pedidos[2]["ativo"] == 1 and pedidos[3]["ativo"] == 1
+
+
+def test_lote_patch_valida_ativo(client):
+    """
+    Um toggle com valor inválido cancela o lote (400).
+    """
+    criar_pedidos(client, 1)
+    res = client.patch("/api/pedidos/batch", json={"ativos": [{"id": 1, "ativo": 5}]})
+    assert res.status_code == 400
+    assert client.get("/api/pedidos/todos").get_json()[0]["ativo"] == 0
+
+
+# -------------------------------------------------------------------
+#          TESTES DO ESCRITOR ÚNICO (FILA + GROUP COMMIT)
+# -------------------------------------------------------------------
+
+def test_escritor_unico_atende_as_rotas_de_escrita(client, app, monkeypatch):
+    """
+    Com SQLITE_ESCRITOR_UNICO ligado, criar, editar, alternar e
+    excluir continuam funcionando (passando pela thread escritora).
+    """
+    monkeypatch.setitem(app.config, "SQLITE_ESCRITOR_UNICO", True)
+
+    criar_pedidos(client, 2)
+    res = client.put(
+        "/api/pedido/1/ativo",
+        data=json.dumps({"ativo": 1}),
+        content_type="application/json",
+    )
+    assert res.status_code == 200
+    assert client.delete("/api/pedido/2").status_code == 200
+    res = client.post("/api/pedidos/batch", json={"pedidos": [{"nome": "Lote", "rg": "1"}]})
+    assert res.get_json()["resultados"][0]["pedidoid"] == 3
+
+    pedidos = client.get("/api/pedidos/todos").get_json()
+    assert [(p["pedidoid"], p["ativo"]) for p in pedidos] == [(1, 1), (3, 0)]
+
+
+def test_escritor_unico_agrupa_escritas_concorrentes(app, monkeypatch):
+    """
+    Escritas enviadas ao mesmo tempo por várias threads são gravadas
+    em menos transações do que escritas (group commit), e cada uma
+    recebe o próprio resultado — inclusive o erro de quem falhou.
+    """
+    import threading
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "ESCRITOR_JANELA_MS", 50)
+    with app.app_context():
+        escritor = app_module._obter_escritor()
+
+    resultados = {}
+
+    def escrever(i):
+        def funcao(conn):
+            if i == 3:
+                raise ValueError("falha proposital")
+            return conn.execute("INSERT INTO rosh (nome) VALUES (?)", (f"R{i}",)).lastrowid
+        try:
+            resultados[i] = escritor.executar(funcao)
+        except ValueError as e:
+            resultados[i] = e
+
+    threads = [threading.Thread(target=escrever, args=(i,)) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert isinstance(resultados[3], ValueError)
+    assert len({v for k, v in resultados.items() if k != 3}) == 9
+    assert escritor.escritas == 10
+    assert escritor.transacoes < escritor.escritas
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        assert conn.execute("SELECT COUNT(*) FROM rosh WHERE nome LIKE 'R%'").fetchone()[0] == 9
+
+
+def test_escritor_unico_fila_cheia_responde_503(client, app, monkeypatch):
+    """
+    Com a fila cheia, a escrita não espera para sempre: a rota
+    responde 503 com Retry-After.
+    """
+    import threading
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "SQLITE_ESCRITOR_UNICO", True)
+    monkeypatch.setitem(app.config, "ESCRITOR_FILA_MAXIMA", 1)
+    monkeypatch.setitem(app.config, "ESCRITOR_ESPERA_FILA_S", 0.05)
+    app_module.fechar_conexoes()  # recria o escritor com a fila menor
+
+    with app.app_context():
+        escritor = app_module._obter_escritor()
+
+    liberar = threading.Event()
+    ocupado = threading.Event()
+
+    def travar(conn):
+        ocupado.set()
+        liberar.wait(5)
+
+    bloqueio = threading.Thread(target=escritor.executar, args=(travar,))
+    bloqueio.start()
+    ocupado.wait(5)
+    escritor.fila.put((lambda conn: None, app_module.Future()))  # ocupa a única vaga
+
+    res = client.delete("/api/pedido/1")
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+
+    liberar.set()
+    bloqueio.join()
+
+
+def test_escritor_unico_sem_resposta_responde_503_e_cancela(client, app, monkeypatch):
+    """
+    Estourado ESCRITOR_TIMEOUT_S: a rota responde 503 com Retry-After
+    (não 500). A escrita que ainda estava na fila é cancelada e não é
+    gravada depois; a que já tinha começado avisa que pode ter sido.
+    """
+    import threading
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "SQLITE_ESCRITOR_UNICO", True)
+    monkeypatch.setitem(app.config, "ESCRITOR_TIMEOUT_S", 0.2)
+    app_module.fechar_conexoes()
+
+    with app.app_context():
+        escritor = app_module._obter_escritor()
+
+    liberar = threading.Event()
+    ocupado = threading.Event()
+
+    def travar(conn):
+        ocupado.set()
+        liberar.wait(5)
+
+    demorada = {}
+
+    def esperar_travada():
+        try:
+            escritor.executar(travar)
+        except app_module.EscritaSemResposta as e:
+            demorada["talvez_gravada"] = e.talvez_gravada
+
+    bloqueio = threading.Thread(target=esperar_travada)
+    bloqueio.start()
+    ocupado.wait(5)
+
+    res = client.post("/api/pedido", json={"nome": "Na fila", "rg": "1", "produto": "Aluguel Pequeno", "rosh": "Mix"})
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+    assert res.get_json()["talvez_gravada"] is False
+
+    liberar.set()
+    bloqueio.join()
+    assert demorada == {"talvez_gravada": True}
+
+    escritor.executar(lambda conn: None)  # a fila andou: o cancelado já passou
+    assert client.get("/api/pedidos/todos").get_json() == []
+
+
+# -------------------------------------------------------------------
+#              TESTES DA BUSCA TEXTUAL (/api/pedidos/busca)
+# -------------------------------------------------------------------
+
+def test_busca_por_prefixo_sem_acento(client):
+    """
+    A busca casa prefixos de palavras, ignora acentos e procura
+    em vários campos (nome, essência, observação...).
+    """
+    criar_pedidos(client, 2)
+    client.post("/api/pedido", json={
+        "nome": "João Mendonça", "rg": "77", "produto": "Aluguel Pequeno",
+        "rosh": "Mix", "essencia": "Menta", "observacao": "Mesa externa",
+    })
+
+    res = client.get("/api/pedidos/busca?q=joao")
+    assert res.status_code == 200
+    assert [p["name"] for p in res.get_json()["pedidos"]] == ["João Mendonça"]
+
+    assert len(client.get("/api/pedidos/busca?q=ment ext").get_json()["pedidos"]) == 1
+    assert len(client.get("/api/pedidos/busca?q=uva").get_json()["pedidos"]) == 2
+
+
+def test_busca_acompanha_edicao_e_exclusao(client):
+    """
+    Os triggers mantêm o índice FTS em dia com PUT e DELETE.
+    """
+    criar_pedidos(client, 2)
+    client.put("/api/pedido/1", json={
+        "nome": "Renomeado", "rg": "1", "produto": "Aluguel Pequeno",
+        "rosh": "Mix", "essencia": "Uva", "observacao": "OK",
+    })
+    client.delete("/api/pedido/2")
+
+    assert client.get("/api/pedidos/busca?q=cliente").get_json()["pedidos"] == []
+    assert client.get("/api/pedidos/busca?q=renom").get_json()["pedidos"][0]["pedidoid"] == 1
+
+
+def test_busca_paginada_e_consulta_vazia(client):
+    """
+    limit/pagina dividem os resultados; texto sem palavras → lista vazia.
+    """
+    criar_pedidos(client, 3)
+
+    primeira = client.get("/api/pedidos/busca?q=cliente&limit=2").get_json()
+    assert len(primeira["pedidos"]) == 2 and primeira["mais"] is True
+    segunda = client.get("/api/pedidos/busca?q=cliente&limit=2&pagina=2").get_json()
+    assert len(segunda["pedidos"]) == 1 and segunda["mais"] is False
+
+    assert client.get('/api/pedidos/busca?q="*').get_json()["pedidos"] == []
+    assert client.get("/api/pedidos/busca?q=x&limit=0").status_code == 400
+
+
+# -------------------------------------------------------------------
+#            TESTES DO ARQUIVAMENTO (banco quente / arquivo)
+# -------------------------------------------------------------------
+
+def envelhecer_pedidos(app, ids, dias=400):
+    """Recua a data de criação dos pedidos indicados em "dias"."""
+    import app as app_module
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.executemany(
+            "UPDATE pedido SET criacao_epoch = criacao_epoch - ? WHERE pedidoid = ?",
+            [(dias * 86400, i) for i in ids],
+        )
+        conn.commit()
+
+
+def test_arquivamento_recusa_idade_menor_que_a_janela(client, app, monkeypatch):
+    """
+    ARQUIVO_IDADE_DIAS abaixo de JANELA_RECENTES_DIAS falha na subida
+    (o arquivamento tiraria pedidos da listagem sem mudar a ETag).
+    """
+    import threading
+    import pytest
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "ARQUIVO_IDADE_DIAS", app.config["JANELA_RECENTES_DIAS"] - 1)
+    iniciadas = threading.active_count()
+    with pytest.raises(RuntimeError):
+        app_module.iniciar_arquivamento_automatico()
+    assert threading.active_count() == iniciadas
+    with app.app_context(), pytest.raises(RuntimeError):
+        app_module.arquivar_pedidos_antigos()
+
+
+def test_arquivamento_move_pedidos_antigos_em_lotes(client, app, monkeypatch):
+    """
+    Pedidos mais velhos que ARQUIVO_IDADE_DIAS saem do banco principal
+    e vão para o arquivo, em lotes de ARQUIVO_LOTE; os recentes ficam.
+    """
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "ARQUIVO_LOTE", 2)
+    monkeypatch.setitem(app.config, "ARQUIVO_PAUSA_S", 0)
+    criar_pedidos(client, 5)
+    envelhecer_pedidos(app, [1, 2, 3])
+
+    with app.app_context():
+        assert app_module.arquivar_pedidos_antigos() == 3
+        assert app_module.arquivar_pedidos_antigos() == 0
+
+        conn = app_module.db_connection()
+        assert [r[0] for r in conn.execute("SELECT pedidoid FROM main.pedido")] == [4, 5]
+        app_module._anexar_arquivo(conn)
+        assert [r[0] for r in conn.execute("SELECT pedidoid FROM arquivo.pedido ORDER BY 1")] == [1, 2, 3]
+
+    assert os.path.exists(app_module._caminho_arquivo())
+
+
+def test_todos_e_busca_leem_os_dois_bancos(client, app):
+    """
+    /todos (lista, páginas e NDJSON) e a busca enxergam os pedidos
+    arquivados; a listagem principal (60 dias) não muda.
+    """
+    import app as app_module
+
+    criar_pedidos(client, 4)
+    envelhecer_pedidos(app, [1, 3])
+    with app.app_context():
+        app_module.arquivar_pedidos_antigos()
+
+    todos = client.get("/api/pedidos/todos").get_json()
+    assert [p["pedidoid"] for p in todos] == [1, 2, 3, 4]
+
+    pagina = client.get("/api/pedidos/todos?limit=3&total=1").get_json()
+    assert [p["pedidoid"] for p in pagina["pedidos"]] == [4, 3, 2]
+    assert pagina["total"] == 4
+    seguinte = client.get(f"/api/pedidos/todos?limit=3&after={pagina['proximo']}").get_json()
+    assert [p["pedidoid"] for p in seguinte["pedidos"]] == [1]
+
+    linhas = client.get("/api/pedidos/todos?stream=1").get_data(as_text=True).splitlines()
+    assert [json.loads(l)["pedidoid"] for l in linhas] == [1, 2, 3, 4]
+
+    assert [p["pedidoid"] for p in client.get("/api/pedidos").get_json()] == [2, 4]
+
+    busca = client.get("/api/pedidos/busca?q=cliente").get_json()["pedidos"]
+    assert sorted(p["pedidoid"] for p in busca) == [1, 2, 3, 4]
+    recentes = client.get("/api/pedidos/busca?q=cliente&recentes=1").get_json()["pedidos"]
+    assert sorted(p["pedidoid"] for p in recentes) == [2, 4]
+
+
+def test_escrita_em_pedido_arquivado_ou_inexistente(client, app):
+    """
+    Pedido arquivado é só leitura: PUT/DELETE respondem 409 sem
+    mexer em nada (no PATCH em lote, erro no item); id que não
+    existe em lugar nenhum → 404.
+    """
+    import app as app_module
+
+    criar_pedidos(client, 2)
+    envelhecer_pedidos(app, [1])
+    with app.app_context():
+        app_module.arquivar_pedidos_antigos()
+    pedido = {"nome": "Editado", "rg": "1", "produto": "Aluguel Pequeno", "rosh": "Mix"}
+
+    assert client.put("/api/pedido/1", json=pedido).status_code == 409
+    assert client.put("/api/pedido/1/ativo", json={"ativo": 1}).status_code == 409
+    res = client.delete("/api/pedido/1")
+    assert res.status_code == 409 and res.get_json()["error"] == "Pedido arquivado: somente leitura"
+
+    assert client.put("/api/pedido/99", json=pedido).status_code == 404
+    assert client.put("/api/pedido/99/ativo", json={"ativo": 1}).status_code == 404
+    assert client.delete("/api/pedido/99").status_code == 404
+
+    # No PATCH em lote, o arquivado vem com o mesmo erro de só leitura
+    res = client.patch("/api/pedidos/batch", json={
+        "ativos": [{"id": 1, "ativo": 1}, {"id": 2, "ativo": 1}, {"id": 99, "ativo": 1}],
+    })
+    assert [(r["ok"], r.get("error")) for r in res.get_json()["resultados"]] == [
+        (False, "Pedido arquivado: somente leitura"), (True, None), (False, "Pedido não encontrado"),
+    ]
+
+    assert client.put("/api/pedido/2/ativo", json={"ativo": 1}).status_code == 200
+    todos = {p["pedidoid"]: p for p in client.get("/api/pedidos/todos").get_json()}
+    assert todos[1]["name"] == "Cliente 1" and todos[1]["ativo"] == 0
+
+
+def test_arquivamento_preserva_resumo_e_nao_gera_exclusoes(client, app):
+    """
+    Mover para o arquivo não é excluir: o resumo continua contando
+    os pedidos e o feed de alterações não recebe tombstones.
+    """
+    import app as app_module
+
+    criar_pedidos(client, 3)
+    envelhecer_pedidos(app, [1, 2])
+    antes = client.get("/api/resumo?de=2000-01-01").get_json()["total"]
+    versao = client.get("/api/pedidos/changes?since=0").get_json()["versao"]
+
+    with app.app_context():
+        app_module.arquivar_pedidos_antigos()
+
+    assert client.get("/api/resumo?de=2000-01-01").get_json()["total"] == antes
+    feed = client.get(f"/api/pedidos/changes?since={versao}").get_json()
+    assert feed["excluidos"] == [] and feed["versao"] == versao
+
+
+# -------------------------------------------------------------------
+#              TESTES DA PROTEÇÃO DO LOGIN (limites e hash)
+# -------------------------------------------------------------------
+
+def test_login_limitado_por_ip(client, app, monkeypatch):
+    """
+    Passada a rajada de tentativas do mesmo IP, o login responde 429
+    com Retry-After, sem verificar a senha.
+    """
+    monkeypatch.setitem(app.config, "LOGIN_IP_RAJADA", 3)
+
+    for _ in range(3):
+        assert login(client, "adm", "errada").status_code == 302
+
+    res = login(client, "adm", "admin123")
+    assert res.status_code == 429
+    assert int(res.headers["Retry-After"]) >= 1
+    with client.session_transaction() as sess:
+        assert "usuario" not in sess
+
+
+def test_login_limitado_por_usuario(client, app, monkeypatch):
+    """
+    O balde por usuário barra as tentativas contra um nome sem
+    afetar o login dos outros usuários.
+    """
+    monkeypatch.setitem(app.config, "LOGIN_USUARIO_RAJADA", 2)
+
+    login(client, "adm", "x")
+    login(client, "adm", "y")
+    assert login(client, "adm", "admin123").status_code == 429
+
+    res = login(client, "Teste", "Teste")
+    assert res.status_code == 302
+    with client.session_transaction() as sess:
+        assert sess["usuario"] == "Teste"
+
+
+def test_login_usuario_inexistente_vai_para_cache_negativo(client):
+    """
+    Um nome inexistente é guardado no cache negativo e a resposta
+    é a mesma de uma senha errada.
+    """
+    import app as app_module
+
+    res = login(client, "fantasma", "qualquer")
+    assert res.status_code == 302 and res.headers["Location"].endswith("/login")
+    assert app_module._usuario_desconhecido("fantasma")
+    assert not app_module._usuario_desconhecido("adm")
+
+
+def test_login_regrava_hash_com_parametros_novos(client, app, monkeypatch):
+    """
+    Mudando LOGIN_HASH_METODO, o hash do usuário é refeito no
+    próximo login bem-sucedido e continua valendo.
+    """
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "LOGIN_HASH_METODO", "pbkdf2:sha256:1000")
+    assert login(client, "adm", "admin123").status_code == 302
+
+    with app.app_context():
+        senha = app_module.db_connection().execute(
+            "SELECT senha FROM user WHERE nome = 'adm'"
+        ).fetchone()[0]
+    assert senha.startswith("pbkdf2:sha256:1000$")
+
+    client.get("/logout")
+    res = login(client, "adm", "admin123")
+    assert res.status_code == 302 and not res.headers["Location"].endswith("/login")
+
+
+# -------------------------------------------------------------------
+#              TESTES DO SERVIDOR DE PRODUÇÃO (serve.py)
+# -------------------------------------------------------------------
+
+def test_serve_monta_opcoes_do_gunicorn(monkeypatch):
+    """
+    Linha de comando e variáveis de ambiente viram as opções do
+    gunicorn (workers com threads, fila e timeouts).
+    """
+    import serve
+
+    monkeypatch.setenv("SERVE_THREADS", "8")
+    opcoes = serve.opcoes_gunicorn(serve.argumentos(["--workers", "3", "--backlog", "64"]))
+
+    assert opcoes["workers"] == 3 and opcoes["threads"] == 8
+    assert opcoes["worker_class"] == "gthread"
+    assert opcoes["backlog"] == 64
+    assert opcoes["post_fork"] is serve._pos_fork
+
+
+def test_serve_limita_eventos_pelas_threads(app, monkeypatch):
+    """
+    O limite de conexões SSE por processo sai das threads, deixando
+    sobra para as rotas de pedidos; sem sobra, nem inicia.
+    """
+    import pytest
+    import serve
+
+    monkeypatch.setitem(app.config, "EVENTOS_MAX_ASSINANTES", 200)
+    assert serve.limitar_eventos(serve.argumentos([])) == 12  # 16 threads - 4 livres
+    assert app.config["EVENTOS_MAX_ASSINANTES"] == 12
+    assert serve.limitar_eventos(serve.argumentos(["--threads", "64"])) == 12  # nunca aumenta
+
+    with pytest.raises(SystemExit):
+        serve.argumentos(["--threads", "4"])
+
+
+def test_serve_pos_fork_descarta_conexoes_herdadas(client, app, monkeypatch):
+    """
+    Depois do fork o worker não reaproveita o pool do processo pai.
+    """
+    import app as app_module
+    import serve
+
+    monkeypatch.setattr(app_module, "iniciar_arquivamento_automatico", lambda: None)
+    client.get("/api/pedidos")
+    assert app_module._pools
+
+    serve._pos_fork(None, None)
+    assert not app_module._pools
+
+
+# -------------------------------------------------------------------
+#              TESTES DA COMPRESSÃO GZIP DAS RESPOSTAS
+# -------------------------------------------------------------------
+
+def test_gzip_comprime_listagem_quando_aceito(client):
+    """
+    Com Accept-Encoding: gzip, a listagem grande vem comprimida
+    (com Vary e ETag fraca) e o 304 continua funcionando.
+    """
+    import gzip
+
+    criar_pedidos(client, 30)
+    res = client.get("/api/pedidos/todos", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in res.headers["Vary"]
+    assert len(json.loads(gzip.decompress(res.data))) == 30
+
+    etag = res.headers["ETag"]
+    assert etag.startswith('W/"')
+    res304 = client.get(
+        "/api/pedidos/todos", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert res304.status_code == 304
+
+    sem_gzip = client.get("/api/pedidos/todos")
+    assert "Content-Encoding" not in sem_gzip.headers
+    assert len(sem_gzip.get_json()) == 30
+
+
+def test_gzip_ignora_respostas_pequenas(client, app, monkeypatch):
+    """
+    Abaixo de GZIP_MINIMO_BYTES a resposta vai sem compressão.
+    """
+    criar_pedidos(client, 1)
+    res = client.get("/api/pedidos", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in res.headers
+
+    monkeypatch.setitem(app.config, "GZIP_MINIMO_BYTES", 10)
+    res = client.get("/api/pedidos", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+
+
+def test_gzip_em_streaming_ndjson(client, app, monkeypatch):
+    """
+    O NDJSON é comprimido em partes (uma por lote do cursor) e o
+    resultado descomprime para todas as linhas.
+    """
+    import zlib
+
+    monkeypatch.setitem(app.config, "STREAM_LOTE", 2)
+    criar_pedidos(client, 5)
+
+    res = client.get("/api/pedidos/todos?stream=1", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in res.headers
+
+    texto = zlib.decompress(res.data, 16 + zlib.MAX_WBITS).decode()
+    assert [json.loads(l)["pedidoid"] for l in texto.splitlines()] == [1, 2, 3, 4, 5]
+
+
+# -------------------------------------------------------------------
+#              TESTES DO FORMATO COLUNAR (?format=columnar)
+# -------------------------------------------------------------------
+
+def decodificar_colunar(bloco):
+    """Mesma decodificação feita pelo JS: colunas → lista de pedidos."""
+    colunas = []
+    for nome, valores in zip(bloco["colunas"], bloco["valores"]):
+        dicionario = bloco["dicionarios"].get(nome)
+        colunas.append([dicionario[i] for i in valores] if dicionario else valores)
+    return [dict(zip(bloco["colunas"], linha)) for linha in zip(*colunas)]
+
+
+def test_colunar_equivale_ao_json_com_dicionario(client):
+    """
+    O formato colunar traz os mesmos pedidos do JSON normal, com
+    produto e rosh codificados por dicionário.
+    """
+    criar_pedidos(client, 3)
+
+    normal = client.get("/api/pedidos/todos").get_json()
+    bloco = client.get("/api/pedidos/todos?format=columnar").get_json()
+
+    assert bloco["linhas"] == 3
+    assert bloco["dicionarios"]["nome_produto"] == ["Aluguel Pequeno"]
+    assert bloco["valores"][bloco["colunas"].index("nome_produto")] == [0, 0, 0]
+    assert decodificar_colunar(bloco) == normal
+
+
+def test_colunar_paginado_e_formato_invalido(client):
+    """
+    Na paginação só a lista "pedidos" muda de formato; os cursores
+    continuam iguais. Formato desconhecido → 400.
+    """
+    criar_pedidos(client, 3)
+
+    dados = client.get("/api/pedidos?limit=2&format=columnar").get_json()
+    assert [p["pedidoid"] for p in decodificar_colunar(dados["pedidos"])] == [3, 2]
+    assert dados["proximo"] == 2
+
+    vazio = client.get("/api/pedidos?limit=2&after=1&format=columnar").get_json()
+    assert vazio["pedidos"]["linhas"] == 0 and vazio["proximo"] is None
+
+    assert client.get("/api/pedidos?format=xml").status_code == 400
+
+
+def test_colunar_em_streaming_um_bloco_por_lote(client, app, monkeypatch):
+    """
+    Com stream=1 cada linha do NDJSON é um bloco colunar de um lote.
+    """
+    monkeypatch.setitem(app.config, "STREAM_LOTE", 2)
+    criar_pedidos(client, 5)
+
+    linhas = client.get("/api/pedidos/todos?stream=1&format=columnar").get_data(as_text=True).splitlines()
+    blocos = [json.loads(l) for l in linhas]
+    assert [b["linhas"] for b in blocos] == [2, 2, 1]
+    assert [p["pedidoid"] for b in blocos for p in decodificar_colunar(b)] == [1, 2, 3, 4, 5]
+
+
+# -------------------------------------------------------------------
+#                 TESTES DO BENCHMARK (benchmark.py)
+# -------------------------------------------------------------------
+
+def test_benchmark_gerador_cobre_produtos_roshs_e_periodo():
+    """
+    O gerador sintético cria a quantidade pedida, usa todos os
+    produtos e roshs e espalha os pedidos pelos meses pedidos.
+    """
+    import app as app_module
+    import benchmark
+
+    pedidos = list(benchmark.gerar_pedidos(2000, meses=3, semente=1))
+    assert len(pedidos) == 2000
+    assert {p[2] for p in pedidos} == set(app_module.PRECOS_INICIAIS)
+    assert {p[3] for p in pedidos} == set(benchmark.ROSHS)
+
+    dias = sorted({p[5][:10] for p in pedidos})
+    assert len(dias) > 80
+    assert benchmark.quantidade("10k") == 10_000 and benchmark.quantidade("2M") == 2_000_000
+
+
+def test_benchmark_banco_tem_alteracoes_e_alocacao_por_rota(app, tmp_path):
+    """
+    O banco sintético tem versões (o feed de alterações não vem
+    vazio) e o pico de alocações é de cada rota: uma rota leve medida
+    depois de uma pesada não herda o pico dela. Produtos, roshs e o
+    PATCH em lote também são medidos, sem erros.
+    """
+    import app as app_module
+    import benchmark
+
+    caminho = benchmark.gerar_banco(str(tmp_path / "bench.db"), 3000, 2, 1)
+    app_module.DB_PATH = caminho
+    client = app.test_client()
+    login(client, "adm", "admin123")
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        versao = app_module._versao(conn, "pedido")
+        assert conn.execute("SELECT COUNT(*) FROM pedido WHERE versao > 0").fetchone()[0] == benchmark.ALTERADOS
+    alteracoes = client.get(f"/api/pedidos/changes?since={versao - 100}").get_json()
+    assert len(alteracoes["alterados"]) == 100
+
+    pesada = benchmark.medir(client, "GET", "/api/pedidos/todos", None, 2, 0)
+    leve = benchmark.medir(client, "GET", "/api/catalogo", None, 2, 0)
+    assert pesada["alocacao_pico_kb"] > 10 * max(leve["alocacao_pico_kb"], 1)
+
+    nomes = {nome for nome, *_ in benchmark.rotas(3000, 3000, versao)}
+    assert {"produtos", "roshs", "atualizar_lote_50"} <= nomes
+    for nome, metodo, url, corpo in benchmark.rotas(3000, 3000, versao):
+        if nome in ("produtos", "roshs", "atualizar_lote_50"):
+            assert benchmark.medir(client, metodo, url, corpo, 2, 0)["erros"] == 0, nome
+    app_module.fechar_conexoes()
+
+
+def test_benchmark_compara_execucoes_e_aponta_regressao():
+    """
+    Só acusa regressão quando a mediana piora além da tolerância
+    (e de 1 ms).
+    """
+    import benchmark
+
+    anterior = {"rotas": {"lenta": {"p50_ms": 10.0}, "rapida": {"p50_ms": 0.2}}}
+    atual = {"rotas": {"lenta": {"p50_ms": 13.0}, "rapida": {"p50_ms": 0.5}, "nova": {"p50_ms": 1.0}}}
+
+    assert benchmark.comparar(atual, anterior, 0.15) == [("lenta", 10.0, 13.0)]
+    assert benchmark.comparar(atual, anterior, 0.5) == []
+
+
+# -------------------------------------------------------------------
+#                TESTES DO TESTE DE CARGA (carga.py)
+# -------------------------------------------------------------------
+
+def test_carga_no_processo_faz_login_e_gera_relatorio(app, monkeypatch):
+    """
+    Estações rodando no processo fazem login pelo /login e depois
+    criam, listam e alteram pedidos sem erros.
+    """
+    import carga
+
+    monkeypatch.setitem(app.config, "PROPAGATE_EXCEPTIONS", None)
+    dados = carga.executar(carga.argumentos([
+        "--estacoes", "2", "--admins", "0", "--duracao", "0.5", "--pausa", "0", "--perfil", "escrita",
+    ]))
+
+    assert dados["erros"] == {}
+    assert dados["acoes"]["login"]["requisicoes"] == 2
+    assert dados["acoes"]["criar"]["requisicoes"] > 0
+    assert dados["vazao_rps"] > 0
+    assert sum(dados["acoes"]["criar"]["histograma"].values()) == dados["acoes"]["criar"]["requisicoes"]
+
+
+def test_carga_doze_estacoes_cada_uma_com_seu_usuario(app, monkeypatch):
+    """
+    Com mais estações que o balde de login por usuário, cada estação
+    entra com o próprio usuário e nenhum login é barrado. Tudo roda
+    numa cópia do banco: o banco real não ganha pedidos nem usuários,
+    e a configuração do app volta ao que era.
+    """
+    import sqlite3
+    import app as app_module
+    import carga
+
+    monkeypatch.setitem(app.config, "PROPAGATE_EXCEPTIONS", None)
+    monkeypatch.setitem(app.config, "LOGIN_HASH_METODO", "pbkdf2:sha256:1000")
+    rajada_ip = app.config["LOGIN_IP_RAJADA"]
+    monkeypatch.setitem(app.config, "LOGIN_IP_RAJADA", 5)
+    banco = app_module.DB_PATH
+
+    dados = carga.executar(carga.argumentos([
+        "--estacoes", "12", "--admins", "0", "--duracao", "0.5", "--pausa", "0", "--perfil", "escrita",
+    ]))
+
+    assert dados["erros"] == {}
+    assert dados["acoes"]["login"]["requisicoes"] == 12
+    assert dados["acoes"]["criar"]["requisicoes"] > 0
+    assert app.config["PROPAGATE_EXCEPTIONS"] is None
+    assert app.config["LOGIN_IP_RAJADA"] == 5 != rajada_ip
+    assert app_module.DB_PATH == banco
+
+    conn = sqlite3.connect(banco)
+    assert conn.execute("SELECT COUNT(*) FROM user WHERE nome LIKE 'estacao%'").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM pedido").fetchone()[0] == 0
+    conn.close()
+
+
+def test_carga_classifica_erros():
+    """
+    Locks do SQLite, fila do escritor cheia e login limitado são
+    contados separadamente.
+    """
+    import sqlite3
+    import carga
+
+    assert carga._tipo_erro(excecao=sqlite3.OperationalError("database is locked")) == "sqlite_lock"
+    assert carga._tipo_erro(503) == "fila_escrita_cheia"
+    assert carga._tipo_erro(429) == "login_limitado"
+    assert carga._tipo_erro(500) == "http_5xx"
+    assert carga._tipo_erro(200) is None
+
+
+# -------------------------------------------------------------------
+#                    TESTES DE MÉTRICAS (/metrics)
+# -------------------------------------------------------------------
+
+def test_metrics_histograma_por_rota_e_contadores_sql(client):
+    """
+    Depois de algumas chamadas, /metrics traz o histograma de
+    latência por rota/status e os contadores de cada consulta SQL
+    (execuções e linhas devolvidas).
+    """
+    # O tempo fecha junto com a resposta (como no servidor)
+    for i in range(3):
+        client.post("/api/pedido", json={
+            "nome": f"Cliente {i}", "rg": str(i), "produto": "Aluguel Pequeno", "rosh": "Mix",
+        }).close()
+    client.get("/api/pedidos?format=json&page=1").close()
+    client.get("/api/pedidos/99999/nao-existe").close()
+
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.mimetype == "text/plain"
+    texto = res.get_data(as_text=True)
+
+    pid = os.getpid()
+    assert f'fumaca_requisicao_segundos_count{{endpoint="/api/pedido",metodo="POST",status="201",pid="{pid}"}} 3' in texto
+    assert 'endpoint="sem_rota",metodo="GET",status="404"' in texto
+    assert 'le="+Inf"' in texto
+
+    linhas_sql = [l for l in texto.splitlines() if l.startswith("fumaca_sql_linhas_total{")]
+    assert any("FROM pedido" in l and not l.endswith(" 0") for l in linhas_sql)
+    assert any(l.startswith("fumaca_sql_execucoes_total{") and "INSERT" in l for l in texto.splitlines())
+
+
+def test_metrics_em_andamento_e_tamanho_do_banco(client):
+    """
+    O gauge de requisições em andamento conta a própria chamada ao
+    /metrics, e o tamanho do banco principal aparece em bytes.
+    """
+    texto = client.get("/metrics").get_data(as_text=True)
+    pid = os.getpid()
+
+    assert f'fumaca_requisicoes_em_andamento{{pid="{pid}"}} 1' in texto
+    principal = next(l for l in texto.splitlines() if 'arquivo="principal"' in l)
+    assert int(principal.rsplit(" ", 1)[1]) > 0
+
+
+def test_metrics_fecham_com_a_resposta_e_contam_o_403_de_jobs(client):
+    """
+    Uma resposta em streaming só entra no histograma quando o envio
+    termina (resposta fechada); o 403 do before_request de /api/jobs
+    também é contado.
+    """
+    import app as app_module
+
+    criar_pedidos(client, 3)
+    chave = ("/api/pedidos/todos", "GET", 200)
+    res = client.get("/api/pedidos/todos?stream=1")
+    assert res.is_streamed
+    assert chave not in app_module.metricas.requisicoes
+    assert app_module.metricas.em_andamento >= 1
+    res.get_data()
+    res.close()
+    assert app_module.metricas.requisicoes[chave][-1] == 1
+
+    client.get("/api/jobs").close()
+    assert app_module.metricas.requisicoes[("/api/jobs", "GET", 403)][-1] == 1
+
+
+def test_metrics_normaliza_sql():
+    """
+    Literais e listas IN de tamanhos diferentes caem na mesma
+    consulta normalizada.
+    """
+    from app import normalizar_sql
+
+    assert normalizar_sql("SELECT *  FROM pedido\n WHERE pedidoid IN (?, ?, ?)") == \
+        normalizar_sql("SELECT * FROM pedido WHERE pedidoid IN (?,?)") == \
+        "SELECT * FROM pedido WHERE pedidoid IN (?, ...)"
+    assert normalizar_sql("SELECT 1 FROM t WHERE nome = 'a''b' AND x2 > 10") == \
+        "SELECT ? FROM t WHERE nome = ? AND x2 > ?"
+
+
+# -------------------------------------------------------------------
+#                TESTES DO LOG DE CONSULTAS LENTAS
+# -------------------------------------------------------------------
+
+def test_consulta_lenta_vai_para_o_log_com_plano_uma_vez(client, app, monkeypatch, caplog):
+    """
+    Com o limite em 0 ms toda consulta é "lenta": ela vai para o log
+    com o formato dos parâmetros, e o EXPLAIN QUERY PLAN roda só na
+    primeira vez que cada consulta aparece.
+    """
+    import app as app_module
+
+    criar_pedidos(client, 2)
+    monkeypatch.setitem(app.config, "CONSULTAS_LENTAS_MS", 0)
+    planos = []
+    original = app_module._plano_execucao
+    monkeypatch.setattr(app_module, "_plano_execucao", lambda *a: planos.append(a[1]) or original(*a))
+
+    with caplog.at_level("WARNING"):
+        client.get("/api/pedidos/busca?q=Cliente")
+        client.get("/api/pedidos/busca?q=Outro")
+
+    assert any("Consulta lenta" in r.getMessage() and "pedido_fts" in r.getMessage() for r in caplog.records)
+    assert len(planos) == len(set(planos))  # um EXPLAIN por consulta distinta
+
+    registro = next(r for sql, r in app_module.consultas_lentas.registros.items() if "pedido_fts MATCH" in sql)
+    assert registro["lentas"] == 2
+    assert registro["plano"]
+    assert registro["parametros"].startswith("(str")
+
+
+def test_diagnostico_consultas_somente_admin_e_aponta_varredura(client, app, monkeypatch):
+    """
+    A rota de diagnóstico exige admin, ordena as consultas pelo tempo
+    total e aponta as que leem a tabela pedido inteira.
+    """
+    monkeypatch.setitem(app.config, "CONSULTAS_LENTAS_MS", 0)
+    criar_pedidos(client, 3)
+    client.get("/api/pedidos/todos?format=json")
+
+    login(client, "Teste", "Teste")
+    assert client.get("/api/diagnostico/consultas").status_code == 403
+
+    login_admin = app.test_client()
+    login(login_admin, "adm", "admin123")
+    dados = login_admin.get("/api/diagnostico/consultas?limit=50").get_json()
+
+    totais = [c["total_ms"] for c in dados["consultas"]]
+    assert totais == sorted(totais, reverse=True)
+    assert dados["limite_lenta_ms"] == 0
+    varredura = [c for c in dados["consultas"] if c["varreduras_completas"] and "FROM pedido" in c["sql"]]
+    assert varredura and varredura[0]["linhas"] >= 3
+
+
+def test_formato_parametros_e_varreduras():
+    """
+    Os parâmetros aparecem só como tipos (nunca os valores), e só
+    passos "SCAN" sem índice contam como varredura completa.
+    """
+    from app import formato_parametros, varreduras_completas
+
+    assert formato_parametros((1, "RG 123", None)) == "(int, str, NoneType)"
+    assert formato_parametros(list(range(20))) == "(int x 20)"
+    assert formato_parametros({"nome": "Ana"}) == "{nome: str}"
+    assert varreduras_completas(["SCAN pedido", "SEARCH produto USING INDEX x (nome=?)",
+                                 "SCAN p USING INDEX idx"]) == ["pedido"]
+
+
+# -------------------------------------------------------------------
+#          TESTES DE PRODUTO/ROSH POR ID (migração 8 e cache)
+# -------------------------------------------------------------------
+
+def test_migracao_troca_nomes_por_ids_sem_mudar_a_api(app):
+    """
+    Pedidos gravados com o nome do produto/rosh passam a guardar os
+    ids; nomes fora do catálogo são cadastrados. A API continua
+    devolvendo os nomes, o resumo conta por produto e a busca acha
+    pelo nome do produto.
+    """
+    import sqlite3
+    import app as app_module
+
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.executemany(
+        "INSERT INTO pedido (name, rg, nome_produto, nome_rosh) VALUES (?, ?, ?, ?)",
+        [("Ana", "1", "Aluguel Pequeno", "Mix"), ("Bia", "2", "Narguilé Especial", "Mix"), ("Caio", "3", "", None)],
+    )
+    conn.commit()
+    conn.close()
+
+    client = app.test_client()
+    todos = client.get("/api/pedidos/todos").get_json()
+    assert [(p["nome_produto"], p["nome_rosh"]) for p in todos] == [
+        ("Aluguel Pequeno", "Mix"), ("Narguilé Especial", "Mix"), (None, None),
+    ]
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        assert conn.execute("SELECT DISTINCT typeof(nome_produto) FROM pedido WHERE nome_produto IS NOT NULL")\
+            .fetchall()[0][0] == "integer"
+        assert conn.execute("SELECT COUNT(*) FROM produto WHERE nome = 'Narguilé Especial'").fetchone()[0] == 1
+
+    quantidades = {i["produto"]: i["quantidade"] for i in client.get("/api/resumo").get_json()["produtos"]}
+    assert quantidades == {"Aluguel Pequeno": 1, "Narguilé Especial": 1, "": 1}
+    busca = client.get("/api/pedidos/busca?q=especial").get_json()["pedidos"]
+    assert [p["name"] for p in busca] == ["Bia"]
+
+
+def test_gravacao_resolve_ids_e_recusa_nome_desconhecido(client, app):
+    """
+    POST/PUT gravam o id do catálogo; produto fora do catálogo → 400,
+    e no lote o item inválido cancela o lote inteiro.
+    """
+    import app as app_module
+
+    criar_pedidos(client, 1)
+    with app.app_context():
+        linha = app_module.db_connection().execute("SELECT nome_produto, nome_rosh FROM pedido").fetchone()
+    assert tuple(linha) == (1, 1)
+
+    item = {"nome": "X", "rg": "9", "produto": "Inexistente", "rosh": "Mix"}
+    res = client.post("/api/pedido", data=json.dumps(item), content_type="application/json")
+    assert res.status_code == 400
+    assert "Inexistente" in res.get_json()["error"]
+    assert client.put("/api/pedido/1", data=json.dumps(item), content_type="application/json").status_code == 400
+
+    lote = client.post("/api/pedidos/batch", json={"pedidos": [dict(item, produto="Aluguel Pequeno"), item]})
+    assert lote.status_code == 400
+    assert [r["indice"] for r in lote.get_json()["resultados"]] == [1]
+
+    # O catálogo novo vale na hora (o cache segue a versão do catálogo)
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.execute("INSERT INTO produto (nome, preco) VALUES ('Inexistente', 10)")
+        conn.commit()
+    res = client.post("/api/pedido", data=json.dumps(item), content_type="application/json")
+    assert res.status_code == 201
+    assert client.get("/api/pedidos").get_json()[-1]["nome_produto"] == "Inexistente"
+
+
+def test_arquivo_antigo_com_nomes_e_convertido_ao_anexar(client, app):
+    """
+    Um banco de arquivo de antes da migração (nomes nas linhas) é
+    convertido para ids na primeira vez que é anexado.
+    """
+    import sqlite3
+    import app as app_module
+
+    criar_pedidos(client, 2)
+    envelhecer_pedidos(app, [1])
+    with app.app_context():
+        app_module.arquivar_pedidos_antigos()
+    app_module.fechar_conexoes()
+
+    conn = sqlite3.connect(app_module._caminho_arquivo())
+    conn.execute("UPDATE pedido SET nome_produto = 'Aluguel Pequeno', nome_rosh = 'Mix'")
+    conn.execute("PRAGMA user_version = 0")
+    conn.commit()
+    conn.close()
+
+    todos = client.get("/api/pedidos/todos?format=columnar").get_json()
+    assert todos["dicionarios"] == {"nome_produto": ["Aluguel Pequeno"], "nome_rosh": ["Mix"]}
+
+    conn = sqlite3.connect(app_module._caminho_arquivo())
+    assert conn.execute("SELECT nome_produto, nome_rosh FROM pedido").fetchall() == [(1, 1)]
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 1
+    conn.close()
+
+
+# -------------------------------------------------------------------
+#               TESTES DA EXPORTAÇÃO CSV (/export.csv)
+# -------------------------------------------------------------------
+
+def ler_csv(resposta):
+    """Lê o CSV exportado (sem o BOM) como lista de dicionários."""
+    import csv
+    import io
+
+    texto = resposta.get_data(as_text=True)
+    assert texto.startswith("﻿")
+    return list(csv.DictReader(io.StringIO(texto[1:])))
+
+
+def test_exportacao_csv_somente_admin_com_preco_e_anexo(client, app):
+    """
+    Só o admin exporta; o CSV vem como anexo, com os nomes de produto
+    e rosh, o preço do cadastro e os pedidos do arquivo, em ordem de
+    criação.
+    """
+    import app as app_module
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.execute("UPDATE produto SET preco = 40 WHERE nome = 'Aluguel Pequeno'")
+        conn.commit()
+
+    criar_pedidos(client, 3)
+    envelhecer_pedidos(app, [2])
+    with app.app_context():
+        app_module.arquivar_pedidos_antigos()
+
+    login(client, "Teste", "Teste")
+    assert client.get("/api/pedidos/export.csv").status_code == 403
+
+    admin = app.test_client()
+    login(admin, "adm", "admin123")
+    res = admin.get("/api/pedidos/export.csv")
+    assert res.status_code == 200
+    assert res.mimetype == "text/csv"
+    assert res.headers["Content-Disposition"] == "attachment; filename=pedidos_completo.csv"
+
+    linhas = ler_csv(res)
+    assert [l["pedidoid"] for l in linhas] == ["2", "1", "3"]  # o 2 foi criado 400 dias antes
+    assert linhas[0]["produto"] == "Aluguel Pequeno" and linhas[0]["rosh"] == "Mix"
+    assert linhas[0]["preco"] == "40.0" and linhas[0]["nome"] == "Cliente 2"
+
+
+def test_exportacao_csv_neutraliza_formulas(client, app):
+    """
+    Campos digitados que começam com = + - @ ou tab saem com um
+    apóstrofo na frente (o Excel não executa como fórmula).
+    """
+    client.post("/api/pedido", json={
+        "nome": "=HYPERLINK(\"http://x\")", "rg": "+55", "produto": "Aluguel Pequeno", "rosh": "Mix",
+        "essencia": "@SUM(A1)", "observacao": "\t-1",
+    })
+    client.post("/api/pedido", json={"nome": "Ana - mesa 2", "rg": "7", "produto": "Aluguel Pequeno", "rosh": "Mix"})
+
+    login(client, "adm", "admin123")
+    perigoso, normal = ler_csv(client.get("/api/pedidos/export.csv"))
+    assert perigoso["nome"] == "'=HYPERLINK(\"http://x\")"
+    assert perigoso["rg"] == "'+55"
+    assert perigoso["essencia"] == "'@SUM(A1)"
+    assert perigoso["observacao"] == "'\t-1"
+    assert normal["nome"] == "Ana - mesa 2" and normal["rg"] == "7"
+
+
+def test_exportacao_csv_filtros(client, app):
+    """
+    from/to (dias locais), produto, rosh e ativo filtram as linhas;
+    valores inválidos → 400.
+    """
+    import time
+    import app as app_module
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.execute("INSERT INTO produto (nome, preco) VALUES ('Reposição', 25)")
+        conn.commit()
+
+    criar_pedidos(client, 3)
+    client.post("/api/pedido", json={"nome": "Outro", "rg": "9", "produto": "Reposição", "rosh": "Mix"})
+    client.put("/api/pedido/1/ativo", json={"ativo": 1})
+    envelhecer_pedidos(app, [3], dias=10)
+
+    login(client, "adm", "admin123")
+    hoje = app_module._epoch_para_local(int(time.time()))[:10]
+
+    def ids(consulta):
+        return [l["pedidoid"] for l in ler_csv(client.get(f"/api/pedidos/export.csv?{consulta}"))]
+
+    assert ids(f"from={hoje}&to={hoje}") == ["1", "2", "4"]
+    assert ids("produto=Reposição") == ["4"]
+    assert ids("ativo=1&rosh=Mix") == ["1"]
+
+    assert client.get("/api/pedidos/export.csv?from=01/02/2024").status_code == 400
+    assert client.get("/api/pedidos/export.csv?produto=Inexistente").status_code == 400
+    assert client.get("/api/pedidos/export.csv?ativo=2").status_code == 400
+
+
+def test_exportacao_csv_em_lotes_sem_ordenacao_temporaria(client, app, monkeypatch):
+    """
+    A resposta é transmitida em partes (uma por lote do cursor), e o
+    plano da consulta com período e arquivo não usa ordenação
+    temporária (a memória não cresce com o histórico).
+    """
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "STREAM_LOTE", 2)
+    criar_pedidos(client, 5)
+    login(client, "adm", "admin123")
+
+    res = client.get("/api/pedidos/export.csv?from=2000-01-01", buffered=False)
+    assert res.is_streamed
+    partes = list(res.response)
+    res.close()
+    assert len(partes) == 1 + 3  # cabeçalho + 3 lotes
+
+    with app.app_context():
+        conn = app_module.db_connection()
+        app_module._anexar_arquivo(conn, criar=True)
+        sql, params = app_module._sql_pedidos(
+            ["p.criacao_epoch >= ?"], [0], True, "ASC",
+            campos="p.pedidoid, p.criacao_epoch", ordenar_por=("criacao_epoch", "pedidoid"),
+        )
+        plano = [linha[3] for linha in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+    assert not any("TEMP B-TREE" in passo for passo in plano)
+
+
+# -------------------------------------------------------------------
+#            TESTES DAS TAREFAS EM SEGUNDO PLANO (/api/jobs)
+# -------------------------------------------------------------------
+
+def esperar_tarefa(client, tarefaid, limite_s=10):
+    """Consulta a tarefa até ela terminar (ou estourar o limite)."""
+    import time
+
+    fim = time.monotonic() + limite_s
+    while time.monotonic() < fim:
+        tarefa = client.get(f"/api/jobs/{tarefaid}").get_json()
+        if tarefa["status"] in ("concluida", "falhou", "cancelada"):
+            return tarefa
+        time.sleep(0.05)
+    raise AssertionError(f"tarefa {tarefaid} não terminou: {tarefa}")
+
+
+def test_tarefa_exportacao_roda_em_segundo_plano_e_gera_arquivo(client, app, monkeypatch, tmp_path):
+    """
+    POST /api/jobs → 202 com Location; o polling mostra a tarefa
+    concluída e o arquivo gerado é o mesmo CSV de /export.csv.
+    """
+    monkeypatch.setitem(app.config, "TAREFAS_DIR", str(tmp_path))
+    criar_pedidos(client, 3)
+
+    login(client, "Teste", "Teste")
+    assert client.post("/api/jobs", json={"tipo": "exportar_csv"}).status_code == 403
+
+    admin = app.test_client()
+    login(admin, "adm", "admin123")
+    res = admin.post("/api/jobs", json={"tipo": "exportar_csv", "parametros": {"from": "2000-01-01", "ativo": 0}})
+    assert res.status_code == 202
+    assert res.headers["Location"].endswith(f"/api/jobs/{res.get_json()['id']}")
+
+    tarefa = esperar_tarefa(admin, res.get_json()["id"])
+    assert tarefa["status"] == "concluida" and tarefa["progresso"] == 1
+    assert tarefa["resultado"]["linhas"] == 3
+    assert tarefa["usuario"] == "adm"
+
+    arquivo = admin.get(tarefa["resultado_url"])
+    assert arquivo.status_code == 200
+    assert "attachment" in arquivo.headers["Content-Disposition"]
+    assert [l["pedidoid"] for l in ler_csv(arquivo)] == ["1", "2", "3"]
+    arquivo.close()
+    assert not list(tmp_path.glob("*.parcial"))
+
+    listagem = admin.get("/api/jobs?status=concluida").get_json()
+    assert [t["id"] for t in listagem["tarefas"]] == [tarefa["id"]]
+
+
+def test_tarefa_validacao_fila_cheia_e_cancelamento(client, app, monkeypatch):
+    """
+    Tipo ou parâmetros inválidos (idade_dias abaixo da janela de
+    recentes inclusive) → 400; fila cheia → 503 com
+    Retry-After; pendente cancela na hora; terminada → 409.
+    """
+    import time
+    import app as app_module
+
+    login(client, "adm", "admin123")
+    assert client.post("/api/jobs", json={"tipo": "apagar_tudo"}).status_code == 400
+    for corpo in (["arquivar"], "arquivar", 3, {"tipo": ["arquivar"]}, {"tipo": {"a": 1}}):
+        assert client.post("/api/jobs", json=corpo).status_code == 400, corpo
+    assert client.post("/api/jobs", json={"tipo": "exportar_csv", "parametros": {"from": "ontem"}}).status_code == 400
+    assert client.post("/api/jobs", json={"tipo": "arquivar", "parametros": {"idade_dias": -1}}).status_code == 400
+    janela = app.config["JANELA_RECENTES_DIAS"]
+    assert client.post("/api/jobs", json={"tipo": "arquivar", "parametros": {"idade_dias": janela - 1}}).status_code == 400
+    assert client.post("/api/jobs", json={"tipo": "arquivar", "parametros": {"idade_dias": 1e308}}).status_code == 400
+    for invalido in ({"from": 20240101}, {"to": ["x"]}, {"produto": {"a": 1}}, {"ativo": True}, {"ativo": 2}):
+        res = client.post("/api/jobs", json={"tipo": "exportar_csv", "parametros": invalido})
+        assert res.status_code == 400, invalido
+    assert client.get("/api/jobs/999").status_code == 404
+
+    # Pendente que ainda não foi entregue a nenhum executor
+    with app.app_context():
+        conn = app_module.db_connection()
+        tarefaid = conn.execute(
+            "INSERT INTO tarefa (tipo, criacao_epoch) VALUES ('arquivar', ?)", (int(time.time()),)
+        ).lastrowid
+        conn.commit()
+
+    monkeypatch.setitem(app.config, "TAREFAS_PENDENTES_MAXIMO", 1)
+    cheia = client.post("/api/jobs", json={"tipo": "reindexar_busca"})
+    assert cheia.status_code == 503 and cheia.headers["Retry-After"]
+
+    res = client.post(f"/api/jobs/{tarefaid}/cancel")
+    assert res.status_code == 202 and res.get_json()["status"] == "cancelada"
+    assert client.post(f"/api/jobs/{tarefaid}/cancel").status_code == 409
+    assert client.get(f"/api/jobs/{tarefaid}/resultado").status_code == 409
+
+
+def test_tarefa_em_execucao_para_no_proximo_progresso(app, monkeypatch):
+    """
+    O pedido de cancelamento é lido do banco no progresso(), então
+    vale mesmo se a tarefa roda em outro processo.
+    """
+    import time
+    import pytest
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "TAREFAS_BATIMENTO_S", 0)
+    with app.app_context():
+        conn = app_module.db_connection()
+        tarefaid = conn.execute(
+            "INSERT INTO tarefa (tipo, status, criacao_epoch) VALUES ('arquivar', 'executando', ?)",
+            (int(time.time()),),
+        ).lastrowid
+        conn.commit()
+
+        contexto = app_module.ContextoTarefa(tarefaid)
+        contexto.progresso(0.5)
+        conn.execute("UPDATE tarefa SET cancelar = 1 WHERE tarefaid = ?", (tarefaid,))
+        conn.commit()
+        with pytest.raises(app_module.TarefaCancelada):
+            contexto.progresso(0.6)
+        assert conn.execute("SELECT progresso FROM tarefa WHERE tarefaid = ?", (tarefaid,)).fetchone()[0] == 0.6
+
+
+def test_tarefas_orfas_falham_ou_sao_retomadas(client, app, monkeypatch):
+    """
+    Sem batimento há TAREFAS_ORFA_S (worker morreu): a exportação é
+    marcada como falha; o arquivamento (retomável) volta para a fila
+    e termina; quem já passou do limite de tentativas falha.
+    """
+    import time
+    import app as app_module
+
+    criar_pedidos(client, 2)
+    envelhecer_pedidos(app, [1])
+    antigo = int(time.time()) - 3600
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.executemany(
+            "INSERT INTO tarefa (tipo, status, tentativas, criacao_epoch, batimento_epoch) VALUES (?, 'executando', ?, ?, ?)",
+            [("exportar_csv", 1, antigo, antigo), ("arquivar", 1, antigo, antigo), ("arquivar", 3, antigo, antigo)],
+        )
+        conn.commit()
+        app_module.recuperar_tarefas()
+
+    login(client, "adm", "admin123")
+    exportacao, arquivamento, esgotada = (esperar_tarefa(client, i) for i in (1, 2, 3))
+    assert exportacao["status"] == "falhou"
+    assert exportacao["mensagem"] == "Interrompida por reinício do servidor"
+    assert arquivamento["status"] == "concluida"
+    assert arquivamento["resultado"] == {"movidos": 1}
+    assert esgotada["status"] == "falhou"
+
+
+def test_tarefa_longa_sem_progresso_mantem_batimento(client, app, monkeypatch):
+    """
+    Um passo longo que não chama progresso() não é dado como órfão:
+    a thread de batimento renova batimento_epoch enquanto ele roda.
+    """
+    import time
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "TAREFAS_ORFA_S", 2)
+    monkeypatch.setitem(app_module.TIPOS_TAREFA, "lenta", {
+        "funcao": lambda contexto, parametros: time.sleep(3.5) or {}, "validar": None, "retomavel": False,
+    })
+
+    login(client, "adm", "admin123")
+    tarefaid = client.post("/api/jobs", json={"tipo": "lenta"}).get_json()["id"]
+    time.sleep(3)
+    with app.app_context():
+        app_module.recuperar_tarefas()
+    assert client.get(f"/api/jobs/{tarefaid}").get_json()["status"] == "executando"
+    assert esperar_tarefa(client, tarefaid)["status"] == "concluida"
+
+
+def test_tarefa_dada_como_orfa_nao_e_sobrescrita_no_fim(client, app, monkeypatch, tmp_path):
+    """
+    Se a varredura marcou a tarefa como falha enquanto ela rodava, o
+    fim da execução não troca o estado para concluída e o arquivo
+    gerado é descartado.
+    """
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "TAREFAS_DIR", str(tmp_path))
+
+    def orfa(contexto, parametros):
+        conn = app_module.db_connection()
+        conn.execute("UPDATE tarefa SET status = 'falhou' WHERE tarefaid = ?", (contexto.tarefaid,))
+        conn.commit()
+        (tmp_path / "orfa.csv").write_text("x")
+        return {"arquivo": "orfa.csv"}
+
+    monkeypatch.setitem(app_module.TIPOS_TAREFA, "orfa", {"funcao": orfa, "validar": None, "retomavel": False})
+
+    login(client, "adm", "admin123")
+    tarefa = esperar_tarefa(client, client.post("/api/jobs", json={"tipo": "orfa"}).get_json()["id"])
+    assert tarefa["status"] == "falhou" and tarefa["resultado"] is None
+    assert not (tmp_path / "orfa.csv").exists()
+
+
+def test_tarefas_terminadas_expiram_com_o_arquivo(client, app, monkeypatch, tmp_path):
+    """Terminadas há mais de TAREFAS_RETENCAO_S somem, com o arquivo."""
+    import time
+    import app as app_module
+
+    monkeypatch.setitem(app.config, "TAREFAS_DIR", str(tmp_path))
+    (tmp_path / "tarefa_1.csv").write_text("x")
+    agora = int(time.time())
+    with app.app_context():
+        conn = app_module.db_connection()
+        conn.executemany(
+            "INSERT INTO tarefa (tipo, status, resultado, criacao_epoch, fim_epoch) VALUES ('exportar_csv', 'concluida', ?, ?, ?)",
+            [('{"arquivo": "tarefa_1.csv"}', agora - 30 * 86400, agora - 30 * 86400), (None, agora, agora)],
+        )
+        conn.commit()
+        app_module.recuperar_tarefas()
+        assert [l[0] for l in conn.execute("SELECT tarefaid FROM tarefa")] == [2]
+    assert not (tmp_path / "tarefa_1.csv").exists()
+
+
+def test_tarefa_reindexar_busca_usa_nomes_atuais_do_catalogo(client, app):
+    """
+    Produto renomeado direto no banco: depois da reindexação, a busca
+    acha os pedidos (inclusive arquivados) pelo nome novo.
+    """
+    import app as app_module
+
+    criar_pedidos(client, 2)
+    envelhecer_pedidos(app, [1])
+    with app.app_context():
+        app_module.arquivar_pedidos_antigos()
+        conn = app_module.db_connection()
+        conn.execute("UPDATE produto SET nome = 'Narguile Grande' WHERE nome = 'Aluguel Pequeno'")
+        conn.commit()
+
+    login(client, "adm", "admin123")
+    assert client.get("/api/pedidos/busca?q=narguile").get_json()["pedidos"] == []
+
+    res = client.post("/api/jobs", json={"tipo": "reindexar_busca"})
+    assert esperar_tarefa(client, res.get_json()["id"])["status"] == "concluida"
+
+    pedidos = client.get("/api/pedidos/busca?q=narguile").get_json()["pedidos"]
+    assert sorted(p["pedidoid"] for p in pedidos) == [1, 2]
+
+
+# -------------------------------------------------------------------
+#        TESTES DOS ESTÁTICOS COM IMPRESSÃO DIGITAL (/assets)
+# -------------------------------------------------------------------
+
+def test_pagina_usa_url_com_hash_do_conteudo(client, app):
+    """
+    O template aponta para /assets/index.<hash>.js; o hash muda
+    quando o arquivo muda, e a versão antiga continua disponível.
+    """
+    import re
+    import app as app_module
+
+    login(client, "Teste", "Teste")
+    html = client.get("/").get_data(as_text=True)
+    url = re.search(r'src="(/assets/index\.[0-9a-f]{12}\.js)"', html).group(1)
+
+    with app.test_request_context():
+        assert app_module.estatico("index.js") == url
+        assert app_module.estatico("nao_existe.js") == "/static/nao_existe.js"
+
+    pasta = app.config["ESTATICOS_DIR"]
+    assert sorted(os.listdir(pasta)) == sorted(
+        n for impresso in app_module._manifesto_estaticos.values() for n in (impresso, impresso + ".gz")
+    )
+
+
+def test_login_liga_a_folha_de_estilo_pelo_helper(client, app, monkeypatch, tmp_path):
+    """
+    O Login.html aponta o Login2.css pelo estatico(): sem o arquivo,
+    cai em /static; com ele em static/, vira /assets/Login2.<hash>.css.
+    """
+    import re
+    import app as app_module
+
+    assert 'href="/static/Login2.css"' in client.get("/login").get_data(as_text=True)
+
+    (tmp_path / "Login2.css").write_text("body { margin: 0; }")
+    monkeypatch.setattr(app, "static_folder", str(tmp_path))
+    monkeypatch.setattr(app_module, "_manifesto_estaticos", {})
+    html = client.get("/login").get_data(as_text=True)
+    assert re.search(r'href="/assets/Login2\.[0-9a-f]{12}\.css"', html)
+
+
+def test_estaticos_preparados_em_paralelo_sem_erro(app):
+    """
+    Várias primeiras páginas ao mesmo tempo (servidor com threads):
+    todas recebem a URL com hash e não sobra temporário na pasta.
+    """
+    import threading
+    import app as app_module
+
+    urls, erros = [], []
+
+    def renderizar():
+        try:
+            with app.test_request_context():
+                urls.append(app_module.estatico("index.js"))
+        except Exception as e:
+            erros.append(e)
+
+    threads = [threading.Thread(target=renderizar) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert erros == []
+    assert len(set(urls)) == 1 and urls[0].startswith("/assets/index.")
+    assert not [n for n in os.listdir(app.config["ESTATICOS_DIR"]) if n.endswith(".tmp")]
+
+
+def test_assets_servem_gzip_pronto_com_cache_imutavel(client, app):
+    """
+    Com Accept-Encoding: gzip vem o .gz gerado na preparação (mesmo
+    conteúdo do original); sem, vem o arquivo puro. Os dois com
+    cache longo e imutável.
+    """
+    import gzip
+    import app as app_module
+
+    impresso = app_module.preparar_estaticos()["Historico.js"]
+    with open(os.path.join(app.static_folder, "Historico.js"), "rb") as f:
+        original = f.read()
+
+    res = client.get(f"/assets/{impresso}", headers={"Accept-Encoding": "gzip"})
+    assert res.status_code == 200
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert res.mimetype in ("text/javascript", "application/javascript")
+    assert "immutable" in res.headers["Cache-Control"]
+    assert "max-age=31536000" in res.headers["Cache-Control"]
+    assert "Accept-Encoding" in res.headers["Vary"]
+    assert gzip.decompress(res.get_data()) == original
+    res.close()
+
+    puro = client.get(f"/assets/{impresso}")
+    assert "Content-Encoding" not in puro.headers
+    assert puro.get_data() == original
+    assert "immutable" in puro.headers["Cache-Control"]
+    puro.close()
+
+
+def test_assets_inexistente_ou_gz_direto_404(client, app):
+    """Só os nomes do manifesto (sem o .gz e sem sair da pasta)."""
+    import app as app_module
+
+    impresso = app_module.preparar_estaticos()["index.js"]
+    assert client.get("/assets/index.000000000000.js").status_code == 404
+    assert client.get(f"/assets/{impresso}.gz").status_code == 404
+    assert client.get("/assets/..%2Fapp.py").status_code == 404